@@ -415,10 +415,10 @@ def init_activity_map_coloring(map_type, subcorticals=True):
 def load_faces_verts():
     faces_verts = {}
     current_root_path = mu.get_user_fol()
-    if op.isfile(op.join(current_root_path, 'faces_verts_lh.npy') and \
-                         op.join(current_root_path, 'faces_verts_rh.npy')):
-        faces_verts['lh'] = np.load(op.join(current_root_path, 'faces_verts_lh.npy'))
-        faces_verts['rh'] = np.load(op.join(current_root_path, 'faces_verts_rh.npy'))
+    if mu.faces_verts_lookup_exists(op.join(current_root_path, 'faces_verts_lh.npy')) and \
+            mu.faces_verts_lookup_exists(op.join(current_root_path, 'faces_verts_rh.npy')):
+        faces_verts['lh'] = mu.load_faces_verts_lookup(op.join(current_root_path, 'faces_verts_lh.npy'))
+        faces_verts['rh'] = mu.load_faces_verts_lookup(op.join(current_root_path, 'faces_verts_rh.npy'))
     return faces_verts
 
 
@@ -426,13 +426,13 @@ def load_subs_faces_verts():
     faces_verts = {}
     verts = {}
     current_root_path = mu.get_user_fol()
-    subcoticals = glob.glob(op.join(current_root_path, 'subcortical', '*_faces_verts.npy'))
-    for subcortical_file in subcoticals:
-        subcortical = mu.namebase(subcortical_file)[:-len('_faces_verts')]
-        lookup_file = op.join(current_root_path, 'subcortical', '{}_faces_verts.npy'.format(subcortical))
+    subcoticals = set([mu.namebase(f)[:-len('_faces_verts')] for f in
+                       glob.glob(op.join(current_root_path, 'subcortical', '*_faces_verts.np[yz]'))])
+    for subcortical in subcoticals:
+        lookup_file = op.join(current_root_path, 'subcortical', '{}_faces_verts.npz'.format(subcortical))
         verts_file = op.join(current_root_path, 'subcortical', '{}.npz'.format(subcortical))
-        if op.isfile(lookup_file) and op.isfile(verts_file):
-            faces_verts[subcortical] = np.load(lookup_file)
+        if mu.faces_verts_lookup_exists(lookup_file) and op.isfile(verts_file):
+            faces_verts[subcortical] = mu.load_faces_verts_lookup(lookup_file)
             verts[subcortical] = np.load(verts_file)['verts']
     return faces_verts, verts
 
@@ -817,18 +817,21 @@ def plot_activity(map_type, faces_verts, threshold, meg_sub_activity=None,
             if map_type == 'MEG':
                 activity_type = bpy.context.scene.meg_files
                 activity_type = '' if activity_type == 'conditions diff' else '{}_'.format(activity_type)
-                fname = op.join(current_root_path, 'activity_map_{}{}'.format(
-                    activity_type, hemi), 't' + frame_str + '.npy')
+                fol = op.join(current_root_path, 'activity_map_{}{}'.format(activity_type, hemi))
                 colors_ratio = ColoringMakerPanel.meg_activity_colors_ratio
                 data_min, data_max = ColoringMakerPanel.meg_activity_data_minmax
                 cb_title = 'MEG'
             elif map_type == 'FMRI_DYNAMICS':
-                fname =  op.join(current_root_path, 'fmri', 'activity_map_' + hemi, 't' + frame_str + '.npy')
+                fol = op.join(current_root_path, 'fmri', 'activity_map_' + hemi)
                 colors_ratio = ColoringMakerPanel.fmri_activity_colors_ratio
                 data_min, data_max = ColoringMakerPanel.fmri_activity_data_minmax
                 cb_title = 'fMRI'
-            if op.isfile(fname):
+            # The memory-mapped cube is returned as is, the frame is sliced (without copying) below
+            f, _ = mu.load_activity_cube(fol)
+            fname = op.join(fol, 't' + frame_str + '.npy')
+            if f is None and op.isfile(fname):
                 f = np.load(fname)
+            if f is not None:
                 if _addon().colorbar_values_are_locked():
                     data_max, data_min = _addon().get_colorbar_max_min()
                     colors_ratio = 256 / (data_max - data_min)
@@ -902,9 +905,9 @@ def fmri_subcortex_activity_color(threshold, override_current_mat=True, use_abs=
         if cur_obj is None:
             print("Can't find the object {}!".format(subcortical))
         else:
-            lookup_file = op.join(current_root_path, 'subcortical', '{}_faces_verts.npy'.format(subcortical))
-            if op.isfile(lookup_file):
-                lookup = np.load(lookup_file)
+            lookup_file = op.join(current_root_path, 'subcortical', '{}_faces_verts.npz'.format(subcortical))
+            if mu.faces_verts_lookup_exists(lookup_file):
+                lookup = mu.load_faces_verts_lookup(lookup_file)
                 verts_values = np.load(subcortical_file)
                 activity_map_obj_coloring(cur_obj, verts_values, lookup, threshold, override_current_mat,
                                           use_abs=use_abs)
@@ -923,11 +926,7 @@ def create_inflated_curv_coloring():
             cur_obj.select = True
             bpy.ops.mesh.vertex_color_remove()
             vcol_layer = mesh.vertex_colors.new('curve')
-            for vert in range(curv.shape[0]):
-                x = lookup[vert]
-                for loop_ind in x[x>-1]:
-                    d = vcol_layer.data[loop_ind]
-                    d.color = verts_colors[vert]
+            verts_lookup_loop_coloring(np.arange(curv.shape[0]), lookup, vcol_layer, verts_colors, cur_obj.name)
 
     try:
         # todo: check not to overwrite
@@ -935,12 +934,12 @@ def create_inflated_curv_coloring():
         for hemi in mu.HEMIS:
             cur_obj = mu.get_hemi_obj(hemi)
             curv_fname = op.join(mu.get_user_fol(), 'surf', '{}.curv.npy'.format(hemi))
-            faces_verts_fname = op.join(mu.get_user_fol(), 'faces_verts_{}.npy'.format(hemi))
-            if not op.isfile(curv_fname) or not op.isfile(faces_verts_fname):
+            faces_verts_fname = op.join(mu.get_user_fol(), 'faces_verts_{}.npz'.format(hemi))
+            if not op.isfile(curv_fname) or not mu.faces_verts_lookup_exists(faces_verts_fname):
                 print("Can't plot the {} curves!".format(hemi))
                 continue
             curv = np.load(curv_fname)
-            lookup = np.load(op.join(mu.get_user_fol(), 'faces_verts_{}.npy'.format(hemi)))
+            lookup = mu.load_faces_verts_lookup(faces_verts_fname)
             color_obj_curvs(cur_obj, curv, lookup)
         for hemi in mu.HEMIS:
             curvs_fol = op.join(mu.get_user_fol(), 'surf', '{}_{}_curves'.format(bpy.context.scene.atlas, hemi))
@@ -955,9 +954,9 @@ def create_inflated_curv_coloring():
                     else:
                         print('Can\'t find the file {}'.format(curv_file))
 
-                    faces_verts_file = op.join(lookup_fol, '{}_faces_verts.npy'.format(label))
-                    if op.isfile(faces_verts_file):
-                        lookup = np.load(faces_verts_file)
+                    faces_verts_file = op.join(lookup_fol, '{}_faces_verts.npz'.format(label))
+                    if mu.faces_verts_lookup_exists(faces_verts_file):
+                        lookup = mu.load_faces_verts_lookup(faces_verts_file)
                     else:
                         print('Can\'t find the file {}'.format(faces_verts_file))
                     color_obj_curvs(inflated_cur_obj, curv, lookup)
@@ -1031,14 +1030,11 @@ def activity_map_obj_coloring(cur_obj, vert_values, lookup=None, threshold=0, ov
         cur_obj = bpy.data.objects[cur_obj]
     if lookup is None:
         lookup_fnames = glob.glob(
-            op.join(mu.get_user_fol(), '**', '{}_faces_verts.npy'.format(cur_obj.name)), recursive=True)
+            op.join(mu.get_user_fol(), '**', '{}_faces_verts.np[yz]'.format(cur_obj.name)), recursive=True)
         if len(lookup_fnames) == 0:
             print("activity_map_obj_coloring: Can't find the lookup file for {}".format(cur_obj))
             return False
-        lookup = np.load(lookup_fnames[0])
-
-    mesh = cur_obj.data
-    scn = bpy.context.scene
+        lookup = mu.load_faces_verts_lookup(lookup_fnames[0])
 
     if use_abs is None:
         use_abs = bpy.context.scene.coloring_use_abs
@@ -1058,8 +1054,20 @@ def activity_map_obj_coloring(cur_obj, vert_values, lookup=None, threshold=0, ov
     if vert_values.ndim == 1 and data_min is not None:
         verts_colors = calc_colors(vert_values, data_min, colors_ratio)
         colors_picked_from_cm = True
+    vcol_layer = prepare_coloring_layer(cur_obj, override_current_mat, coloring_layer)
+    if save_prev_colors:
+        ColoringMakerPanel.prev_colors[cur_obj.name] = {'lookup':lookup, 'vcol_layer':vcol_layer}
+    if colors_picked_from_cm:
+        verts_lookup_loop_coloring(valid_verts, lookup, vcol_layer, verts_colors, cur_obj.name, save_prev_colors)
+    else:
+        verts_lookup_loop_coloring(
+            valid_verts, lookup, vcol_layer, vert_values[:, 1:], cur_obj.name, save_prev_colors)
+
+
+def prepare_coloring_layer(cur_obj, override_current_mat=True, coloring_layer='Col'):
+    mesh = cur_obj.data
     #check if our mesh already has Vertex Colors, and if not add some... (first we need to make sure it's the active object)
-    scn.objects.active = cur_obj
+    bpy.context.scene.objects.active = cur_obj
     cur_obj.select = True
     if override_current_mat:
         recreate_coloring_layers(mesh, coloring_layer)
@@ -1069,30 +1077,117 @@ def activity_map_obj_coloring(cur_obj, vert_values, lookup=None, threshold=0, ov
         # mesh.vertex_colors.active_index = 1
         mesh.vertex_colors.active_index = mesh.vertex_colors.keys().index(coloring_layer)
         mesh.vertex_colors[coloring_layer].active_render = True
-    # else:
-    #     vcol_layer = mesh.vertex_colors.active
-    # print('cur_obj: {}, max vert in lookup: {}, vcol_layer len: {}'.format(cur_obj.name, np.max(lookup), len(vcol_layer.data)))
-    vcol_layer = mesh.vertex_colors[coloring_layer]
-    if save_prev_colors:
-        ColoringMakerPanel.prev_colors[cur_obj.name] = {'lookup':lookup, 'vcol_layer':vcol_layer, 'colors':{}}
-    if colors_picked_from_cm:
-        verts_lookup_loop_coloring(
-            valid_verts, lookup, vcol_layer, lambda vert:verts_colors[vert], cur_obj.name, save_prev_colors)
+    return mesh.vertex_colors[coloring_layer]
+
+
+def calc_activity_frame_colors(vert_values, lookup, threshold, data_min, colors_ratio, cm, use_abs,
+                               bigger_or_equall=False):
+    # No bpy calls here, so it can be called from the play panel's prefetching threads
+    values = np.array(vert_values, dtype=np.float32)
+    valid_verts = find_valid_verts(values, threshold, use_abs, bigger_or_equall)
+    verts_colors = mu.calc_colors_from_cm(values[valid_verts], data_min, colors_ratio, cm)
+    loops, loops_verts = lookup_loops(lookup, valid_verts)
+    return dict(values=values, loops=loops, loops_colors=verts_colors[loops_verts])
+
+
+def get_activity_map_frames_calculator(map_type, threshold=None):
+    # Collects on the main thread everything needed for calculating the activity map frames' colors, and returns
+    # a function t -> {hemi: frame colors}. Returns None if the map isn't saved as activity cubes.
+    cm = _addon().get_cm()
+    if cm is None or map_type not in ['MEG', 'FMRI_DYNAMICS']:
+        return None
+    user_fol = mu.get_user_fol()
+    if map_type == 'MEG':
+        if threshold is None:
+            threshold = bpy.context.scene.coloring_lower_threshold
+        activity_type = bpy.context.scene.meg_files
+        activity_type = '' if activity_type == 'conditions diff' else '{}_'.format(activity_type)
+        fol_template = op.join(user_fol, 'activity_map_{}{}'.format(activity_type, '{hemi}'))
+        if ColoringMakerPanel.meg_activity_data_minmax is None:
+            return None
+        colors_ratio = ColoringMakerPanel.meg_activity_colors_ratio
+        data_min, data_max = ColoringMakerPanel.meg_activity_data_minmax
     else:
-        verts_lookup_loop_coloring(
-            valid_verts, lookup, vcol_layer, lambda vert:vert_values[vert, 1:], cur_obj.name, save_prev_colors)
+        if threshold is None:
+            threshold = bpy.context.scene.meg_threshold
+        fol_template = op.join(user_fol, 'fmri', 'activity_map_{hemi}')
+        if ColoringMakerPanel.fmri_activity_data_minmax is None:
+            return None
+        colors_ratio = ColoringMakerPanel.fmri_activity_colors_ratio
+        data_min, data_max = ColoringMakerPanel.fmri_activity_data_minmax
+    if _addon().colorbar_values_are_locked():
+        data_max, data_min = _addon().get_colorbar_max_min()
+        colors_ratio = 256 / (data_max - data_min)
+    if threshold > data_max:
+        threshold = data_min
+    use_abs = bpy.context.scene.coloring_use_abs
+    hemis_cubes = {}
+    for hemi in [hemi for hemi in HEMIS if not mu.get_hemi_obj(hemi).hide]:
+        hemis_cubes[hemi], _ = mu.load_activity_cube(fol_template.format(hemi=hemi))
+        if hemis_cubes[hemi] is None or ColoringMakerPanel.faces_verts.get(hemi) is None:
+            return None
+    faces_verts = {hemi: ColoringMakerPanel.faces_verts[hemi] for hemi in hemis_cubes.keys()}
+
+    def calc_frame(t):
+        if any([not 0 <= t < cube.shape[1] for cube in hemis_cubes.values()]):
+            return None
+        return {hemi: calc_activity_frame_colors(
+            cube[:, t], faces_verts[hemi], threshold, data_min, colors_ratio, cm, use_abs)
+            for hemi, cube in hemis_cubes.items()}
+
+    return calc_frame
+
+
+def plot_activity_frame_colors(map_type, frame_colors, override_current_mat=True):
+    # Applies the colors calculated by get_activity_map_frames_calculator
+    if map_type == 'MEG':
+        ColoringMakerPanel.what_is_colored.add(WIC_MEG)
+    elif map_type == 'FMRI_DYNAMICS':
+        ColoringMakerPanel.what_is_colored.add(WIC_FMRI_DYNAMICS)
+    _addon().show_activity()
+    for hemi, hemi_frame_colors in frame_colors.items():
+        cur_obj = mu.get_hemi_obj(hemi)
+        set_activity_values(cur_obj, hemi_frame_colors['values'])
+        vcol_layer = prepare_coloring_layer(cur_obj, override_current_mat)
+        layer_colors = get_vcol_layer_colors(vcol_layer)
+        layer_colors[hemi_frame_colors['loops'], :3] = hemi_frame_colors['loops_colors']
+        set_vcol_layer_colors(vcol_layer, layer_colors)
+    return True
+
+
+def lookup_loops(lookup, verts):
+    # Returns the loops indices of the verts, and for each loop the index of its vertex in verts
+    if isinstance(lookup, mu.FacesVertsLookup):
+        return lookup.verts_loops(verts)
+    # Legacy dense lookup, padded with -1
+    x = lookup[verts]
+    loops_mask = x > -1
+    return x[loops_mask].astype(np.int64), np.nonzero(loops_mask)[0]
 
 
-def verts_lookup_loop_coloring(valid_verts, lookup, vcol_layer, colors_func, cur_obj_name, save_prev_colors=False):
+def get_vcol_layer_colors(vcol_layer):
+    colors_num = len(vcol_layer.data[0].color) if len(vcol_layer.data) > 0 else 3
+    colors = np.empty(len(vcol_layer.data) * colors_num, dtype=np.float32)
+    vcol_layer.data.foreach_get('color', colors)
+    return colors.reshape((-1, colors_num))
+
+
+def set_vcol_layer_colors(vcol_layer, colors):
+    vcol_layer.data.foreach_set('color', np.ascontiguousarray(colors, dtype=np.float32).ravel())
+
+
+def verts_lookup_loop_coloring(valid_verts, lookup, vcol_layer, verts_colors, cur_obj_name, save_prev_colors=False):
+    # verts_colors is indexed by the vertices indices. All the layer's loops colors are read and written at once
+    valid_verts = np.asarray(valid_verts, dtype=np.int64)
+    loops, loops_verts = lookup_loops(lookup, valid_verts)
+    layer_colors = get_vcol_layer_colors(vcol_layer)
     if save_prev_colors:
-        ColoringMakerPanel.prev_colors[cur_obj_name]['colors'] = defaultdict(dict)
-    for vert in valid_verts:
-        x = lookup[vert]
-        for loop_ind in x[x > -1]:
-            d = vcol_layer.data[loop_ind]
-            if save_prev_colors:
-                ColoringMakerPanel.prev_colors[cur_obj_name]['colors'][vert][loop_ind] = d.color.copy()
-            d.color = colors_func(vert)
+        saved_loops = np.zeros(len(layer_colors), dtype=bool)
+        saved_loops[loops] = True
+        ColoringMakerPanel.prev_colors[cur_obj_name]['colors'] = layer_colors.copy()
+        ColoringMakerPanel.prev_colors[cur_obj_name]['saved_loops'] = saved_loops
+    layer_colors[loops, :3] = np.asarray(verts_colors)[valid_verts[loops_verts], :3]
+    set_vcol_layer_colors(vcol_layer, layer_colors)
 
 
 def recreate_coloring_layers(mesh, coloring_layer='Col'):
@@ -1139,20 +1234,25 @@ def color_prev_colors(verts, obj_name, coloring_layer='Col'):
         mesh.vertex_colors.active_index = mesh.vertex_colors.keys().index(coloring_layer)
         mesh.vertex_colors[coloring_layer].active_render = True
     vcol_layer = mesh.vertex_colors[coloring_layer]
-    for vert in verts:
-        x = lookup[vert]
-        for loop_ind in x[x > -1]:
-            d = vcol_layer.data[loop_ind]
-            if vert in ColoringMakerPanel.prev_colors[obj_name]['colors']:
-                prev_color = ColoringMakerPanel.prev_colors[obj_name]['colors'][vert][loop_ind]
-                if d.color != prev_color:
-                    d.color = prev_color
-            else:
-                if ColoringMakerPanel.curvs is not None:
-                    default_color = [1, 1, 1] if ColoringMakerPanel.curvs[hemi][vert] == 0 else [0.55, 0.55, 0.55]
-                else:
-                    default_color = [1, 1, 1]
-                d.color = default_color
+    verts = np.asarray(verts, dtype=np.int64)
+    loops, loops_verts = lookup_loops(lookup, verts)
+    layer_colors = get_vcol_layer_colors(vcol_layer)
+    prev_colors = ColoringMakerPanel.prev_colors[obj_name].get('colors')
+    saved_loops = ColoringMakerPanel.prev_colors[obj_name].get('saved_loops')
+    if prev_colors is not None and saved_loops is not None:
+        saved = saved_loops[loops]
+        layer_colors[loops[saved]] = prev_colors[loops[saved]]
+    else:
+        saved = np.zeros(len(loops), dtype=bool)
+    # The loops that weren't colored get the default (curvature) color
+    default_loops, default_verts = loops[~saved], verts[loops_verts[~saved]]
+    curvs = ColoringMakerPanel.curvs.get(hemi) if ColoringMakerPanel.curvs is not None else None
+    if curvs is not None:
+        layer_colors[default_loops, :3] = np.where(
+            (curvs[default_verts] == 0)[:, np.newaxis], [1, 1, 1], [0.55, 0.55, 0.55])
+    else:
+        layer_colors[default_loops, :3] = [1, 1, 1]
+    set_vcol_layer_colors(vcol_layer, layer_colors)
     return True
 
 
@@ -1382,8 +1482,8 @@ def color_subcortical_region(region_name, color, use_abs=None):
     #todo: read the ColoringPanel.subs_verts_faces like in fmri labels coloring
     cur_obj = bpy.data.objects.get(region_name + '_fmri_activity', None)
     obj_ana_fname = op.join(mu.get_user_fol(), 'subcortical', '{}.npz'.format(region_name))
-    obj_lookup_fname = op.join(mu.get_user_fol(), 'subcortical', '{}_faces_verts.npy'.format(region_name))
-    if not cur_obj is None and op.isfile(obj_lookup_fname):
+    obj_lookup_fname = op.join(mu.get_user_fol(), 'subcortical', '{}_faces_verts.npz'.format(region_name))
+    if not cur_obj is None and mu.faces_verts_lookup_exists(obj_lookup_fname):
         # todo: read only the verts number
         if not op.isfile(obj_ana_fname):
             verts, faces = mu.read_ply_file(op.join(mu.get_user_fol(), 'subcortical', '{}.ply'.format(region_name)))
@@ -1391,7 +1491,7 @@ def color_subcortical_region(region_name, color, use_abs=None):
         else:
             d = np.load(obj_ana_fname)
             verts =  d['verts']
-        lookup = np.load(obj_lookup_fname)
+        lookup = mu.load_faces_verts_lookup(obj_lookup_fname)
         region_colors_data = np.hstack((np.array([1.]), color))
         region_colors_data = np.tile(region_colors_data, (len(verts), 1))
         activity_map_obj_coloring(cur_obj, region_colors_data, lookup, 0, True, use_abs=use_abs)
@@ -1431,15 +1531,14 @@ def _meg_files_update(context):
     user_fol = mu.get_user_fol()
     ColoringMakerPanel.activity_map_chosen = False
     ColoringMakerPanel.stc_file_chosen = False
-    activity_types = [mu.namebase(f)[len('activity_map_'):-2] for f in glob.glob(op.join(user_fol, 'activity_map_*rh'))]
+    activity_types = get_meg_activity_types(user_fol)
     for activity_type in activity_types:
         if activity_type != '':
             activity_type = activity_types[:-1]
         if bpy.context.scene.meg_files == activity_type or activity_type == '' and \
                         bpy.context.scene.meg_files == 'conditions diff':
             ColoringMakerPanel.activity_map_chosen = True
-            meg_data_maxmin_fname = op.join(mu.get_user_fol(), 'meg_activity_map_{}minmax.pkl'.format(activity_type))
-            data_min, data_max = mu.load(meg_data_maxmin_fname)
+            data_min, data_max = load_meg_activity_map_minmax(activity_type)
             ColoringMakerPanel.meg_activity_colors_ratio = 256 / (data_max - data_min)
             ColoringMakerPanel.meg_activity_data_minmax = (data_min, data_max)
             if not _addon().colorbar_values_are_locked():
@@ -2131,7 +2230,8 @@ def draw(self, context):
     layout = self.layout
     user_fol = mu.get_user_fol()
     atlas = bpy.context.scene.atlas
-    faces_verts_exist = mu.hemi_files_exists(op.join(user_fol, 'faces_verts_{hemi}.npy'))
+    faces_verts_exist = all([mu.faces_verts_lookup_exists(op.join(user_fol, 'faces_verts_{}.npy'.format(hemi)))
+                             for hemi in mu.HEMIS])
     fmri_files = glob.glob(op.join(user_fol, 'fmri', 'fmri_*lh*.npy'))  # mu.hemi_files_exists(op.join(user_fol, 'fmri_{hemi}.npy'))
     # fmri_clusters_files_exist = mu.hemi_files_exists(op.join(user_fol, 'fmri', 'fmri_clusters_{hemi}.npy'))
     # meg_ext_meth = bpy.context.scene.meg_labels_extract_method
@@ -2155,8 +2255,8 @@ def draw(self, context):
     layout.prop(context.scene, 'color_rois_homogeneously', text="Color ROIs homogeneously")
 
     if faces_verts_exist:
-        meg_current_activity_data_exist = mu.hemi_files_exists(
-            op.join(user_fol, 'activity_map_{hemi}', 't{}.npy'.format(bpy.context.scene.frame_current)))
+        meg_current_activity_data_exist = mu.hemi_activity_maps_exist(
+            op.join(user_fol, 'activity_map_{hemi}'), bpy.context.scene.frame_current)
         if ColoringMakerPanel.meg_activity_data_exist and meg_current_activity_data_exist or \
                 ColoringMakerPanel.stc_file_exist:
             col = layout.box().column()
@@ -2420,18 +2520,34 @@ def init_labels_vertices():
             ColoringMakerPanel.labels_vertices[atlas] = dict(labels_names=labels_names, labels_vertices=labels_vertices)
 
 
+def get_meg_activity_types(user_fol):
+    # Both the activity cubes (activity_map_*rh.npy) and the legacy folders of frames (activity_map_*rh)
+    activity_fnames = glob.glob(op.join(user_fol, 'activity_map_*rh')) + \
+                      glob.glob(op.join(user_fol, 'activity_map_*rh.npy'))
+    return sorted(set([mu.namebase(f)[len('activity_map_'):-2] for f in activity_fnames]))
+
+
+def load_meg_activity_map_minmax(activity_type):
+    meg_data_maxmin_fname = op.join(mu.get_user_fol(), 'meg_activity_map_{}minmax.pkl'.format(activity_type))
+    if op.isfile(meg_data_maxmin_fname):
+        return mu.load(meg_data_maxmin_fname)
+    _, header = mu.load_activity_cube(op.join(mu.get_user_fol(), 'activity_map_{}rh'.format(activity_type)))
+    if header is not None and header.get('data_min') is not None:
+        return header['data_min'], header['data_max']
+    return None, None
+
+
 def init_meg_activity_map():
     user_fol = mu.get_user_fol()
     list_items = []
-    activity_types = [mu.namebase(f)[len('activity_map_'):-2] for f in glob.glob(op.join(user_fol, 'activity_map_*rh'))]
+    activity_types = get_meg_activity_types(user_fol)
     for activity_type in activity_types:
         if activity_type != '':
             activity_type = activity_type[:-1]
-        meg_files_exist = len(glob.glob(op.join(user_fol, 'activity_map_{}rh'.format(activity_type), 't*.npy'))) > 0 and \
-                          len(glob.glob(op.join(user_fol, 'activity_map_{}lh'.format(activity_type), 't*.npy'))) > 0
-        meg_data_maxmin_fname = op.join(mu.get_user_fol(), 'meg_activity_map_{}minmax.pkl'.format(activity_type))
-        if meg_files_exist and op.isfile(meg_data_maxmin_fname):
-            data_min, data_max = mu.load(meg_data_maxmin_fname)
+        meg_files_exist = mu.hemi_activity_maps_exist(
+            op.join(user_fol, 'activity_map_{}{}'.format(activity_type, '{hemi}')))
+        data_min, data_max = load_meg_activity_map_minmax(activity_type)
+        if meg_files_exist and data_min is not None:
             ColoringMakerPanel.meg_activity_colors_ratio = 256 / (data_max - data_min)
             ColoringMakerPanel.meg_activity_data_minmax = (data_min, data_max)
             print('data meg: {}-{}'.format(data_min, data_max))
@@ -2477,7 +2593,7 @@ def create_stc_files_list(list_items=[]):
 
 def init_fmri_activity_map():
     user_fol = mu.get_user_fol()
-    fmri_files_exist = mu.hemi_files_exists(op.join(user_fol, 'fmri', 'activity_map_{hemi}', 't0.npy'))
+    fmri_files_exist = mu.hemi_activity_maps_exist(op.join(user_fol, 'fmri', 'activity_map_{hemi}'), 0)
     fmri_data_maxmin_fname = op.join(user_fol, 'fmri', 'activity_map_minmax.npy')
     if fmri_files_exist and op.isfile(fmri_data_maxmin_fname):
         ColoringMakerPanel.fmri_activity_map_exist = True
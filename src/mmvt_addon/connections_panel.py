@@ -16,6 +16,11 @@ import glob
 # PARENT_OBJ = 'connections'
 HEMIS_WITHIN, HEMIS_BETWEEN = range(2)
 STAT_AVG, STAT_DIFF = range(2)
+# The number of sides of each edge's tube in the single mesh mode (like a bezier curve with bevel_resolution=0)
+EDGE_SIDES = 4
+EDGE_LOOPS_NUM = EDGE_SIDES * 4
+# The width of the weakest edge, relative to connections_width
+MIN_EDGE_WIDTH_SCALE = 0.25
 
 
 def _addon():
@@ -76,7 +81,7 @@ def check_connections(stat=STAT_DIFF):
     indices = np.where(mask)[0]
     parent_obj = bpy.data.objects.get(get_connections_parent_name(), None)
     if parent_obj and len(parent_obj.children) > 0:
-        bpy.context.scene.connections_num = min(len(parent_obj.children) - 1, len(indices))
+        bpy.context.scene.connections_num = min(get_created_connections_num(parent_obj), len(indices))
     else:
         bpy.context.scene.connections_num = len(indices)
     parent_obj = bpy.data.objects.get(get_connections_parent_name(), None)
@@ -121,7 +126,10 @@ def create_keyframes(d, threshold, threshold_type, radius=.1, stat=STAT_DIFF, ve
     N = len(indices)
     print('{} connections are above the threshold'.format(N))
     create_vertices(d, mask, verts_color)
-    create_conncection_per_condition(d, layers_rods, indices, mask, windows_num, norm_fac, T, radius)
+    if bpy.context.scene.connections_single_mesh:
+        create_connections_mesh(d, layers_rods, indices)
+    else:
+        create_conncection_per_condition(d, layers_rods, indices, mask, windows_num, norm_fac, T, radius)
     print('Create connections for the conditions {}'.format('difference' if stat == STAT_DIFF else 'mean'))
     create_keyframes_for_parent_obj(d, indices, mask, windows_num, norm_fac, T, stat)
     print('finish keyframing!')
@@ -185,6 +193,156 @@ def create_conncection_per_condition(d, layers_rods, indices, mask, windows_num,
     mu.change_fcurves_colors(parent_obj.children)
 
 
+def get_connections_mesh_name():
+    return '{}_mesh'.format(get_connections_parent_name())
+
+
+def get_connections_mesh_obj():
+    mesh_obj = bpy.data.objects.get(get_connections_mesh_name())
+    if mesh_obj is None or ConnectionsPanel.d is None or 'con_indices' not in mesh_obj:
+        return None
+    if ConnectionsPanel.mesh is None or ConnectionsPanel.mesh.name != mesh_obj.name:
+        # After loading a blend file, or changing the connectivity file
+        init_connections_mesh_data(mesh_obj.name, np.array(mesh_obj['con_indices'][:], dtype=np.int64))
+    return mesh_obj
+
+
+def init_connections_mesh_data(mesh_name, indices):
+    # The state of the single mesh edges: edge k is the connection indices[k]
+    d = ConnectionsPanel.d
+    lookup = np.ones(len(d.con_names), dtype=np.int64) * -1
+    lookup[indices] = np.arange(len(indices))
+    ConnectionsPanel.mesh = mu.Bag(
+        name=mesh_name, indices=indices, lookup=lookup, visible=np.ones(len(indices), dtype=bool),
+        colors=np.ones((len(indices), 3), dtype=np.float32), widths_scales=np.ones(len(indices)),
+        locations=np.array(d.locations) * 0.1)
+    return ConnectionsPanel.mesh
+
+
+def get_created_connections_num(parent_obj):
+    if get_connections_mesh_obj() is not None:
+        return len(ConnectionsPanel.mesh.indices)
+    # All the parent's children are connections, except for the vertices parent
+    return len(parent_obj.children) - 1
+
+
+def calc_edges_tubes_faces(edges_num, sides=EDGE_SIDES):
+    # Each edge is a tube of sides quads between its two rings of sides vertices
+    ring = np.arange(sides)
+    edge_faces = np.column_stack((ring, (ring + 1) % sides, (ring + 1) % sides + sides, ring + sides))
+    edges_offsets = np.arange(edges_num)[:, np.newaxis, np.newaxis] * sides * 2
+    return (edge_faces[np.newaxis] + edges_offsets).reshape((-1, 4))
+
+
+def calc_edges_tubes_verts(p1, p2, widths, sides=EDGE_SIDES):
+    # Returns the (edges_num * sides * 2, 3) tubes vertices. Zero width edges collapse to lines, which aren't rendered
+    directions = np.array(p2 - p1, dtype=np.float64)
+    norms = np.linalg.norm(directions, axis=1)
+    directions /= np.where(norms == 0, 1, norms)[:, np.newaxis]
+    # A perpendicular to each edge, crossing it with the axis it's least aligned with
+    axes = np.eye(3)[np.argmin(np.abs(directions), axis=1)]
+    u = np.cross(directions, axes)
+    u_norms = np.linalg.norm(u, axis=1)
+    u /= np.where(u_norms == 0, 1, u_norms)[:, np.newaxis]
+    v = np.cross(directions, u)
+    angles = np.linspace(0, 2 * np.pi, sides, endpoint=False)
+    rings = np.cos(angles)[np.newaxis, :, np.newaxis] * u[:, np.newaxis, :] + \
+            np.sin(angles)[np.newaxis, :, np.newaxis] * v[:, np.newaxis, :]
+    rings *= np.asarray(widths, dtype=np.float64).reshape((-1, 1, 1))
+    verts = np.concatenate((p1[:, np.newaxis, :] + rings, p2[:, np.newaxis, :] + rings), axis=1)
+    return verts.reshape((-1, 3))
+
+
+def calc_connections_mesh_verts(mesh_data):
+    con_indices = ConnectionsPanel.d.con_indices[mesh_data.indices]
+    p1, p2 = mesh_data.locations[con_indices[:, 0]], mesh_data.locations[con_indices[:, 1]]
+    widths = np.where(mesh_data.visible, bpy.context.scene.connections_width * mesh_data.widths_scales, 0)
+    return calc_edges_tubes_verts(p1, p2, widths)
+
+
+def create_connections_mesh(d, layers_rods, indices):
+    # Creates all the connections as one mesh, where each edge is a tube. The edges colors are set in the 'Col'
+    # vertex colors layer, and the filtered edges are collapsed, so there is no object per connection
+    parent_obj = bpy.data.objects[get_connections_parent_name()]
+    mesh_name = get_connections_mesh_name()
+    print('Create {} connections as one mesh'.format(len(indices)))
+    mesh_data = init_connections_mesh_data(mesh_name, np.array(indices, dtype=np.int64))
+    verts = calc_connections_mesh_verts(mesh_data)
+    faces = calc_edges_tubes_faces(len(indices))
+    mesh = bpy.data.meshes.new(mesh_name)
+    mesh.vertices.add(len(verts))
+    mesh.vertices.foreach_set('co', verts.ravel())
+    mesh.loops.add(faces.size)
+    mesh.loops.foreach_set('vertex_index', faces.ravel())
+    mesh.polygons.add(len(faces))
+    mesh.polygons.foreach_set('loop_start', np.arange(0, faces.size, 4))
+    mesh.polygons.foreach_set('loop_total', [4] * len(faces))
+    mesh.polygons.foreach_set('use_smooth', [True] * len(faces))
+    mesh.update(calc_edges=True)
+    mesh.vertex_colors.new('Col')
+    cur_obj = bpy.data.objects.new(mesh_name, mesh)
+    bpy.context.scene.objects.link(cur_obj)
+    cur_obj.layers = layers_rods
+    cur_obj.parent = parent_obj
+    cur_obj['con_indices'] = mesh_data.indices.tolist()
+    mat_name = '{}_mat'.format(mesh_name)
+    if bpy.data.materials.get(mat_name) is None:
+        cur_mat = bpy.data.materials['Activity_map_mat'].copy()
+        cur_mat.name = mat_name
+    cur_obj.active_material = bpy.data.materials[mat_name]
+    update_connections_mesh(colors=mesh_data.colors)
+
+
+def update_connections_mesh(colors=None, visible=None, update_verts=False):
+    # colors (edges_num, 3) are written to the mesh's vertex colors layer with one foreach_set. The vertices are
+    # recalculated only when the edges visibility, width or locations are changed
+    mesh_obj = get_connections_mesh_obj()
+    if mesh_obj is None:
+        return
+    mesh_data, mesh = ConnectionsPanel.mesh, mesh_obj.data
+    if visible is not None:
+        mesh_data.visible = np.asarray(visible, dtype=bool)
+    if visible is not None or update_verts:
+        mesh.vertices.foreach_set('co', calc_connections_mesh_verts(mesh_data).ravel())
+    if colors is not None:
+        mesh_data.colors = np.asarray(colors, dtype=np.float32)[:, :3]
+        vcol_layer = mesh.vertex_colors['Col']
+        layer_colors = _addon().coloring.get_vcol_layer_colors(vcol_layer)
+        layer_colors[:, :3] = np.repeat(mesh_data.colors, EDGE_LOOPS_NUM, axis=0)
+        _addon().coloring.set_vcol_layer_colors(vcol_layer, layer_colors)
+    mesh.update()
+
+
+def plot_connections_mesh(selected_indices, colors, stat_vals, threshold, data_abs_max):
+    # Each edge's color and width are set by its value: the width goes from MIN_EDGE_WIDTH_SCALE to 1 times
+    # connections_width, relative to the colorbar's abs max
+    mesh_data = ConnectionsPanel.mesh
+    edges = mesh_data.lookup[np.array(selected_indices, dtype=np.int64)]
+    valid = edges > -1
+    edges_colors = mesh_data.colors.copy()
+    edges_colors[edges[valid]] = np.asarray(colors).reshape((len(edges), -1))[valid, :3]
+    abs_vals = np.abs(np.array(stat_vals, dtype=np.float64).reshape(len(edges)))
+    if data_abs_max > 0:
+        mesh_data.widths_scales[edges[valid]] = MIN_EDGE_WIDTH_SCALE + (1 - MIN_EDGE_WIDTH_SCALE) * \
+            np.clip(abs_vals[valid] / data_abs_max, 0, 1)
+    visible = None
+    if bpy.context.scene.hide_connection_under_threshold:
+        visible = mesh_data.visible.copy()
+        visible[edges[valid & (abs_vals < threshold)]] = False
+    update_connections_mesh(colors=edges_colors, visible=visible, update_verts=True)
+
+
+def get_shown_connections_names(d):
+    if get_connections_mesh_obj() is not None:
+        return d.con_names[ConnectionsPanel.mesh.indices[ConnectionsPanel.mesh.visible]].tolist()
+    shown_names = []
+    for con_name in d.con_names:
+        cur_obj = bpy.data.objects.get(con_name)
+        if cur_obj and not cur_obj.hide:
+            shown_names.append(con_name)
+    return shown_names
+
+
 def create_vertices(d, mask, verts_color='green'):
     layers = [False] * 20
     layers[_addon().CONNECTIONS_LAYER] = True
@@ -223,6 +381,9 @@ def connections_width_update(self, context):
     connection_parent = get_connection_parent()
     if connection_parent is None:
         return
+    if get_connections_mesh_obj() is not None:
+        update_connections_mesh(update_verts=True)
+        return
     for c in connection_parent.children:
         if c.data is None:
             continue
@@ -272,6 +433,10 @@ def update_vertices_location():
             continue
         node_obj.location = new_location
         existing_nodes.append(label_name)
+    if get_connections_mesh_obj() is not None:
+        ConnectionsPanel.mesh.locations = np.array(new_locations)
+        update_connections_mesh(update_verts=True)
+        return
     for node1_name in existing_nodes:
         for node2_name in existing_nodes:
             con_obj = bpy.data.objects.get('{}-{}'.format(node1_name, node2_name))
@@ -313,16 +478,14 @@ def create_keyframes_for_parent_obj(d, indices, mask, windows_num, norm_fac, T,
     stat_data = calc_stat_data(d.con_values, stat)
     N = len(indices)
     now = time.time()
+    extra_time_points = 0 if norm_fac == 1 else 2
+    timepoints = np.arange(windows_num) * norm_fac + extra_time_points
     for run, (ind, conn_name) in enumerate(zip(indices, d.con_names[mask])):
         mu.time_to_go(now, run, N, runs_num_to_print=100)
         # insert_frame_keyframes(parent_obj, conn_name, stat_data[ind, -1], T)
-        for t in range(windows_num):
-            extra_time_points = 0 if norm_fac ==1 else 2
-            timepoint = t * norm_fac + extra_time_points
-            mu.insert_keyframe_to_custom_prop(parent_obj, conn_name, stat_data[ind, t], timepoint)
-        fcurve = parent_obj.animation_data.action.fcurves[run]
-        fcurve.keyframe_points[0].co[1] = 0
-        fcurve.keyframe_points[-1].co[1] = 0
+        values = np.array(stat_data[ind, :windows_num], dtype=np.float32)
+        values[0] = values[-1] = 0
+        mu.insert_keyframes_to_custom_prop(parent_obj, conn_name, values, zeros_frames=(), frames=timepoints)
 
     finalize_fcurves(parent_obj)
     finalize_objects_creations()
@@ -382,20 +545,30 @@ def filter_graph(context, d, condition, threshold, threshold_type, connections_t
     mu.show_hide_hierarchy(False, parent_obj_name)
     masked_con_names = calc_masked_con_names(d, threshold, threshold_type, connections_type, condition, stat)
     parent_obj = bpy.data.objects[parent_obj_name]
-    bpy.context.scene.connections_num = min(len(masked_con_names), len(parent_obj.children) - 1)
+    bpy.context.scene.connections_num = min(len(masked_con_names), get_created_connections_num(parent_obj))
     conn_show = 0
     selected_objects, selected_indices = [], []
-    for con_ind, con_name in enumerate(d.con_names):
-        cur_obj = bpy.data.objects.get(con_name)
-        if cur_obj:
-            if con_name in masked_con_names:
-                selected_objects.append(cur_obj)
-                selected_indices.append(con_ind)
-                conn_show += 1
-            cur_obj.hide = con_name not in masked_con_names
-            cur_obj.hide_render = con_name not in masked_con_names
-            if bpy.context.scene.selection_type == 'conds':
-                cur_obj.select = not cur_obj.hide
+    mesh_obj = get_connections_mesh_obj()
+    if mesh_obj is not None:
+        mesh_indices = ConnectionsPanel.mesh.indices
+        visible = np.in1d(d.con_names[mesh_indices], list(masked_con_names))
+        update_connections_mesh(visible=visible)
+        mesh_obj.hide = mesh_obj.hide_render = False
+        selected_indices = mesh_indices[visible].tolist()
+        selected_objects = d.con_names[selected_indices].tolist()
+        conn_show = len(selected_indices)
+    else:
+        for con_ind, con_name in enumerate(d.con_names):
+            cur_obj = bpy.data.objects.get(con_name)
+            if cur_obj:
+                if con_name in masked_con_names:
+                    selected_objects.append(cur_obj)
+                    selected_indices.append(con_ind)
+                    conn_show += 1
+                cur_obj.hide = con_name not in masked_con_names
+                cur_obj.hide_render = con_name not in masked_con_names
+                if bpy.context.scene.selection_type == 'conds':
+                    cur_obj.select = not cur_obj.hide
     ConnectionsPanel.selected_objects = selected_objects
     ConnectionsPanel.selected_indices = selected_indices
     print('Showing {} connections after filtering'.format(conn_show))
@@ -496,16 +669,19 @@ def plot_connections(d=None, plot_time=None, threshold=None, calc_t=True, data_m
         _addon().show_hide_connections()
         if threshold is None:
             threshold = bpy.context.scene.coloring_lower_threshold
-        for ind, (cur_obj, obj_color) in enumerate(zip(selected_objects, colors)):
-            if isinstance(cur_obj, str):
-                cur_obj = bpy.data.objects.get(cur_obj)
-            if bpy.context.scene.hide_connection_under_threshold:
-                if abs(stat_vals[ind]) < threshold:
-                    cur_obj.hide = True
-                    cur_obj.hide_render = True
-            bpy.context.scene.objects.active = cur_obj
-            _addon().coloring.object_coloring(cur_obj, colors[ind])
-            # mu.create_material('{}_mat'.format(cur_obj.name), colors[ind], 1, False)
+        if get_connections_mesh_obj() is not None:
+            plot_connections_mesh(selected_indices, colors, stat_vals, threshold, max(abs(data_min), abs(data_max)))
+        else:
+            for ind, (cur_obj, obj_color) in enumerate(zip(selected_objects, colors)):
+                if isinstance(cur_obj, str):
+                    cur_obj = bpy.data.objects.get(cur_obj)
+                if bpy.context.scene.hide_connection_under_threshold:
+                    if abs(stat_vals[ind]) < threshold:
+                        cur_obj.hide = True
+                        cur_obj.hide_render = True
+                bpy.context.scene.objects.active = cur_obj
+                _addon().coloring.object_coloring(cur_obj, colors[ind])
+                # mu.create_material('{}_mat'.format(cur_obj.name), colors[ind], 1, False)
         if bpy.context.scene.hide_connection_under_threshold:
             filter_nodes()
         parent_obj_name = get_connections_parent_name()
@@ -534,7 +710,11 @@ def get_all_selected_connections(d):
     # con_objs_names = [obj.name for obj in bpy.data.objects[get_connections_parent_name()].children if obj.name != 'connections_vertices']
     # all_con_set = set(d.con_names.tolist())
     # indices = [np.where(d.con_names == obj_name)[0][0] for obj_name in con_objs_names]
-    if bpy.context.scene.selection_type == 'conds' or parent_obj.animation_data is None:
+    if get_connections_mesh_obj() is not None and (
+            bpy.context.scene.selection_type == 'conds' or parent_obj.animation_data is None):
+        inds = ConnectionsPanel.mesh.indices[ConnectionsPanel.mesh.visible].tolist()
+        objs = d.con_names[inds].tolist()
+    elif bpy.context.scene.selection_type == 'conds' or parent_obj.animation_data is None:
         for ind, con_name in enumerate(d.con_names):
             cur_obj = bpy.data.objects.get(con_name)
             if cur_obj and not cur_obj.hide:
@@ -583,14 +763,22 @@ def filter_nodes(do_filter=True, connectivity_file=''):
     if vertices_obj is None:
         print('connections_vertices is None!')
         return
+    mesh_obj = get_connections_mesh_obj()
+    if mesh_obj is not None:
+        d = ConnectionsPanel.d
+        shown_indices = ConnectionsPanel.mesh.indices[ConnectionsPanel.mesh.visible]
+        connected_labels = set(np.array(d.labels)[np.unique(d.con_indices[shown_indices])])
     for node in bpy.data.objects.get('connections_vertices').children:
         if do_filter:
             conn_found = False
             label_name = node.name[:-len('_vertice')]
-            for conn in bpy.data.objects[parent].children:
-                if label_name in conn.name and not conn.hide:
-                    conn_found = True
-                    break
+            if mesh_obj is not None:
+                conn_found = label_name in connected_labels
+            else:
+                for conn in bpy.data.objects[parent].children:
+                    if label_name in conn.name and not conn.hide:
+                        conn_found = True
+                        break
             if not conn_found:
                 node.hide = True
                 node.hide_render = True
@@ -619,10 +807,7 @@ def filter_electrodes_via_connections(context, do_filter):
 
     if do_filter:
         selected_electrodes = set()
-        for ind, con_name in enumerate(ConnectionsPanel.d.con_names):
-            cur_obj = bpy.data.objects.get(con_name)
-            if not cur_obj or cur_obj.hide:
-                continue
+        for con_name in get_shown_connections_names(ConnectionsPanel.d):
             electrodes = con_name.split('-')
             for elc in electrodes:
                 cur_elc = bpy.data.objects.get(elc)
@@ -912,6 +1097,7 @@ def connections_draw(self, context):
     layout.operator(CheckConnections.bl_idname, text="Check connections ", icon='RNA_ADD')
     layout.label(text='# Connections: {}'.format(bpy.context.scene.connections_num))
     layout.label(text='{:.2f} < values < {:.2f}'.format(bpy.context.scene.connections_min, bpy.context.scene.connections_max))
+    layout.prop(context.scene, 'connections_single_mesh', text='Create as one mesh')
     layout.operator(CreateConnections.bl_idname, text="Create connections ", icon='RNA_ADD')
     layout.prop(context.scene, 'connections_threshold', text="Threshold")
     layout.prop(context.scene, 'above_below_threshold', text='')
@@ -966,6 +1152,8 @@ bpy.types.Scene.connections_show_vertices = bpy.props.BoolProperty(
     default=True, description='Show/hide nodes', update=connections_show_vertices_update)
 bpy.types.Scene.connections_width = bpy.props.FloatProperty(
     default=0, min=0, max=0.2, update=connections_width_update, description='Connections depth')
+bpy.types.Scene.connections_single_mesh = bpy.props.BoolProperty(
+    default=False, description='Creates all the connections as one mesh, colored by its vertex colors layer')
 
 
 class ConnectionsPanel(bpy.types.Panel):
@@ -983,6 +1171,7 @@ class ConnectionsPanel(bpy.types.Panel):
     conn_names = []
     selected_indices = []
     mask = None
+    mesh = None
 
     def draw(self, context):
         connections_draw(self, context)
@@ -745,23 +745,15 @@ def add_data_to_brain(source_files):
                 print('keyframing {}'.format(obj_name))
                 for cond_ind, cond_str in enumerate(f['conditions']):
                     cond_str = cond_str.astype(str)
-                    # Set the values to zeros in the first and last frame for current object(current label)
-                    mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, 1)
-                    mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, len(f['data'][0]) + 2)
-    
-                    # For every time point insert keyframe to current object
-                    for ind, t in enumerate(data[:, cond_ind]):
-                        mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, t, ind + 2)
-    
+                    # Set the values to zeros in the first and last frame for current object(current label),
+                    # and insert keyframes for every time point
+                    fcurves = mu.insert_keyframes_to_custom_prop(
+                        cur_obj, obj_name + '_' + cond_str, data[:, cond_ind], zeros_frames=(1, len(f['data'][0]) + 2))
                     # remove the orange keyframe sign in the fcurves window
-                    fcurves = bpy.data.objects[obj_name].animation_data.action.fcurves[cond_ind]
                     mod = fcurves.modifiers.new(type='LIMITS')
             elif bpy.context.scene.add_meg_labels_data_overwrite:
                 for fcurve_ind, fcurve in enumerate(cur_obj.animation_data.action.fcurves):
-                    fcurve.keyframe_points[0].co[1] = 0
-                    fcurve.keyframe_points[-1].co[1] = 0
-                    for t in range(T):
-                        fcurve.keyframe_points[t + 1].co[1] = data[t, fcurve_ind]
+                    mu.set_fcurve_keyframes_values(fcurve, data[:T, fcurve_ind])
 
         conditions.extend(f['conditions'])
     try:
@@ -896,25 +888,15 @@ def add_data_to_parent_obj(parent_obj, source_files, stat):
         for obj_counter, source_name in enumerate(sources_names):
             mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
             data = sources[source_name]
-            # Set the values to zeros in the first and last frame for Brain object
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, 1)
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, T)
-
-            # For every time point insert keyframe to the main Brain object
-            for ind in range(data.shape[0]):
-                mu.insert_keyframe_to_custom_prop(parent_obj, source_name, data[ind], ind + 2)
-
+            # Set the values to zeros in the first and last frame for Brain object, and insert keyframes for every
+            # time point to the main Brain object
+            fcurves = mu.insert_keyframes_to_custom_prop(parent_obj, source_name, data, zeros_frames=(1, T))
             # remove the orange keyframe sign in the fcurves window
-            fcurves = parent_obj.animation_data.action.fcurves[obj_counter]
             mod = fcurves.modifiers.new(type='LIMITS')
     else:
         for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
             fcurve_name = mu.get_fcurve_name(fcurve)
-            fcurve.keyframe_points[0].co[1] = 0
-            fcurve.keyframe_points[-1].co[1] = 0
-            T = min([len(fcurve.keyframe_points) - 1, len(sources[fcurve_name])])
-            for t in range(T):
-                fcurve.keyframe_points[t + 1].co[1] = sources[fcurve_name][t]
+            mu.set_fcurve_keyframes_values(fcurve, sources[fcurve_name])
 
     if bpy.data.objects.get(' '):
         bpy.context.scene.objects.active = bpy.data.objects[' ']
@@ -1059,25 +1041,18 @@ def add_data_to_electrodes(all_data, meta_data, window_len=None, conditions=None
             cur_obj.animation_data_clear()
             for cond_ind, cond_str in enumerate(conditions):
                 cond_str = cond_str.astype(str) if not isinstance(cond_str, str) else cond_str
-                # Set the values to zeros in the first and last frame for current object(current label)
-                mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, 1)
-                # todo: +2? WTF?!?
-                mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, T + 2)
-
                 print('keyframing ' + obj_name + ' object in condition ' + cond_str)
-                # For every time point insert keyframe to current object
+                # Set the values to zeros in the first and last frame for current object(current label), and insert
+                # keyframes for every time point
+                # todo: +2? WTF?!?
                 data_cond_ind = conditions.index(cond_str) #np.where(conditions == cond_str)[0][0]
-                for ind, t in enumerate(data[:T, data_cond_ind]):
-                    mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + str(cond_str), t, ind + 2)
+                fcurves = mu.insert_keyframes_to_custom_prop(
+                    cur_obj, obj_name + '_' + str(cond_str), data[:T, data_cond_ind], zeros_frames=(1, T + 2))
                 # remove the orange keyframe sign in the fcurves window
-                fcurves = bpy.data.objects[obj_name].animation_data.action.fcurves[cond_ind]
                 mod = fcurves.modifiers.new(type='LIMITS')
         else:
             for fcurve_ind, fcurve in enumerate(cur_obj.animation_data.action.fcurves):
-                fcurve.keyframe_points[0].co[1] = 0
-                fcurve.keyframe_points[-1].co[1] = 0
-                for t in range(T):
-                    fcurve.keyframe_points[t + 1].co[1] = data[t, fcurve_ind]
+                mu.set_fcurve_keyframes_values(fcurve, data[:T, fcurve_ind])
 
     conditions = meta_data['conditions']
     print('Finished keyframing!!')
@@ -1118,13 +1093,7 @@ def add_data_to_electrodes_parent_obj(parent_obj, all_data, meta, stat=STAT_DIFF
         for obj_counter, source_name in enumerate(sources_names):
             mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
             data = sources[source_name]
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, 1)
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, T + 2)
-
-            for ind in range(T):
-                mu.insert_keyframe_to_custom_prop(parent_obj, source_name, data[ind], ind + 2)
-
-            fcurves = parent_obj.animation_data.action.fcurves[obj_counter]
+            fcurves = mu.insert_keyframes_to_custom_prop(parent_obj, source_name, data[:T], zeros_frames=(1, T + 2))
             mod = fcurves.modifiers.new(type='LIMITS')
     else:
         for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
@@ -1132,10 +1101,7 @@ def add_data_to_electrodes_parent_obj(parent_obj, all_data, meta, stat=STAT_DIFF
             if fcurve_name not in sources:
                 print('{} not in sources!'.format(fcurve_name))
                 continue
-            fcurve.keyframe_points[0].co[1] = 0
-            fcurve.keyframe_points[-1].co[1] = 0
-            for t in range(T):
-                fcurve.keyframe_points[t + 1].co[1] = sources[fcurve_name][t]
+            mu.set_fcurve_keyframes_values(fcurve, sources[fcurve_name][:T])
 
     mu.view_all_in_graph_editor()
     print('Finished keyframing {}!!'.format(parent_obj.name))
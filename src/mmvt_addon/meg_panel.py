@@ -278,76 +278,82 @@ def eeg_sensors_files_update(self, context):
 
 # ************** Coloring function
 
-def color_eeg_helmet(use_abs=None):
-    if use_abs is None:
-        use_abs = bpy.context.scene.coloring_use_abs
-    fol = mu.get_user_fol()
-    data, meta = get_eeg_sensors_data()
-    if bpy.context.scene.eeg_sensors_conditions != 'diff':
-        cond_ind = np.where(meta['conditions'] == bpy.context.scene.eeg_sensors_conditions)[0][0]
-        data = data[:, :, cond_ind]
-        if not _addon().colorbar_values_are_locked():
-            _addon().set_colorbar_title('EEG sensors {} condition'.format(meta['conditions'][cond_ind]))
+def get_helmet_session(modality):
+    # The helmet's sensors data (after the condition selection), faces_verts lookup and colorbar limits are
+    # calculated once per selection, so each frame only slices one time point
+    if modality == 'meg':
+        sensors_file, condition = get_meg_sensors_file(), bpy.context.scene.meg_sensors_conditions
+        sensors_types = bpy.context.scene.meg_sensors_types
     else:
-        data = np.diff(data, axis=2).squeeze()
-        if not _addon().colorbar_values_are_locked():
-            _addon().set_colorbar_title('EEG sensors conditions difference')
-    lookup = np.load(op.join(fol, 'eeg', 'eeg_faces_verts.npy'))
-    threshold = 0
-    if _addon().colorbar_values_are_locked():
-        data_max, data_min = _addon().get_colorbar_max_min()
+        sensors_file, condition, sensors_types = get_eeg_sensors_file(), bpy.context.scene.eeg_sensors_conditions, ''
+    key = (mu.get_user_fol(), sensors_file, condition, sensors_types)
+    session = MEGPanel.helmet_sessions.get(modality, None)
+    if session is not None and session.key == key:
+        return session
+
+    data, meta = get_meg_sensors_data() if modality == 'meg' else get_eeg_sensors_data()
+    if modality == 'meg':
+        data = data[MEGPanel.meg_helmet_indices[sensors_types], :, :]
+    if condition != 'diff':
+        cond_ind = np.where(meta['conditions'] == condition)[0][0]
+        data = data[:, :, cond_ind]
+        title = '{} sensors {} condition'.format(modality.upper(), meta['conditions'][cond_ind])
     else:
-        data_max, data_min = mu.get_data_max_min(data, True, (1, 99))
-        # data_min, data_max = np.percentile(data, 3), np.percentile(data, 97)
-        # data_maxmin = max([abs(data_min), abs(data_max)])
-        # data_min, data_max = -data_maxmin, data_maxmin
-        _addon().set_colorbar_max_min(data_max, data_min, True)
-    colors_ratio = 256 / (data_max - data_min)
+        C = data.shape[2]
+        if modality == 'meg':
+            data = data.squeeze() if C == 1 else np.diff(data, axis=2).squeeze() if C == 2 else \
+                np.mean(data, axis=2).squeeze()
+        else:
+            data = np.diff(data, axis=2).squeeze()
+        title = '{} sensors conditions difference'.format(modality.upper())
+    lookup = mu.load_faces_verts_lookup(op.join(mu.get_user_fol(), modality, '{}_faces_verts.npz'.format(modality)))
+    # The colorbar limits are calculated on the first frame that needs them
+    session = mu.Bag(key=key, data=data, title=title, lookup=lookup, data_minmax=None, helmet_data=None)
+    # Time major, so each frame's values are contiguous
+    helmet_data = data if modality == 'meg' else data[MEGPanel.eeg_helmet_indices]
+    session.helmet_data = np.ascontiguousarray(helmet_data.T)
+    MEGPanel.helmet_sessions[modality] = session
+    return session
 
-    cur_obj = bpy.data.objects['eeg_helmet']
-    data_t = data[MEGPanel.eeg_helmet_indices, bpy.context.scene.frame_current]
-    _addon().coloring.activity_map_obj_coloring(
-        cur_obj, data_t, lookup, threshold, True, data_min=data_min,
-        colors_ratio=colors_ratio, bigger_or_equall=False, use_abs=use_abs)
 
+def clear_helmet_sessions():
+    MEGPanel.helmet_sessions = {}
 
-def color_meg_helmet(use_abs=None, threshold=None):
+
+def color_helmet(modality, use_abs=None, threshold=None):
     if threshold is None:
         threshold = bpy.context.scene.coloring_lower_threshold
     if use_abs is None:
         use_abs = bpy.context.scene.coloring_use_abs
-    fol = mu.get_user_fol()
-    data, meta = get_meg_sensors_data()
-    data = data[MEGPanel.meg_helmet_indices[bpy.context.scene.meg_sensors_types], :, :]
-    if bpy.context.scene.meg_sensors_conditions != 'diff':
-        cond_ind = np.where(meta['conditions'] == bpy.context.scene.meg_sensors_conditions)[0][0]
-        data = data[:, :, cond_ind]
-        if not _addon().colorbar_values_are_locked():
-            _addon().set_colorbar_title('MEG sensors {} condition'.format(meta['conditions'][cond_ind]))
-    else:
-        C = data.shape[2]
-        data = data.squeeze() if C == 1 else np.diff(data, axis=2).squeeze() if C == 2 else \
-            np.mean(data, axis=2).squeeze()
-        if not _addon().colorbar_values_are_locked():
-            _addon().set_colorbar_title('MEG sensors conditions difference')
-    lookup = np.load(op.join(fol, 'meg', 'meg_faces_verts.npy'))
+    session = get_helmet_session(modality)
     if _addon().colorbar_values_are_locked():
         data_max, data_min = _addon().get_colorbar_max_min()
     else:
-        data_max, data_min = mu.get_data_max_min(data, True, (1, 99))
-        # data_min, data_max = np.percentile(data, 3), np.percentile(data, 97)
-        # data_maxmin = max([abs(data_min), abs(data_max)])
-        # data_min, data_max = -data_maxmin, data_maxmin
+        if session.data_minmax is None:
+            session.data_minmax = mu.get_data_max_min(session.data, True, (1, 99))
+            # data_min, data_max = np.percentile(data, 3), np.percentile(data, 97)
+            # data_maxmin = max([abs(data_min), abs(data_max)])
+            # data_min, data_max = -data_maxmin, data_maxmin
+        data_max, data_min = session.data_minmax
+        _addon().set_colorbar_title(session.title)
         _addon().set_colorbar_max_min(data_max, data_min, True)
     colors_ratio = 256 / (data_max - data_min)
 
-    cur_obj = bpy.data.objects['meg_helmet']
-    data_t = data[:, bpy.context.scene.frame_current]
+    cur_obj = bpy.data.objects['{}_helmet'.format(modality)]
+    data_t = session.helmet_data[bpy.context.scene.frame_current]
     _addon().coloring.activity_map_obj_coloring(
-        cur_obj, data_t, lookup, threshold, True, data_min=data_min,
+        cur_obj, data_t, session.lookup, threshold, True, data_min=data_min,
         colors_ratio=colors_ratio, bigger_or_equall=False, use_abs=use_abs)
 
 
+def color_eeg_helmet(use_abs=None):
+    color_helmet('eeg', use_abs, threshold=0)
+
+
+def color_meg_helmet(use_abs=None, threshold=None):
+    color_helmet('meg', use_abs, threshold)
+
+
 def color_meg_sensors(threshold=None):
     _addon().show_hide_meg_sensors()
     _addon().coloring.add_to_what_is_colored(_addon().coloring.WIC_MEG_SENSORS)
@@ -1050,6 +1056,7 @@ class MEGPanel(bpy.types.Panel):
     meg_sensors_data_minmax, meg_sensors_colors_ratio = None, None
     eeg_sensors_data, eeg_sensors_meta, eeg_sensors_data_minmax = {}, {}, None
     meg_sensors_data, meg_sensors_meta_data, meg_sensors_data_minmax = {}, {}, None
+    helmet_sessions = {}
 
     def draw(self, context):
         if MEGPanel.init:
@@ -1059,6 +1066,7 @@ class MEGPanel(bpy.types.Panel):
 def init(addon):
     MEGPanel.addon = addon
     user_fol = mu.get_user_fol()
+    clear_helmet_sessions()
 
     MEGPanel.eeg_sensors_exist = init_eeg_sensors()
     MEGPanel.meg_sensors_exist = init_meg_sensors()
@@ -230,6 +230,193 @@ def load(fname):
     return obj
 
 
+# Activity maps (MEG / fMRI dynamics) are stored per hemi as one (vertices x time) float32 npy cube next to the
+# legacy folder of t{N}.npy files. The cube is saved in Fortran order, so each frame is a contiguous column that
+# can be read from the memory map without copying. The min/max and colorbar metadata are kept in a small header.
+_activity_cubes = {}
+
+
+def activity_cube_fnames(fol):
+    fol = fol[:-1] if fol.endswith(op.sep) else fol
+    return '{}.npy'.format(fol), '{}_header.pkl'.format(fol)
+
+
+def save_activity_cube(fol, data, data_min=None, data_max=None, cb_title='', chunk_size=1000):
+    cube_fname, _ = activity_cube_fnames(fol)
+    make_dir(get_fname_folder(cube_fname))
+    _activity_cubes.pop(cube_fname, None)
+    V, T = data.shape
+    cube = np.lib.format.open_memmap(cube_fname, mode='w+', dtype=np.float32, shape=(V, T), fortran_order=True)
+    for t in range(0, T, chunk_size):
+        cube[:, t:t + chunk_size] = data[:, t:t + chunk_size]
+    cube.flush()
+    del cube
+    save_activity_cube_header(
+        fol, vertices_num=V, times_num=T, data_min=data_min, data_max=data_max, cb_title=cb_title)
+    return op.isfile(cube_fname)
+
+
+def save_activity_cube_frame(fol, t, frame):
+    # Writes one frame into the existing cube, which is preferred over the t{N}.npy files. If the frame doesn't fit
+    # the cube, the stale cube is removed. Returns True if the cube was updated
+    cube_fname, header_fname = activity_cube_fnames(fol)
+    if not op.isfile(cube_fname):
+        return False
+    _activity_cubes.pop(cube_fname, None)
+    frame = np.ravel(frame)
+    cube = np.load(cube_fname, mmap_mode='r+')
+    updated = cube.ndim == 2 and cube.shape[0] == len(frame) and 0 <= t < cube.shape[1]
+    if updated:
+        cube[:, t] = frame
+        cube.flush()
+    del cube
+    if not updated:
+        for fname in [cube_fname, header_fname]:
+            if op.isfile(fname):
+                os.remove(fname)
+    return updated
+
+
+def save_activity_cube_header(fol, **kwargs):
+    _, header_fname = activity_cube_fnames(fol)
+    header = load(header_fname) if op.isfile(header_fname) else {}
+    header.update(kwargs)
+    save(header, header_fname)
+
+
+def load_activity_cube(fol):
+    cube_fname, header_fname = activity_cube_fnames(fol)
+    if not op.isfile(cube_fname):
+        return None, None
+    mtime = os.path.getmtime(cube_fname)
+    if cube_fname not in _activity_cubes or _activity_cubes[cube_fname][0] != mtime:
+        header = load(header_fname) if op.isfile(header_fname) else {}
+        _activity_cubes[cube_fname] = (mtime, np.load(cube_fname, mmap_mode='r'), header)
+    return _activity_cubes[cube_fname][1:]
+
+
+def load_activity_frame(fol, t):
+    cube, _ = load_activity_cube(fol)
+    if cube is not None:
+        return cube[:, t] if t < cube.shape[1] else None
+    fname = op.join(fol, 't{}.npy'.format(t))
+    return np.load(fname) if op.isfile(fname) else None
+
+
+def activity_map_exists(fol, t=None):
+    cube_fname, _ = activity_cube_fnames(fol)
+    if op.isfile(cube_fname):
+        return True
+    if t is None:
+        return len(glob.glob(op.join(fol, 't*.npy'))) > 0
+    return op.isfile(op.join(fol, 't{}.npy'.format(t)))
+
+
+def hemi_activity_maps_exist(fol_template, t=None):
+    return all([activity_map_exists(fol_template.format(hemi=hemi), t) for hemi in HEMIS])
+
+
+class FacesVertsLookup(object):
+    # CSR lookup from the mesh vertices to their loops: the loops of vert are loops[indptr[vert]:indptr[vert + 1]]
+    def __init__(self, indptr, loops):
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.loops = np.asarray(loops, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def shape(self):
+        return (len(self), )
+
+    def __getitem__(self, vert):
+        return self.loops[self.indptr[vert]:self.indptr[vert + 1]]
+
+    def verts_loops(self, verts):
+        # Returns the loops of all the verts, and for each loop the index of its vertex in verts
+        verts = np.asarray(verts, dtype=np.int64)
+        starts = self.indptr[verts].astype(np.int64)
+        counts = self.indptr[verts + 1] - starts
+        loops_verts = np.repeat(np.arange(len(verts)), counts)
+        offsets = np.arange(len(loops_verts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.loops[starts[loops_verts] + offsets].astype(np.int64), loops_verts
+
+
+def calc_faces_verts_lookup(faces, verts_num):
+    # The loop index of each face's vertex is its index in the raveled faces (triangles only)
+    _faces = np.asarray(faces).ravel()
+    loops = np.argsort(_faces, kind='mergesort')
+    indptr = np.zeros(verts_num + 1, dtype=np.int32)
+    np.cumsum(np.bincount(_faces, minlength=verts_num), out=indptr[1:])
+    return FacesVertsLookup(indptr, loops)
+
+
+def faces_verts_lookup_fname(fname):
+    return '{}.npz'.format(fname[:-4] if fname.endswith('.npy') or fname.endswith('.npz') else fname)
+
+
+def save_faces_verts_lookup(lookup, fname):
+    np.savez(faces_verts_lookup_fname(fname), indptr=lookup.indptr, loops=lookup.loops)
+
+
+def faces_verts_lookup_exists(fname):
+    # fname is the lookup file name, the legacy dense matrix (*.npy) is also supported
+    lookup_fname = faces_verts_lookup_fname(fname)
+    return op.isfile(lookup_fname) or op.isfile('{}.npy'.format(lookup_fname[:-4]))
+
+
+def load_faces_verts_lookup(fname):
+    lookup_fname = faces_verts_lookup_fname(fname)
+    if op.isfile(lookup_fname):
+        d = np.load(lookup_fname)
+        return FacesVertsLookup(d['indptr'], d['loops'])
+    legacy_fname = '{}.npy'.format(lookup_fname[:-4])
+    if not op.isfile(legacy_fname):
+        return None
+    # Legacy dense (vertices x max valence) lookup, padded with -1
+    lookup = np.load(legacy_fname)
+    valid = lookup > -1
+    indptr = np.zeros(lookup.shape[0] + 1, dtype=np.int32)
+    np.cumsum(valid.sum(1), out=indptr[1:])
+    return FacesVertsLookup(indptr, lookup[valid])
+
+
+_vertices_labels_ids = {}
+
+
+def get_vertices_labels_ids_fname(subject_fol, atlas, hemi):
+    return op.join(subject_fol, 'labels', '{}_vertices_labels_ids_{}.npz'.format(atlas, hemi))
+
+
+def save_vertices_labels_ids(subject_fol, atlas, hemi, vertices_labels_ids, labels_names):
+    fname = get_vertices_labels_ids_fname(subject_fol, atlas, hemi)
+    make_dir(get_fname_folder(fname))
+    _vertices_labels_ids.pop(fname, None)
+    np.savez(fname, vertices_labels_ids=np.asarray(vertices_labels_ids, dtype=np.int32),
+             labels_names=np.array(labels_names, dtype=str))
+    return op.isfile(fname)
+
+
+def load_vertices_labels_ids(subject_fol, atlas, hemi):
+    # Returns the vertex -> label id array (-1 for vertices without a label) and the labels names
+    fname = get_vertices_labels_ids_fname(subject_fol, atlas, hemi)
+    if not op.isfile(fname):
+        return None, None
+    mtime = os.path.getmtime(fname)
+    if fname not in _vertices_labels_ids or _vertices_labels_ids[fname][0] != mtime:
+        d = np.load(fname)
+        _vertices_labels_ids[fname] = (mtime, d['vertices_labels_ids'], d['labels_names'])
+    return _vertices_labels_ids[fname][1:]
+
+
+def find_vertex_label(subject_fol, atlas, hemi, vertex_ind):
+    vertices_labels_ids, labels_names = load_vertices_labels_ids(subject_fol, atlas, hemi)
+    if vertices_labels_ids is None or not 0 <= vertex_ind < len(vertices_labels_ids) or \
+            vertices_labels_ids[vertex_ind] < 0:
+        return ''
+    return str(labels_names[vertices_labels_ids[vertex_ind]])
+
+
 class Bag( dict ):
     """ a dict with d.key short for d["key"]
         d = Bag( k=v ... / **dict / dict.items() / [(k,v) ...] )  just like dict
@@ -263,6 +450,56 @@ def insert_keyframe_to_custom_prop(obj, prop_name, value, keyframe):
     obj.keyframe_insert(data_path='[' + '"' + prop_name + '"' + ']', frame=keyframe)
 
 
+def insert_keyframes_to_custom_prop(obj, prop_name, values, first_frame=2, zeros_frames=(1,), frames=None):
+    # Bulk version of insert_keyframe_to_custom_prop: values[ind] is keyframed in first_frame + ind (or in frames[ind]),
+    # and zeros in zeros_frames. The fcurve is created once, and all its keyframes are set with foreach_set.
+    values = np.asarray(values, dtype=np.float32).ravel()
+    # Like keyframe_insert, the property is left with the last inserted value
+    obj[prop_name] = float(values[-1]) if len(values) > 0 else 0.0
+    if frames is None:
+        frames = np.arange(first_frame, first_frame + len(values), dtype=np.float32)
+    else:
+        frames = np.asarray(frames, dtype=np.float32).ravel()
+    zeros_frames = np.setdiff1d(np.array(zeros_frames, dtype=np.float32), frames)
+    frames = np.concatenate((frames, zeros_frames))
+    values = np.concatenate((values, np.zeros(len(zeros_frames), dtype=np.float32)))
+    sort_inds = np.argsort(frames, kind='mergesort')
+    frames, values = frames[sort_inds], values[sort_inds]
+    if obj.animation_data is None:
+        obj.animation_data_create()
+    if obj.animation_data.action is None:
+        obj.animation_data.action = bpy.data.actions.new('{}Action'.format(obj.name))
+    fcurves = obj.animation_data.action.fcurves
+    data_path = '[' + '"' + prop_name + '"' + ']'
+    fcurve = fcurves.find(data_path)
+    if fcurve is not None:
+        fcurves.remove(fcurve)
+    fcurve = fcurves.new(data_path)
+    keyframes_num = len(frames)
+    fcurve.keyframe_points.add(keyframes_num)
+    fcurve.keyframe_points.foreach_set('co', np.vstack((frames, values)).T.ravel())
+    prefs = bpy.context.user_preferences.edit
+    keyframe_props = bpy.types.Keyframe.bl_rna.properties
+    interpolation = keyframe_props['interpolation'].enum_items[prefs.keyframe_new_interpolation_type].value
+    handle_type = keyframe_props['handle_left_type'].enum_items[prefs.keyframe_new_handle_type].value
+    fcurve.keyframe_points.foreach_set('interpolation', [interpolation] * keyframes_num)
+    fcurve.keyframe_points.foreach_set('handle_left_type', [handle_type] * keyframes_num)
+    fcurve.keyframe_points.foreach_set('handle_right_type', [handle_type] * keyframes_num)
+    fcurve.update()
+    return fcurve
+
+
+def set_fcurve_keyframes_values(fcurve, values):
+    # Sets the first and last keyframes to zero, and the ones between them to values
+    co = np.zeros(len(fcurve.keyframe_points) * 2, dtype=np.float32)
+    fcurve.keyframe_points.foreach_get('co', co)
+    co = co.reshape((-1, 2))
+    co[0, 1], co[-1, 1] = 0, 0
+    T = min(len(values), len(co) - 1)
+    co[1:T + 1, 1] = values[:T]
+    fcurve.keyframe_points.foreach_set('co', co.ravel())
+
+
 def create_and_set_material(obj):
     # curMat = bpy.data.materials['OrigPatchesMat'].copy()
     if obj.active_material is None or obj.active_material.name != obj.name + '_Mat':
@@ -1207,29 +1444,89 @@ class connection_to_listener(object):
 conn_to_listener = connection_to_listener()
 
 
-def min_cdist_from_obj(obj, Y):
-    vertices = obj.data.vertices
-    kd = mathutils.kdtree.KDTree(len(vertices))
-    for ind, x in enumerate(vertices):
-        kd.insert(x.co, ind)
+_kd_trees_cache = {}
+_points_kd_trees_cache = OrderedDict()
+POINTS_KD_TREES_CACHE_SIZE = 20
+
+
+def create_kd_tree(points):
+    kd = mathutils.kdtree.KDTree(len(points))
+    for ind, x in enumerate(points):
+        kd.insert(x, ind)
     kd.balance()
-    # Find the closest point to the 3d cursor
-    res = []
-    for y in Y:
-        res.append(kd.find_n(y, 1)[0])
+    return kd
+
+
+def calc_obj_vertices_co(obj, use_shape_keys=False):
+    vertices_num = len(obj.data.vertices)
+    mesh = obj.to_mesh(bpy.context.scene, True, 'PREVIEW') if use_shape_keys else obj.data
+    co = np.zeros(len(mesh.vertices) * 3)
+    mesh.vertices.foreach_get('co', co)
+    if use_shape_keys:
+        bpy.data.meshes.remove(mesh)
+    # in flat map not all the vertices exist
+    return co.reshape((-1, 3))[:vertices_num]
+
+
+def get_obj_kd_tree_state(obj, use_shape_keys=False):
+    # The tree is rebuilt if the mesh was replaced, or if the shape keys (inflating / flattening) were changed
+    mesh = obj.data
+    state = [mesh.as_pointer(), len(mesh.vertices)]
+    if use_shape_keys and mesh.shape_keys is not None:
+        state.extend([key_block.value for key_block in mesh.shape_keys.key_blocks])
+    return tuple(state)
+
+
+def get_obj_kd_tree(obj, use_shape_keys=False):
+    # KDTree of the object's vertices (in the object's coordinates), cached per object
+    key = (obj.name, use_shape_keys)
+    state = get_obj_kd_tree_state(obj, use_shape_keys)
+    if key not in _kd_trees_cache or _kd_trees_cache[key][0] != state:
+        _kd_trees_cache[key] = (state, create_kd_tree(calc_obj_vertices_co(obj, use_shape_keys)))
+    return _kd_trees_cache[key][1]
+
+
+def get_points_kd_tree(X):
+    X = np.array(X, dtype=np.float64)
+    key = (X.shape, hash(X.tobytes()))
+    if key in _points_kd_trees_cache:
+        _points_kd_trees_cache.move_to_end(key)
+    else:
+        _points_kd_trees_cache[key] = create_kd_tree(X)
+        if len(_points_kd_trees_cache) > POINTS_KD_TREES_CACHE_SIZE:
+            _points_kd_trees_cache.popitem(last=False)
+    return _points_kd_trees_cache[key]
+
+
+def clear_kd_trees_cache(obj_name=None):
+    if obj_name is None:
+        _kd_trees_cache.clear()
+        _points_kd_trees_cache.clear()
+    else:
+        for key in [k for k in _kd_trees_cache.keys() if k[0] == obj_name]:
+            del _kd_trees_cache[key]
+
+
+def init_kd_trees_cache(objects_names, use_shape_keys=False):
+    now = time.time()
+    objects = [bpy.data.objects[name] for name in objects_names if bpy.data.objects.get(name) is not None]
+    for obj_ind, obj in enumerate(objects):
+        time_to_go(now, obj_ind, len(objects), runs_num_to_print=50)
+        get_obj_kd_tree(obj, use_shape_keys)
+
+
+def kd_tree_find_closest(kd, Y):
+    # co, index, dist for each point in Y
+    return [kd.find(y) for y in Y]
+
+
+def min_cdist_from_obj(obj, Y, use_shape_keys=False):
     # co, index, dist
-    return res
+    return kd_tree_find_closest(get_obj_kd_tree(obj, use_shape_keys), Y)
 
 
 def min_cdist(X, Y):
-    kd = mathutils.kdtree.KDTree(X.shape[0])
-    for ind, x in enumerate(X):
-        kd.insert(x, ind)
-    kd.balance()
-    # Find the closest point to the 3d cursor
-    res = []
-    for y in Y:
-        res.append(kd.find_n(y, 1)[0])
+    res = kd_tree_find_closest(get_points_kd_tree(X), Y)
     # co, index, dist
     if len(Y) == 1:
         return res[0]
@@ -1307,15 +1604,72 @@ def create_empty_in_vertex(vertex_location, obj_name, layer, parent_name=''):
         bpy.context.object.parent = bpy.data.objects[parent_name]
 
 
+PLY_TYPES = {'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2', 'int': 'i4', 'uint': 'u4',
+             'float': 'f4', 'double': 'f8', 'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+             'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8'}
+
+
+def read_ply_header(f):
+    # Returns the format and the vertices / faces elements (num and properties) from the ply header
+    ply_format, elements, element = 'ascii', {}, None
+    while True:
+        line = f.readline().decode('ascii')
+        if line == '' or line.strip() == 'end_header':
+            break
+        words = line.strip().split()
+        if len(words) == 0:
+            continue
+        if words[0] == 'format':
+            ply_format = words[1]
+        elif words[0] == 'element':
+            element = words[1]
+            elements[element] = dict(num=int(words[2]), props=[])
+        elif words[0] == 'property' and element is not None:
+            elements[element]['props'].append(words[1:])
+    return ply_format, elements
+
+
 def read_ply_file(ply_file):
-    with open(ply_file, 'r') as f:
-        lines = f.readlines()
-        verts_num = int(lines[2].split(' ')[-1])
-        faces_num = int(lines[6].split(' ')[-1])
-        verts_lines = lines[9:9 + verts_num]
-        faces_lines = lines[9 + verts_num:]
-        verts = np.array([list(map(float, l.strip().split(' '))) for l in verts_lines])
-        faces = np.array([list(map(int, l.strip().split(' '))) for l in faces_lines])[:,1:]
+    # Vectorized reading of ascii and binary ply files
+    with open(ply_file, 'rb') as f:
+        ply_format, elements = read_ply_header(f)
+        verts_element = elements.get('vertex', dict(num=0, props=[]))
+        faces_element = elements.get('face', dict(num=0, props=[['list', 'uchar', 'int', 'vertex_index']]))
+        verts_num, faces_num = verts_element['num'], faces_element['num']
+        props_num = len(verts_element['props'])
+        count_type, index_type = faces_element['props'][0][1:3]
+        if ply_format == 'ascii':
+            values = np.array(f.read().split(), dtype=np.float64)
+            verts = values[:verts_num * props_num].reshape((verts_num, props_num))
+            faces_values = values[verts_num * props_num:].astype(np.int64)
+            if faces_num > 0 and len(faces_values) == faces_num * (faces_values[0] + 1) and \
+                    np.all(faces_values[::faces_values[0] + 1] == faces_values[0]):
+                faces = faces_values.reshape((faces_num, faces_values[0] + 1))[:, 1:]
+            else:
+                faces, ind = [], 0
+                for _ in range(faces_num):
+                    faces.append(faces_values[ind + 1:ind + 1 + faces_values[ind]])
+                    ind += faces_values[ind] + 1
+                faces = np.array(faces, dtype=None if len(set(map(len, faces))) <= 1 else object)
+        else:
+            endian = '<' if ply_format == 'binary_little_endian' else '>'
+            verts_dtype = np.dtype([(prop[1], endian + PLY_TYPES[prop[0]]) for prop in verts_element['props']])
+            verts = np.fromfile(f, verts_dtype, verts_num)
+            verts = np.column_stack([verts[prop[1]] for prop in verts_element['props']]).astype(np.float64)
+            faces_data = f.read()
+            count_dtype, index_dtype = np.dtype(endian + PLY_TYPES[count_type]), np.dtype(endian + PLY_TYPES[index_type])
+            poly_size = np.frombuffer(faces_data, count_dtype, 1)[0] if faces_num > 0 else 3
+            faces_dtype = np.dtype([('n', count_dtype), ('verts', index_dtype, (poly_size,))])
+            if len(faces_data) == faces_num * faces_dtype.itemsize and \
+                    np.all(np.frombuffer(faces_data, faces_dtype, faces_num)['n'] == poly_size):
+                faces = np.frombuffer(faces_data, faces_dtype, faces_num)['verts'].astype(np.int64)
+            else:
+                faces, ind = [], 0
+                for _ in range(faces_num):
+                    n = int(np.frombuffer(faces_data, count_dtype, 1, ind)[0])
+                    faces.append(np.frombuffer(faces_data, index_dtype, n, ind + count_dtype.itemsize))
+                    ind += count_dtype.itemsize + n * index_dtype.itemsize
+                faces = np.array(faces, dtype=None if len(set(map(len, faces))) <= 1 else object)
     return verts, faces
 
 
@@ -2472,6 +2826,24 @@ def read_labels_from_annot(annot_fname):
     return labels
 
 
+def calc_vertices_labels_ids_from_annot(annot_fname):
+    # Vectorized vertex -> label id (-1 for no label), with the labels ordered like in read_labels_from_annot
+    hemi = get_hemi_from_fname(namebase_with_ext(annot_fname))
+    annot, ctab, annot_names = _read_annot(annot_fname)
+    annot_labels_ids = ctab[:, -1]
+    sorter = np.argsort(annot_labels_ids)
+    ctab_inds = sorter[np.clip(np.searchsorted(annot_labels_ids, annot, sorter=sorter), 0, len(sorter) - 1)]
+    ctab_inds[annot_labels_ids[ctab_inds] != annot] = -1
+    # Only the labels with vertices, sorted by name
+    used_inds = np.unique(ctab_inds[ctab_inds >= 0])
+    labels_names = np.array(['{}-{}'.format(annot_names[ind].decode(), hemi) for ind in used_inds])
+    order = np.argsort(labels_names)
+    new_ids = np.ones(len(annot_labels_ids), dtype=np.int32) * -1
+    new_ids[used_inds[order]] = np.arange(len(used_inds))
+    vertices_labels_ids = np.where(ctab_inds >= 0, new_ids[ctab_inds], -1).astype(np.int32)
+    return vertices_labels_ids, labels_names[order]
+
+
 def _read_annot(fname):
     """Read a Freesurfer annotation from a .annot file.
 
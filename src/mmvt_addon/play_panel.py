@@ -10,6 +10,8 @@ from collections import OrderedDict
 import glob
 import re
 import shutil
+import threading
+from queue import Queue
 
 HEMIS = mu.HEMIS
 
@@ -49,6 +51,10 @@ bpy.types.Scene.add_reverse_frames = bpy.props.BoolProperty(
     default=False, description='Add reverse frames to the end of the movie')
 bpy.types.Scene.play_miscs = bpy.props.EnumProperty(
     items=[('inflating', 'inflating', '', 1), ('slicing', 'slicing', '', 2)])
+bpy.types.Scene.play_prefetch = bpy.props.BoolProperty(default=True,
+    description='Calculates the next frames in the background while playing (MEG activity and fMRI dynamics)')
+bpy.types.Scene.play_prefetch_frames_num = bpy.props.IntProperty(default=10, min=1,
+    description='The number of frames to calculate ahead')
 
 
 def _addon():
@@ -67,6 +73,125 @@ def set_rotate_brain_while_playing(val=True):
     bpy.context.scene.rotate_brain_while_playing = val
 
 
+class FramesPrefetcher(object):
+    # Calculates the upcoming frames on worker threads into a bounded buffer. calc_frame_func must not call bpy.
+    def __init__(self, calc_frame_func, buffer_size=10, workers_num=2):
+        self.calc_frame_func = calc_frame_func
+        self.buffer_size = buffer_size
+        self.buffer = {}
+        self.wanted = set()
+        self.pending = set()
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.workers = [threading.Thread(target=self._worker) for _ in range(workers_num)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def _worker(self):
+        while True:
+            t = self.queue.get()
+            if t is None:
+                break
+            with self.lock:
+                if t not in self.wanted:
+                    self.pending.discard(t)
+                    continue
+            try:
+                frame = self.calc_frame_func(t)
+            except:
+                print(traceback.format_exc())
+                frame = None
+            with self.lock:
+                self.pending.discard(t)
+                if t in self.wanted and frame is not None:
+                    self.buffer[t] = frame
+
+    def prefetch(self, frames):
+        frames = frames[:self.buffer_size]
+        with self.lock:
+            self.wanted = set(frames)
+            for t in [t for t in self.buffer.keys() if t not in self.wanted]:
+                del self.buffer[t]
+            new_frames = [t for t in frames if t not in self.buffer and t not in self.pending]
+            self.pending.update(new_frames)
+        for t in new_frames:
+            self.queue.put(t)
+
+    def get(self, t):
+        with self.lock:
+            frame = self.buffer.pop(t, None)
+        if frame is not None:
+            self.hits += 1
+            return frame
+        self.misses += 1
+        return self.calc_frame_func(t)
+
+    def stats(self):
+        gets_num = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / gets_num if gets_num > 0 else 0)
+
+    def stop(self):
+        with self.lock:
+            self.wanted = set()
+            self.buffer = {}
+        for _ in self.workers:
+            self.queue.put(None)
+
+
+def get_prefetch_stats():
+    return PlayPanel.prefetcher.stats() if PlayPanel.prefetcher is not None else None
+
+
+def _prefetch_map_type(play_type):
+    coloring = _addon().coloring
+    if play_type == 'meg' and coloring.ColoringMakerPanel.activity_map_chosen and \
+            not coloring.ColoringMakerPanel.stc_file_chosen and not bpy.context.scene.coloring_meg_subcorticals:
+        return 'MEG'
+    elif play_type == 'fmri_dynamics':
+        return 'FMRI_DYNAMICS'
+    return None
+
+
+def init_prefetcher(play_type=None):
+    # (Re)creates the prefetcher when the play parameters that affect the colors change
+    if play_type is None:
+        play_type = bpy.context.scene.play_type
+    map_type = _prefetch_map_type(play_type) if bpy.context.scene.play_prefetch else None
+    scn = bpy.context.scene
+    key = None if map_type is None else (
+        map_type, scn.meg_files if map_type == 'MEG' else '', scn.coloring_lower_threshold, scn.meg_threshold,
+        scn.coloring_use_abs, scn.colorbar_files, _addon().colorbar_values_are_locked(),
+        _addon().get_colorbar_max_min(), scn.play_prefetch_frames_num)
+    if key == PlayPanel.prefetcher_key:
+        return PlayPanel.prefetcher
+    stop_prefetcher()
+    PlayPanel.prefetcher_key = key
+    if map_type is not None:
+        calc_frame_func = _addon().coloring.get_activity_map_frames_calculator(map_type)
+        if calc_frame_func is not None:
+            PlayPanel.prefetcher = FramesPrefetcher(calc_frame_func, scn.play_prefetch_frames_num)
+            PlayPanel.prefetch_map_type = map_type
+    return PlayPanel.prefetcher
+
+
+def prefetch_next_frames(cur_frame):
+    if PlayPanel.prefetcher is None:
+        return
+    step = -bpy.context.scene.play_dt if PlayPanel.play_reverse else bpy.context.scene.play_dt
+    frames = [cur_frame + k * step for k in range(1, bpy.context.scene.play_prefetch_frames_num + 1)]
+    PlayPanel.prefetcher.prefetch(
+        [t for t in frames if bpy.context.scene.play_from <= t <= bpy.context.scene.play_to])
+
+
+def stop_prefetcher():
+    if PlayPanel.prefetcher is not None:
+        print('Frames prefetching: {}'.format(PlayPanel.prefetcher.stats()))
+        PlayPanel.prefetcher.stop()
+    PlayPanel.prefetcher, PlayPanel.prefetcher_key = None, None
+
+
 class ModalTimerOperator(bpy.types.Operator):
     """Operator which runs its self from a timer"""
     bl_idname = "wm.modal_timer_operator"
@@ -90,6 +215,7 @@ class ModalTimerOperator(bpy.types.Operator):
         if event.type in {'RIGHTMOUSE', 'ESC'} or self.limits > bpy.context.scene.play_to:
             plot_something(self, context, bpy.context.scene.play_to, ModalTimerOperator._uuid)
             print('Stop!')
+            stop_prefetcher()
             self.limits = bpy.context.scene.play_from
             PlayPanel.is_playing = False
             bpy.context.scene.update()
@@ -112,6 +238,8 @@ class ModalTimerOperator(bpy.types.Operator):
                 # print(self.limits, time.time() - self._time)
                 self._time = time.time()
                 try:
+                    if init_prefetcher() is not None:
+                        prefetch_next_frames(self.limits)
                     plot_something(self, context, self.limits, ModalTimerOperator._uuid)
                 except:
                     print(traceback.format_exc())
@@ -152,13 +280,15 @@ def rotate_while_playing():
         _addon().rotate_brain()
 
 
-def render_movie(play_type, play_from, play_to, camera_fname='', play_dt=1, set_to_camera_mode=True, rotate_brain=False):
+def render_movie(play_type, play_from, play_to, camera_fname='', play_dt=1, set_to_camera_mode=True, rotate_brain=False,
+                 frames=None):
+    # frames: render only a subset of the frames (like in the parallel rendering of scripts/render_movie.py)
     set_play_to(play_to)
     bpy.context.scene.play_type = play_type
     bpy.context.scene.render_movie = True
     bpy.context.scene.rotate_brain_while_playing = rotate_brain
     print('In play movie!')
-    play_range = list(range(play_from, play_to + 1, play_dt))
+    play_range = list(range(play_from, play_to + 1, play_dt)) if frames is None else list(frames)
     runs_num = len(play_range)
     for run, limits in enumerate(play_range):
         print('limits: {}'.format(limits))
@@ -201,7 +331,16 @@ def plot_something(self=None, context=None, cur_frame=0, uuid='', camera_fname='
     # if False: #PlayPanel.init_play:
 
     successful_ret = True
-    if play_type in ['meg', 'meg_elecs', 'meg_elecs_coh', 'meg_helmet_source', 'eeg_helmet_source']:
+    prefetched_frame = None
+    if PlayPanel.prefetcher is not None and PlayPanel.is_playing and \
+            PlayPanel.prefetch_map_type == _prefetch_map_type(play_type):
+        prefetched_frame = PlayPanel.prefetcher.get(bpy.context.scene.frame_current)
+    if prefetched_frame is not None:
+        # Only the precalculated colors are applied here, the rest of the play types are plotted as usual
+        successful_ret = _addon().coloring.plot_activity_frame_colors(PlayPanel.prefetch_map_type, prefetched_frame)
+        if play_type == 'meg':
+            _addon().colorbar.lock_colorbar_values(False)
+    elif play_type in ['meg', 'meg_elecs', 'meg_elecs_coh', 'meg_helmet_source', 'eeg_helmet_source']:
         # if PlayPanel.loop_indices:
         #     _addon().default_coloring(PlayPanel.loop_indices)
         # PlayPanel.loop_indices =
@@ -211,7 +350,7 @@ def plot_something(self=None, context=None, cur_frame=0, uuid='', camera_fname='
         #     PlayPanel.meg_sub_activity, plot_subcorticals)
     if play_type in ['fmri']:
         successful_ret = _addon().activity_map_coloring('FMRI')
-    if play_type in ['fmri_dynamics']:
+    if play_type in ['fmri_dynamics'] and prefetched_frame is None:
         successful_ret = _addon().plot_activity(
             'FMRI_DYNAMICS', PlayPanel.faces_verts, bpy.context.scene.meg_threshold, None, False)
     if play_type in ['elecs', 'meg_elecs', 'elecs_act_coh', 'meg_elecs_coh']:
@@ -250,7 +389,8 @@ def plot_something(self=None, context=None, cur_frame=0, uuid='', camera_fname='
             _addon().save_image(play_type, bpy.context.scene.save_selected_view,
                                           bpy.context.scene.frame_current)
         if bpy.context.scene.render_movie:
-            _addon().render_image(set_to_camera_mode=set_to_camera_mode)
+            # The camera file also sets the images names (scene.camera_files if it's empty)
+            _addon().render_image(camera_fname=camera_fname, set_to_camera_mode=set_to_camera_mode)
     else:
         print("The image wasn't rendered due to an error in the plotting.")
 
@@ -568,6 +708,7 @@ class PlayPanel(bpy.types.Panel):
     play_reverse = False
     first_time = True
     init_play = True
+    prefetcher, prefetcher_key, prefetch_map_type = None, None, None
     # imp_times = [[148, 221], [247, 273], [410, 555], [903, 927]]
 
     def draw(self, context):
@@ -599,6 +740,14 @@ def play_panel_draw(context, layout):
     row.operator(Pause.bl_idname, text="", icon='PAUSE')
     row.operator(Play.bl_idname, text="", icon='PLAY')
     row.operator(NextKeyFrame.bl_idname, text="", icon='NEXT_KEYFRAME')
+    if play_type in ['meg', 'fmri_dynamics']:
+        row = layout.row(align=True)
+        row.prop(context.scene, 'play_prefetch', text="Prefetch frames")
+        if bpy.context.scene.play_prefetch:
+            row.prop(context.scene, 'play_prefetch_frames_num', text="")
+        if PlayPanel.prefetcher is not None:
+            stats = PlayPanel.prefetcher.stats()
+            layout.label(text='Prefetch hits: {}, misses: {}'.format(stats['hits'], stats['misses']))
     layout.prop(context.scene, 'render_movie', text="Render to a movie")
     layout.prop(context.scene, 'save_images', text="Save images")
     layout.prop(context.scene, 'rotate_brain_while_playing', text='Rotate the brain while playing')
@@ -672,6 +821,7 @@ class Pause(bpy.types.Operator):
 
     def invoke(self, context, event=None):
         PlayPanel.is_playing = False
+        stop_prefetcher()
         plot_something(self, context, bpy.context.scene.frame_current, ModalTimerOperator._uuid)
         print('Stop!')
         return {"FINISHED"}
@@ -0,0 +1,75 @@
+import sys
+import os
+import os.path as op
+import time
+import datetime
+
+try:
+    from src.mmvt_addon.scripts import scripts_utils as su
+except:
+    # Add current folder the imports path
+    sys.path.append(os.path.split(__file__)[0])
+    import scripts_utils as su
+
+
+def wrap_blender_call(args=None):
+    if args is None:
+        args = read_args()
+    su.call_script(__file__, args, run_in_background=True, err_pipe=sys.stdin)
+
+
+def read_args(argv=None):
+    parser = su.add_default_args()
+    parser.add_argument('--modality', help='meg/eeg', required=False, default='meg')
+    parser.add_argument('--play_from', help='from when to play', required=False, default=0, type=int)
+    parser.add_argument('--play_to', help='until when to play', required=False, default=100, type=int)
+    parser.add_argument('--play_dt', help='frames step', required=False, default=1, type=int)
+    return su.parse_args(parser, argv)
+
+
+def wrap_mmvt_calls(subject_fname):
+    args = read_args(su.get_python_argv())
+    if args.debug:
+        su.debug()
+    mmvt = su.init_mmvt_addon()
+    mmvt_calls(mmvt, args)
+    su.exit_blender()
+
+
+def mmvt_calls(mmvt, args):
+    # Measures the helmet coloring frame rate, like in the play panel's meg_helmet/eeg_helmet play types.
+    # The first frame, which loads the data and calculates the colorbar limits, is reported separately
+    mu = mmvt.utils
+    color_helmet = mmvt.color_meg_helmet if args.modality == 'meg' else mmvt.color_eeg_helmet
+    mmvt.meg.clear_helmet_sessions()
+    frames = list(range(args.play_from, args.play_to + 1, args.play_dt))
+    mmvt.set_current_time(frames[0])
+    now = time.time()
+    color_helmet()
+    first_frame_time = time.time() - now
+    now = time.time()
+    for t in frames[1:]:
+        mmvt.set_current_time(t)
+        color_helmet()
+    frames_time = time.time() - now
+    fps = (len(frames) - 1) / frames_time if frames_time > 0 else 0
+    msg = '{} helmet: first frame {:.3f}s, {} frames in {:.2f}s ({:.2f} fps)'.format(
+        args.modality, first_frame_time, len(frames) - 1, frames_time, fps)
+    mu.write_to_stderr(msg)
+    # Keeps a history of the runs, to track the frame rate over time
+    output_fname = op.join(mu.make_dir(op.join(mu.get_user_fol(), 'logs')), 'helmet_playback_benchmark.csv')
+    write_header = not op.isfile(output_fname)
+    with open(output_fname, 'a') as output_file:
+        if write_header:
+            output_file.write('date,modality,frames,first_frame_time,frames_time,fps\n')
+        output_file.write('{},{},{},{:.5f},{:.5f},{:.3f}\n'.format(
+            datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), args.modality, len(frames) - 1,
+            first_frame_time, frames_time, fps))
+
+
+if __name__ == '__main__':
+    import sys
+    if op.isfile(sys.argv[0]) and sys.argv[0][-2:] == 'py':
+        wrap_blender_call()
+    else:
+        wrap_mmvt_calls(sys.argv[1])
@@ -50,6 +50,7 @@ def run_script(cmd, verbose=False, stay_alive=False, cwd=None, log_fname='', err
             else:
                 log_file = None
             p = Popen(cmd, shell=True, stdout=log_file, stderr=err_pipe, bufsize=1, close_fds=True, cwd=cwd)
+            return p
         # print(output)
         # return output
 
@@ -12,7 +12,68 @@ except:
 
 def wrap_blender_call():
     args = read_args()
-    su.call_script(__file__, args)
+    if args.workers > 1:
+        render_movie_in_parallel(args)
+    else:
+        su.call_script(__file__, args)
+
+
+def render_movie_in_parallel(args):
+    # Splits the frames between args.workers background Blender processes. Then, the missing frames (of workers that
+    # failed) are rendered again, up to args.render_missing_runs times
+    mmvt_dir = op.join(su.get_links_dir(), 'mmvt')
+    output_path = get_output_path(args)
+    su.make_dir(output_path)
+    args.output_path, args.rel_output_path = output_path, False
+    camera_fname = su.get_camera_fname(mmvt_dir, args)
+    frames = list(range(args.play_from, args.play_to + 1, args.play_dt))
+    for run in range(args.render_missing_runs + 1):
+        missing_frames = find_missing_frames(output_path, frames, camera_fname)
+        if len(missing_frames) == 0:
+            break
+        if run > 0:
+            print('Rendering again {} missing frames: {}'.format(len(missing_frames), missing_frames))
+        workers_num = min(args.workers, len(missing_frames))
+        procs = []
+        for worker_ind in range(workers_num):
+            worker_args = su.Bag(dict(args))
+            # Interleaved subsets, so the workers finish at about the same time
+            worker_args.frames = missing_frames[worker_ind::workers_num]
+            worker_args.workers, worker_args.worker_ind, worker_args.back = 1, worker_ind, True
+            worker_procs = su.call_script(__file__, worker_args, log_name='render_movie_{}'.format(worker_ind),
+                                          run_in_background=True, stay_alive=False)
+            if worker_procs is None:
+                # call_script couldn't find the Blender folder
+                return False
+            procs.extend(worker_procs)
+        for p in procs:
+            if p is not None:
+                p.wait()
+    missing_frames = find_missing_frames(output_path, frames, camera_fname)
+    if len(missing_frames) > 0:
+        print("Couldn't render the following frames: {}".format(missing_frames))
+    return len(missing_frames) == 0
+
+
+def get_frame_image_name(frame, camera_fname):
+    # The image name render_image uses for the frame, when render_movie passes it the loaded camera file
+    camera_name = su.namebase(camera_fname) if camera_fname != '' else 'camera'
+    image_name = '{}_{}'.format(camera_name.replace('camera', ''), frame)
+    return image_name[1:] if image_name.startswith('_') else image_name
+
+
+def find_missing_frames(output_path, frames, camera_fname):
+    import glob
+    return [frame for frame in frames if not any([op.getsize(fname) > 0 for fname in glob.glob(
+        op.join(output_path, '{}.*'.format(get_frame_image_name(frame, camera_fname))))])]
+
+
+def get_output_path(args):
+    if args.rel_output_path:
+        mmvt_dir = op.join(su.get_links_dir(), 'mmvt')
+        output_path = args.play_type if args.output_path == '' else args.output_path
+        return op.join(mmvt_dir, args.subject, 'movies', output_path)
+    return args.output_path
 
 
 def add_args():
@@ -38,6 +99,12 @@ def add_args():
     parser.add_argument('--mark_electrodes', help='mark_electrodes', required=False, default='', type=su.str_arr_type)
     parser.add_argument('--mark_electrodes_value', help='mark_electrodes_value', required=False, default=0.1, type=float)
     parser.add_argument('--mark_other_electrodes', help='mark_other_electrodes', required=False, default=False, type=su.is_true)
+    parser.add_argument('--workers', help='background Blender workers num', required=False, default=1, type=int)
+    parser.add_argument('--render_missing_runs', help='times to render again the missing frames', required=False,
+                        default=1, type=int)
+    # Set by render_movie_in_parallel for each worker
+    parser.add_argument('--frames', help='frames to render', required=False, default='', type=su.int_arr_type)
+    parser.add_argument('--worker_ind', help='worker index', required=False, default=0, type=int)
     return parser
 
 
@@ -53,11 +120,8 @@ def render_movie(subject_fname):
     args = read_args(su.get_python_argv())
     if args.debug:
         su.debug()
-    if args.rel_output_path:
-        mmvt_dir = op.join(su.get_links_dir(), 'mmvt')
-        if args.output_path == '':
-            args.output_path = args.play_type
-        args.output_path = op.join(mmvt_dir, args.subject, 'movies', args.output_path)
+    mmvt_dir = op.join(su.get_links_dir(), 'mmvt')
+    args.output_path = get_output_path(args)
     su.make_dir(args.output_path)
     mmvt = su.init_mmvt_addon()
     mmvt.show_hide_hemi(args.hide_lh, 'lh')
@@ -71,13 +135,17 @@ def render_movie(subject_fname):
     mmvt.filter_nodes(args.filter_nodes)
     mark_electrodes(mmvt, args)
     camera_fname = su.load_camera(mmvt, mmvt_dir, args)
-    if not op.isfile(op.join(args.output_path, 'data.pkl')):
+    # In the parallel rendering, only the first worker captures the graph, and the workers don't save the blend file
+    is_worker = len(args.frames) > 0
+    if not op.isfile(op.join(args.output_path, 'data.pkl')) and args.worker_ind == 0:
         try:
             mmvt.capture_graph(args.play_type, args.output_path, args.selection_type)
         except:
             print("Graph couldn't be captured!")
-    su.save_blend_file(subject_fname)
-    mmvt.render_movie(args.play_type, args.play_from, args.play_to, camera_fname, args.play_dt, args.set_to_camera_mode)
+    if not is_worker:
+        su.save_blend_file(subject_fname)
+    mmvt.render_movie(args.play_type, args.play_from, args.play_to, camera_fname, args.play_dt, args.set_to_camera_mode,
+                      frames=args.frames if is_worker else None)
     su.exit_blender()
 
 
@@ -245,6 +245,7 @@ def call_script(script_fname, args, log_name='', blend_fname=None, call_args=Non
     if len(args.subjects) == 0:
         args.subjects = [args.subject]
     subjects = args.subjects
+    procs = []
     for subject in subjects:
         args.subject = subject
         args.subjects = ''
@@ -265,14 +266,16 @@ def call_script(script_fname, args, log_name='', blend_fname=None, call_args=Non
             blend_fname=blend_fname, script_fname=script_fname, call_args=call_args, log_fname=log_fname) # op.join(args.blender_fol, 'blender')
         print(cmd)
         if not only_verbose:
-            utils.run_script(
-                cmd, stay_alive=stay_alive, log_fname=log_fname, cwd=blender_fol, err_pipe=err_pipe) #mmvt_addon_fol)
+            procs.append(utils.run_script(
+                cmd, stay_alive=stay_alive, log_fname=log_fname, cwd=blender_fol, err_pipe=err_pipe)) #mmvt_addon_fol)
         # if blend_fname_is_None:
         #     blend_fname = None
         # if call_args_is_None:
         #     call_args = None
         # call_args, blend_fname = None, None
     # print('Finish! For more details look in {}'.format(log_fname))
+    # The processes are returned only if not stay_alive
+    return procs
 
 
 def get_logs_fol(subject):
@@ -441,6 +444,15 @@ def get_subject_name(subject_fname):
     return namebase(subject_fname).split('_')[0]
 
 
+def get_camera_fname(mmvt_dir, args):
+    # The camera file load_camera will use
+    for camera_fname in [args.camera, op.join(args.output_path, 'camera.pkl'),
+                         op.join(mmvt_dir, args.subject, 'camera', 'camera.pkl')]:
+        if op.isfile(camera_fname):
+            return camera_fname
+    return ''
+
+
 def load_camera(mmvt, mmvt_dir, args):
     if op.isfile(args.camera):
         camera_fname = args.camera
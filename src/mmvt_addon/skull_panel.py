@@ -111,7 +111,8 @@ def plot_distances(from_inner=True):
     # distances = np.linalg.norm(f.intersections[:, 0] - f.intersections[:, 1], axis=1)
     source_str = 'from_inner' if from_inner else 'from_outer'
     distances = np.load(op.join(mu.get_user_fol(), 'skull', 'ray_casts_{}.npy'.format(source_str)))
-    faces_verts = np.load(op.join(mu.get_user_fol(), 'skull', 'faces_verts_{}_skull.npy'.format('inner' if from_inner else 'outer')))
+    faces_verts = mu.load_faces_verts_lookup(op.join(
+        mu.get_user_fol(), 'skull', 'faces_verts_{}_skull.npz'.format('inner' if from_inner else 'outer')))
     skull_obj = bpy.data.objects['{}_skull'.format('inner' if from_inner else 'outer')]
     data_max = 25 #np.percentile(distances, 75)
     if _addon().colorbar_values_are_locked():
@@ -126,7 +127,7 @@ def plot_distances(from_inner=True):
 def plot_distances_from_outer():
     f = mu.Bag(np.load(op.join(mu.get_user_fol(), 'skull', 'intersections_from_outer_skull.npz')))
     distances = np.linalg.norm(f.intersections[:, 0] - f.intersections[:, 1], axis=1)
-    faces_verts = np.load(op.join(mu.get_user_fol(), 'skull', 'faces_verts_outer_skull.npy'))
+    faces_verts = mu.load_faces_verts_lookup(op.join(mu.get_user_fol(), 'skull', 'faces_verts_outer_skull.npz'))
     outer_skull = bpy.data.objects['outer_skull']
     data_max = np.percentile(distances, 75)
     if _addon().colorbar_values_are_locked():
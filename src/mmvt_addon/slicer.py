@@ -4,6 +4,7 @@ import os.path as op
 import traceback
 import glob
 from itertools import product
+from collections import OrderedDict
 
 try:
     import nibabel as nib
@@ -20,6 +21,9 @@ except:
     from src.mmvt_addon.mmvt_utils import calc_colors_from_cm as calc_colors
     IN_BLENDER = False
 
+SLICES_CACHE_SIZE = 30
+_slices_pixels_cache = OrderedDict()
+
 
 def init(mmvt, modality, modality_data=None, colormap=None, subject='', mmvt_dir=''):
     if subject == '':
@@ -119,11 +123,9 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
     for modality in modalities:
         self[modality].coordinates = np.rint(np.array([x, y, z])[self[modality].order]).astype(int)
         self[modality].cross = [None] * 3
-        self[modality].x_vox = np.zeros_like(self[modality].data)
-        if mu.in_shape(xyz, self[modality].data.shape):
-            self[modality].x_vox[tuple(xyz)] = 255
-        else:
-            self[modality].x_vox[128, 128, 128] = 255
+        # The marked voxel, instead of marking it in a volume sized array
+        self[modality].marked_vox = xyz[:3] if mu.in_shape(xyz, self[modality].data.shape) else \
+            np.array([128, 128, 128])
 
     # cross_vert, cross_horiz = calc_cross(self[modality].coordinates, self[modality].sizes, self[modality].flips)
     images = {}
@@ -140,10 +142,22 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
         # self[modality].cross[ii] = cross
         for modality in modalities:
             s = self[modality]
-            cross = calc_cross(self[modality].x_vox, s, ii)
+            cross = calc_cross(s.marked_vox, s, ii)
             # print('{} ({},{})'.format(prespective, cross[0], cross[1]))
 
             self[modality].cross[ii] = cross
+            if clim is not None:
+                colors_ratio = 256 / (clim[1] - clim[0])
+            else:
+                clim, colors_ratio = s.clim, s.colors_ratio
+            sizes = (s.sizes[xax], s.sizes[yax])
+            self[modality].extras[ii] = (int((max_sizes[0] - sizes[0])/2), int((max_sizes[1] - sizes[1])/2))
+            cache_key = calc_slice_cache_key(s, ii, cross, clim, colors_ratio, zoom_around_voxel, zoom_voxels_num,
+                                             smooth, mark_voxel)
+            if cache_key is not None and cache_key in _slices_pixels_cache:
+                _slices_pixels_cache.move_to_end(cache_key)
+                pixels[modality] = _slices_pixels_cache[cache_key].copy()
+                continue
             d = get_image_data(s.data, s.order, s.flips, ii, s.coordinates, cross, zoom_around_voxel, zoom_voxels_num,
                                smooth)
             if s.pial_vol_mask is not None and bpy.context.scene.slices_show_pial:
@@ -176,15 +190,13 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
             # todo: Should do that step in the state init
             if modality == 'ct':
                 d[np.where(d == 0)] = -200
-            sizes = (s.sizes[xax], s.sizes[yax])
-            self[modality].extras[ii] = (int((max_sizes[0] - sizes[0])/2), int((max_sizes[1] - sizes[1])/2))
-            if clim is not None:
-                colors_ratio = 256 / (clim[1] - clim[0])
-            else:
-                clim, colors_ratio = s.clim, s.colors_ratio
             pixels[modality] = calc_slice_pixels(
                 mmvt, d, sizes, max_sizes, clim, colors_ratio, s.colormap, zoom_around_voxel, zoom_voxels_num, mark_voxel,
                 pial_vol_mask_data, dural_vol_mask_data, fmri_vol_data, t1_ct_mask)
+            if cache_key is not None:
+                _slices_pixels_cache[cache_key] = pixels[modality].copy()
+                if len(_slices_pixels_cache) > SLICES_CACHE_SIZE:
+                    _slices_pixels_cache.popitem(last=False)
         # image = create_image(d, sizes, max_sizes, s.clim, s.colors_ratio, prespective, s.colormap,
         #                      int(cross_horiz[ii][0, 1]), int(cross_vert[ii][0, 0]),
         #                      state[modality].extras[ii])
@@ -209,13 +221,42 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
 
 
 
-def calc_cross(x_vox, state, ii):
-    x_vox_slice = get_image_data(x_vox, state.order, state.flips, ii, state.coordinates)
-    inds = np.argwhere(x_vox_slice)
-    if len(inds) == 0:
+def calc_cross(marked_vox, state, ii):
+    # The marked voxel location in the ii slice, following the axes order and flips of get_image_data
+    shape = state.data.shape
+    slice_ax, pos = state.order[ii], state.coordinates[ii]
+    if not -shape[slice_ax] <= pos < shape[slice_ax] or marked_vox[slice_ax] != pos % shape[slice_ax]:
         return 128, 128
-    else:
-        return np.rint(np.argwhere(x_vox_slice)[0]).astype(int)
+    ax0, ax1 = [ax for ax in range(3) if ax != slice_ax]
+    (r, c), (h, w) = (marked_vox[ax0], marked_vox[ax1]), (shape[ax0], shape[ax1])
+    xax, yax = [1, 0, 0][ii], [2, 2, 1][ii]
+    if state.order[xax] < state.order[yax]:
+        (r, c), (h, w) = (c, r), (w, h)
+    if state.flips[xax]:
+        c = w - 1 - c
+    if state.flips[yax]:
+        r = h - 1 - r
+    return np.array([r, c], dtype=int)
+
+
+def calc_slice_cache_key(state, ii, cross, clim, colors_ratio, zoom_around_voxel, zoom_voxels_num, smooth,
+                         mark_voxel):
+    # The rendered planes depend on the overlays coloring when there is an fMRI volume, so they aren't cached
+    if state.fmri_vol is not None:
+        return None
+    masks_key = []
+    if IN_BLENDER:
+        if state.pial_vol_mask is not None and bpy.context.scene.slices_show_pial:
+            masks_key.append(tuple(bpy.context.scene.slices_show_pial_color))
+        if state.dural_vol_mask is not None and bpy.context.scene.slices_show_dural:
+            masks_key.append(tuple(bpy.context.scene.slices_show_dural_color))
+    zoom_key = (tuple(cross), zoom_voxels_num, smooth, mark_voxel) if zoom_around_voxel else None
+    return (state.modality, id(state.data), id(state.colormap), ii, int(state.coordinates[ii]),
+            tuple(float(c) for c in clim), float(colors_ratio), zoom_key, tuple(masks_key))
+
+
+def clear_slices_cache():
+    _slices_pixels_cache.clear()
 
 
 # def calc_cross(coordinates, sizes, flips):
@@ -267,19 +308,17 @@ def calc_slice_pixels(mmvt, data, sizes, max_sizes, clim, colors_ratio, colormap
     colors = calc_colors(data, clim[0], colors_ratio, colormap)
     max_sizes = [256, 256, 256]
 
+    # Writes the colors into a dark padded pixels array, instead of concatenating dark margins
+    h, w = colors.shape[:2]
     extra = [int((max_sizes[0] - sizes[0]) / 2), int((max_sizes[1] - sizes[1]) / 2)]
-    if max_sizes[0] > sizes[0]: # and max_sizes[1] == sizes[1]:
-        dark = np.zeros((colors.shape[0], extra[0], 3))
-        colors = np.concatenate((dark, colors, dark), axis=1)
-    if max_sizes[1] > sizes[1]: # and max_sizes[0] == sizes[0]:
-        dark = np.zeros((extra[1], colors.shape[1], 3))
-        colors = np.concatenate((dark, colors, dark), axis=0)
-
-    extra = [max_sizes[0] - colors.shape[0], max_sizes[1] - colors.shape[1]]
-    if extra[0] > 0:
-        colors = np.concatenate((np.zeros((extra[0], colors.shape[1], 3)), colors), axis=0)
-    if extra[1] > 0:
-        colors = np.concatenate((np.zeros((colors.shape[0], extra[1], 3)), colors), axis=1)
+    rows_pad = extra[1] if max_sizes[1] > sizes[1] else 0
+    cols_pad = extra[0] if max_sizes[0] > sizes[0] else 0
+    rows_start = max(max_sizes[0] - (h + 2 * rows_pad), 0) + rows_pad
+    cols_start = max(max_sizes[1] - (w + 2 * cols_pad), 0) + cols_pad
+    pixels = np.zeros((rows_start + h + rows_pad, cols_start + w + cols_pad, 4))
+    pixels[:, :, 3] = 1
+    pixels[rows_start:rows_start + h, cols_start:cols_start + w, :3] = colors
+    colors = pixels[:, :, :3]
 
     if zoom_around_voxel and mark_voxel:
         # todo: in very close zoom the red doesn't cover the whole pixel
@@ -299,20 +338,15 @@ def calc_slice_pixels(mmvt, data, sizes, max_sizes, clim, colors_ratio, colormap
             colors[fmri_inds] = mmvt.coloring.calc_colors(fmri_vol_data[fmri_inds])
     if t1_ct_mask is not None:
         colors[np.where(t1_ct_mask)] = (0, 0, 256)
-
-    pixels = np.ones((colors.shape[0], colors.shape[1], 4))
-    pixels[:, :, :3] = colors
     return pixels
 
 
 def add_cross_to_pixels(pixels, max_sizes, cross, extra):
     try:
         if 0 <= cross[1] < max_sizes[1]:  # data.shape[1]:
-            for x in range(max_sizes[0]):  # data.shape[0]):
-                pixels[x, cross[1] + extra[0]] = [0, 1, 0, 1]
+            pixels[:max_sizes[0], cross[1] + extra[0]] = [0, 1, 0, 1]
         if 0 <= cross[0] < max_sizes[0]:  # data.shape[0]:
-            for y in range(max_sizes[1]):  # data.shape[1]):
-                pixels[cross[0] + extra[1], y] = [0, 1, 0, 1]
+            pixels[cross[0] + extra[1], :max_sizes[1]] = [0, 1, 0, 1]
     except:
         pass
     return pixels
@@ -35,7 +35,6 @@ def load_offline_data(sub_folder):
             continue
         offline_data = data if offline_data == [] else np.hstack((offline_data, data))
     StreamingPanel.offline_data = offline_data
-    StreamingPanel.cycle_data = []
     StreamingPanel.minmax_vals = []
 
 
@@ -47,12 +46,45 @@ def electrodes_sep_update(self, context):
     C = len(parent_obj.animation_data.action.fcurves)
     for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
         elc_ind = fcurve_ind
-        for t in range(T):
-            fcurve.keyframe_points[t].co[1] = data[elc_ind, t] + \
-                                             (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
+        co = get_fcurve_co(fcurve)
+        co[:T, 1] = data[elc_ind, :T] + (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
+        set_fcurve_co(fcurve, co)
     mu.view_all_in_graph_editor()
 
 
+def get_fcurve_co(fcurve):
+    # Returns the fcurve's keyframes coordinates as a (keyframes_num x 2) array
+    co = np.zeros(len(fcurve.keyframe_points) * 2, dtype=np.float32)
+    fcurve.keyframe_points.foreach_get('co', co)
+    return co.reshape((-1, 2))
+
+
+def set_fcurve_co(fcurve, co):
+    fcurve.keyframe_points.foreach_set('co', co.ravel())
+
+
+def calc_cycle_indices(curr_t, T, max_steps):
+    # The keyframes indices of the next T samples, starting from curr_t and wrapping around after max_steps
+    inds = np.arange(T)
+    frames = curr_t + inds
+    wrapped = frames > max_steps
+    frames[wrapped] = inds[wrapped]
+    return frames
+
+
+def color_electrodes_objects(names, values, data_min, colors_ratio):
+    # Calculates the colors of all the electrodes at once, instead of one color_objects_homogeneously call per object
+    if len(names) == 0:
+        return
+    colors = _addon().calc_colors(values, data_min, colors_ratio)
+    for obj_name, color in zip(names, colors):
+        obj = bpy.data.objects.get(obj_name.replace(' ', ''))
+        if obj is None:
+            print('{} is None!'.format(obj_name))
+            continue
+        _addon().object_coloring(obj, color)
+
+
 # @mu.profileit()
 def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=50):
     MAX_STEPS = StreamingPanel.max_steps
@@ -84,17 +116,19 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
 
     # stim
     stim_ch_indices = [channels_names.index(s) for s in stim_channels if s in channels_names]
+    samples_inds = np.arange(mat.shape[1])
     for stim_ch_indice in stim_ch_indices:
         if len(np.unique(mat[stim_ch_indice])) == 1:
             mat[stim_ch_indice] = 0
         else:
             stim_indices = np.where(np.diff(mat[stim_ch_indice]) == 1)[0] + 1
-            stim_ch = np.zeros(T)
+            stim_ch = np.zeros(mat.shape[1])
             for stim_indice in stim_indices:
                 # mat[stim_ch_indice][(np.arange(T) < stim_indice) | (np.arange(T) > stim_indice + stim_length)] = 0
-                stim_ch[(np.arange(T) >= stim_indice) & (np.arange(T) < stim_indice + stim_length)] = 1
+                stim_ch[(samples_inds >= stim_indice) & (samples_inds < stim_indice + stim_length)] = 1
             mat[stim_ch_indice] = stim_ch
 
+    colored_names, colored_values = [], []
     for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
         fcurve_name = mu.get_fcurve_name(fcurve)
         if len(channels_names) > 0 and fcurve_name not in channels_names and fcurve_name not in stim_channels:
@@ -103,26 +137,20 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
             continue
         if first_curve:
             max_steps = min([len(fcurve.keyframe_points), MAX_STEPS]) - 2
+            frames = calc_cycle_indices(curr_t, T, max_steps)
             first_curve = False
         elc_ind = next(elecs_cycle) #fcurve_ind
         if elc_ind >= mat.shape[0]:
             continue
-        for ind in range(T):
-            t = curr_t + ind
-            if t > max_steps:
-                t = ind
-            fcurve.keyframe_points[t].co[1] = mat[elc_ind, ind] + (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
-            # if fcurve.keyframe_points[t].co[1] != 0:
-            #     print(elc_ind, ind, fcurve.keyframe_points[t].co[1])
-        _addon().color_objects_homogeneously([mat[elc_ind, ind]], [fcurve_name], None, data_min, colors_ratio)
+        co = get_fcurve_co(fcurve)
+        co[frames, 1] = mat[elc_ind, :T] + (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
+        set_fcurve_co(fcurve, co)
+        colored_names.append(fcurve_name)
+        colored_values.append(mat[elc_ind, T - 1])
         # fcurve.keyframe_points[max_steps + 1].co[1] = 0
         # fcurve.keyframe_points[0].co[1] = 0
+    color_electrodes_objects(colored_names, colored_values, data_min, colors_ratio)
 
-    try:
-        StreamingPanel.cycle_data = mat if StreamingPanel.cycle_data == [] else np.hstack((StreamingPanel.cycle_data, mat))
-    except:
-        StreamingPanel.cycle_data = mat
-        # print('asfd')
     bpy.context.scene.frame_current += mat.shape[1]
     if bpy.context.scene.frame_current > MAX_STEPS - 1:
         bpy.context.scene.frame_current = bpy.context.scene.frame_current - MAX_STEPS
@@ -135,7 +163,8 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
             print('sleep for {}'.format(max_steps_secs - time_diff_sec))
             time.sleep(max_steps_secs - time_diff_sec)
         StreamingPanel.time = datetime.now()
-        StreamingPanel.cycle_data = []
+        if StreamingPanel.ring_buffer is not None:
+            StreamingPanel.cycle_start = StreamingPanel.ring_buffer.consumed_samples_num
 
 
 def show_electrodes_fcurves():
@@ -181,15 +210,76 @@ def offline_logs_reader(udp_queue, while_termination_func, **kargs):
         data = np.delete(data, no_channels, axis=0)
     if good_channels:
         data = data[good_channels]
+    ring_buffer = StreamingRingBuffer(data.shape[0], kargs.get('ring_buffer_window', 10000))
     ind = 0
     while while_termination_func():
         if ind+buffer_size < data.shape[1]:
-            udp_queue.put(data[:, ind:ind+buffer_size])
+            # Waits for the consumer instead of overwriting the samples it didn't read yet
+            if ring_buffer.samples_num + buffer_size - ring_buffer.consumed_samples_num > ring_buffer.window:
+                time.sleep(0.001)
+                continue
+            ring_buffer.extend(data[:, ind:ind+buffer_size])
+            udp_queue.put((ring_buffer, ring_buffer.samples_num, time.time()))
             ind += buffer_size
         else:
             break
 
 
+class StreamingRingBuffer(object):
+    # Fixed capacity (channels x window) ring buffer. Each sample is written twice (at ind and ind + window), so
+    # any window of the last samples is a contiguous view. Samples are indexed by their absolute number.
+    def __init__(self, channels_num, window):
+        self.data = np.zeros((channels_num, 2 * window))
+        self.window = window
+        self.samples_num = 0
+        self.consumed_samples_num = 0
+        self.dropped_samples_num = 0
+        self.latencies = []
+
+    def extend(self, block):
+        block = block.reshape((self.data.shape[0], -1))
+        if block.shape[1] > self.window:
+            self.samples_num += block.shape[1] - self.window
+            block = block[:, -self.window:]
+        inds = (self.samples_num + np.arange(block.shape[1])) % self.window
+        self.data[:, inds] = block
+        self.data[:, inds + self.window] = block
+        self.samples_num += block.shape[1]
+
+    def view(self, start, end):
+        if end - start > self.window or start < self.samples_num - self.window:
+            return None
+        offset = start % self.window
+        return self.data[:, offset:offset + end - start]
+
+    def consume(self, end, put_time=None, max_samples_num=None, catch_up=False):
+        # Returns a copy of the samples that weren't consumed yet, up to end, as the reader keeps writing to the buffer.
+        # Up to max_samples_num samples are taken, the first ones, or the last ones if catch_up (the rest are dropped)
+        window = min(self.window, max_samples_num) if catch_up and max_samples_num is not None else self.window
+        start = max(self.consumed_samples_num, end - window)
+        if max_samples_num is not None:
+            end = min(end, start + max_samples_num)
+        self.dropped_samples_num += start - self.consumed_samples_num
+        self.consumed_samples_num = end
+        if put_time is not None:
+            self.latencies.append(time.time() - put_time)
+            self.latencies = self.latencies[-1000:]
+        data = self.view(start, end) if end > start else None
+        return data.copy() if data is not None else None
+
+    def stats(self):
+        return dict(samples=self.samples_num, dropped=self.dropped_samples_num,
+                    latency=np.mean(self.latencies) if len(self.latencies) > 0 else 0)
+
+
+def calc_channels_indices(channels_num, good_channels, bad_channels, no_channels):
+    # The same selection as zeroing the bad channels, deleting the no_channels and then taking the good ones
+    channels_inds = np.delete(np.arange(channels_num), no_channels)
+    if len(good_channels) > 0:
+        channels_inds = channels_inds[good_channels]
+    return channels_inds, np.in1d(channels_inds, bad_channels)
+
+
 def udp_reader(udp_queue, while_termination_func, **kargs):
     import socket
 
@@ -219,11 +309,13 @@ def udp_reader(udp_queue, while_termination_func, **kargs):
     multicast_group = kargs.get('multicast_group', '1.1.1.1')
     multicast = kargs.get('multicast', True)
     timeout = kargs.get('timeout', 0.1)
+    window = kargs.get('ring_buffer_window', 10000)
     print('udp_reader:', server, port, multicast_group, buffer_size, multicast, timeout)
     if multicast:
         sock = bind_to_multicast(port, multicast_group)
     else:
         sock = bind_to_server(server, port)
+    sock.settimeout(timeout)
 
     #todo:
     # 1) calc good channels on the fly?
@@ -237,89 +329,74 @@ def udp_reader(udp_queue, while_termination_func, **kargs):
     no_channels = kargs.get('no_channels', '')
     no_channels = list(map(mu.to_int, no_channels.split(','))) if bad_channels != '' else []
 
-    buffer = []
+    # https://docs.scipy.org/doc/numpy/user/basics.byteswapping.html
+    # The packets are float64 (little-endian) samples of all the channels
+    packet = np.zeros(2048 * 16 // 8, dtype=np.float64)
+    packet_view = memoryview(packet).cast('B')
+    ring_buffer, channels_inds, bad_mask = None, None, None
     prev_val = None
-    mat_len = 0
-    first_message = True
-    now = time.time()
-    prev_value = None
+    batch_start = 0
 
     while while_termination_func():
         try:
-            sock.settimeout(timeout)
             if multicast:
-                next_val, address = sock.recvfrom(2048)
-            else:
-                next_val = sock.recv(2048 * 16)
-        except socket.timeout as e:
-            if e.args[0] == 'timed out':
-                # print('!!! timed out !!!')
-                if prev_val is None and mat_len > 0:
-                    prev_val = np.zeros((mat_len, 1))
-                else:
-                    continue
-                next_val = prev_val
-            else:
-                print('!!! {} !!!'.format(e))
-                raise Exception(e)
-        else:
-            # https://docs.scipy.org/doc/numpy/user/basics.byteswapping.html
-            # data = pnet(socket,'read',packetSize,dtype,'intel');
-            # big-endian:
-            # x = np.ndarray(shape=(len(next_val) / 2,), dtype='>f8', buffer=next_val)
-            # dt = np.dtype(np.float64).newbyteorder('>')
-            # x = np.frombuffer(next_val, dtype=dt)
-            next_val = np.frombuffer(next_val, dtype=np.dtype(np.float64)).copy() #.reshape(14, 100)[10:, :]
-            next_val[bad_channels] = 0
-            if len(no_channels) > 0:
-                next_val = np.delete(next_val, no_channels, axis=0)
-            if good_channels:
-                next_val = next_val[good_channels]
-
-            if np.allclose(next_val, 0):
-                continue
-            if prev_val is not None and np.allclose(next_val.ravel(), prev_val.ravel()):
-                continue
-            prev_val = next_val.copy()
-            print('New packet! ({:.5f}s): {}'.format(next_val, time.time() - now, next_val))
-            now = time.time()
-
-            # print(next_val[0])
-            # next_val = next_val.decode(sys.getfilesystemencoding(), 'ignore')
-            # next_val = np.array([mu.to_float(f, 0.0) for f in next_val.split(',')])
-            if first_message:
-                mat_len = len(next_val)
-                first_message = False
+                nbytes, address = sock.recvfrom_into(packet_view)
             else:
-                if len(next_val) != mat_len:
-                    pass
-                    # print('Wrong message len! {}'.format(len(next_val)))
-            # next_val = next_val[:mat_len]
-            next_val = next_val[..., np.newaxis]
-
-        try:
-            buffer = next_val if buffer == [] else np.hstack((buffer, next_val))
-        except:
-            # todo: transpose first if needed
-            buffer = next_val if buffer == [] else np.hstack((buffer, next_val.T))
-        # buffer.append(next_val)
-        if buffer.shape[1] >= buffer_size:
-        # if len(buffer) >= buffer_size:
-            # print('{} took {:.5f}s {}'.format('udp_reader', time.time() - now, buffer.shape[1]))
-            # print('udp_reader: ', datetime.now())
-            # zeros_indices = np.where(np.all(buffer == 0, 1))[0]
-            # buffer = buffer[zeros_indices]
-            udp_queue.put(buffer)
-            buffer = []
+                nbytes = sock.recv_into(packet_view)
+        except socket.timeout:
+            continue
+        channels_num = nbytes // 8
+        if ring_buffer is None:
+            channels_inds, bad_mask = calc_channels_indices(channels_num, good_channels, bad_channels, no_channels)
+            ring_buffer = StreamingRingBuffer(len(channels_inds), window)
+        elif channels_num <= channels_inds[-1]:
+            # print('Wrong message len! {}'.format(channels_num))
+            continue
+        next_val = packet[channels_inds]
+        next_val[bad_mask] = 0
+        if np.allclose(next_val, 0):
+            continue
+        if prev_val is not None and np.allclose(next_val, prev_val):
+            continue
+        prev_val = next_val
+        ring_buffer.extend(next_val)
+        if ring_buffer.samples_num - batch_start >= buffer_size:
+            udp_queue.put((ring_buffer, ring_buffer.samples_num, time.time()))
+            batch_start = ring_buffer.samples_num
+
+
+def get_streaming_data(one_batch=False):
+    # Takes the readers' (ring_buffer, samples_num, time) messages. In udp streaming all the waiting messages are
+    # taken at once, so the graph catches up with the stream, up to the graph's max_steps samples. The skipped samples
+    # are counted as dropped.
+    message, last_message = None, None
+    while True:
+        message = mu.queue_get(StreamingPanel.udp_queue)
+        if message is None:
+            break
+        last_message = message
+        if one_batch:
+            break
+    if last_message is None:
+        return None
+    ring_buffer, samples_num, put_time = last_message
+    StreamingPanel.ring_buffer = ring_buffer
+    if one_batch:
+        return ring_buffer.consume(samples_num, put_time, bpy.context.scene.streaming_buffer_size)
+    return ring_buffer.consume(samples_num, put_time, StreamingPanel.max_steps, catch_up=True)
 
 
 def save_cycle():
-    if bpy.context.scene.save_streaming:
+    ring_buffer = StreamingPanel.ring_buffer
+    if bpy.context.scene.save_streaming and ring_buffer is not None:
         streaming_fol = datetime.strftime(datetime.now(), '%Y-%m-%d')
         output_fol = op.join(mu.get_user_fol(), 'electrodes', 'streaming', streaming_fol)
         output_fname = 'streaming_data_{}.npy'.format(datetime.strftime(datetime.now(), '%H-%M-%S'))
         mu.make_dir(output_fol)
-        np.save(op.join(output_fol, output_fname), StreamingPanel.cycle_data)
+        cycle_start = max(StreamingPanel.cycle_start, ring_buffer.consumed_samples_num - ring_buffer.window)
+        cycle_data = ring_buffer.view(cycle_start, ring_buffer.consumed_samples_num)
+        if cycle_data is not None:
+            np.save(op.join(output_fol, output_fname), cycle_data)
 
 
 def get_electrodes_data():
@@ -329,8 +406,7 @@ def get_electrodes_data():
         if fcurve_ind == 0:
             max_steps = min([len(fcurve.keyframe_points), StreamingPanel.max_steps]) - 2
             data = np.zeros((len(fcurves), max_steps))
-        for t in range(max_steps):
-            data[fcurve_ind, t] = fcurve.keyframe_points[t].co[1]
+        data[fcurve_ind] = get_fcurve_co(fcurve)[:max_steps, 1]
     return data
 
 
@@ -393,7 +469,9 @@ class StreamButton(bpy.types.Operator):
                         port=bpy.context.scene.streaming_server_port,
                         timeout=bpy.context.scene.timeout,
                         multicast=bpy.context.scene.multicast,
-                        mat_len=len(bpy.data.objects['Deep_electrodes'].children))
+                        mat_len=len(bpy.data.objects['Deep_electrodes'].children),
+                        ring_buffer_window=StreamingPanel.max_steps + 10 * bpy.context.scene.streaming_buffer_size)
+            StreamingPanel.ring_buffer, StreamingPanel.cycle_start = None, 0
             if bpy.context.scene.stream_type == 'offline':
                 config = mu.read_config_ini(op.join(
                     mu.get_user_fol(), 'electrodes', 'streaming', bpy.context.scene.logs_folders))
@@ -420,15 +498,16 @@ class StreamButton(bpy.types.Operator):
 
         if event.type in {'RIGHTMOUSE', 'ESC'}:
             StreamingPanel.is_streaming = False
+            if StreamingPanel.ring_buffer is not None:
+                print('Streaming: {}'.format(StreamingPanel.ring_buffer.stats()))
             bpy.context.scene.update()
             self.cancel(context)
             return {'PASS_THROUGH'}
 
         if event.type == 'TIMER':
             if StreamingPanel.is_streaming and time.time() - self._time > bpy.context.scene.streaming_buffer_size / 1000.0:
-                print(time.time() - self._time)
                 self._time = time.time()
-                data = mu.queue_get(StreamingPanel.udp_queue)
+                data = get_streaming_data(one_batch=bpy.context.scene.stream_type == 'offline')
                 if not data is None:
                     # if len(np.where(data)[0]) > 0:
                     #     print('spike!!!!!')
@@ -485,6 +564,9 @@ def streaming_draw(self, context):
     layout.prop(context.scene, 'streaming_window_length', text='Window length')
     layout.prop(context.scene, 'stim_length', text='Stim length')
     layout.prop(context.scene, 'electrodes_sep', text='Curves separation')
+    if StreamingPanel.ring_buffer is not None:
+        stats = StreamingPanel.ring_buffer.stats()
+        layout.label(text='Dropped samples: {}, latency: {:.3f}s'.format(stats['dropped'], stats['latency']))
 
 
 bpy.types.Scene.streaming_buffer_size = bpy.props.IntProperty(default=100, min=1)
@@ -525,7 +607,8 @@ class StreamingPanel(bpy.types.Panel):
     electrodes_file = None
     electrodes_data = None
     time = datetime.now()
-    electrodes_names, electrodes_conditions, offline_data, cycle_data = [], [], [], []
+    electrodes_names, electrodes_conditions, offline_data = [], [], []
+    ring_buffer, cycle_start = None, 0
     data_max, data_min, electrodes_colors_ratio = 0, 0, 1
 
     def draw(self, context):
@@ -594,8 +677,9 @@ def init_electrodes_fcurves(window_length=2500):
             if fcurve_ind == 0:
                 # max_steps = min([len(fcurve.keyframe_points), StreamingPanel.max_steps]) - 1
                 max_steps = len(fcurve.keyframe_points) - 1
-            for t in range(max_steps):
-                fcurve.keyframe_points[t].co[1] = 0
+            co = get_fcurve_co(fcurve)
+            co[:max_steps, 1] = 0
+            set_fcurve_co(fcurve, co)
 
 
 def init_electrodes_animation(window_length=2500):
@@ -108,26 +108,8 @@ def find_vertex_index_and_mesh_closest_to_cursor(cursor=None, hemis=None, use_sh
     for obj_name in hemis:
         obj = bpy.data.objects[obj_name]
         co_find = cursor * obj.matrix_world.inverted()
-        mesh = obj.data
-        size = len(mesh.vertices)
-        kd = mathutils.kdtree.KDTree(size)
-
-        if use_shape_keys:
-            me = obj.to_mesh(bpy.context.scene, True, 'PREVIEW')
-            for i, v in enumerate(mesh.vertices):
-                try:
-                    kd.insert(me.vertices[i].co, i)
-                except:
-                    # in flat map not all the vertices exist
-                    # todo handle the case where the brain is sliced and the user click the plane with the image.
-                    print('find_vertex_index_and_mesh_closest_to_cursor: exception in the use_shape_keys loop')
-                    break
-            bpy.data.meshes.remove(me)
-        else:
-            for i, v in enumerate(mesh.vertices):
-                kd.insert(v.co, i)
-
-        kd.balance()
+        # todo handle the case where the brain is sliced and the user click the plane with the image.
+        kd = mu.get_obj_kd_tree(obj, use_shape_keys)
         # print(obj.name)
         for (co, index, dist) in kd.find_n(co_find, 1):
             # print('cursor at {} ,vertex {}, index {}, dist {}'.format(str(co_find), str(co), str(index), str(dist)))
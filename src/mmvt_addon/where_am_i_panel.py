@@ -126,6 +126,7 @@ def where_i_am_draw(self, context):
         col.prop(context.scene, 'find_closest_label_on_click', text='Find each click on brain')
         if WhereAmIPanel.labels_contours is not None:
             col.prop(context.scene, 'plot_closest_label_contour', text="Plot label's contour")
+    layout.prop(context.scene, 'build_kd_trees_on_load', text='Prepare the closest vertex search on load')
     layout.operator(ClearWhereAmI.bl_idname, text="Clear", icon='PANEL_CLOSE')
 
 
@@ -316,14 +317,31 @@ def apply_trans(trans, points):
     return np.array([np.dot(trans, np.append(p, 1))[:3] for p in points])
 
 
-def find_closest_obj(search_also_for_subcorticals=True):
-    distances, names, indices = [], [], []
-
+def get_closest_obj_parents_names(search_also_for_subcorticals=True):
     parent_objects_names = ['Cortex-lh', 'Cortex-rh']
     if _addon().is_inflated():
         parent_objects_names = ['Cortex-inflated-lh', 'Cortex-inflated-rh']
     if search_also_for_subcorticals:
         parent_objects_names.append('Subcortical_structures')
+    return parent_objects_names
+
+
+def init_kd_trees_cache():
+    # Builds the KD-trees of the hemis and the labels objects up front, instead of on the first click
+    objects_names = list(mu.HEMIS)
+    for parent_object_name in get_closest_obj_parents_names():
+        parent_object = bpy.data.objects.get(parent_object_name, None)
+        if parent_object is not None:
+            objects_names.extend([obj.name for obj in parent_object.children if 'unknown' not in obj.name])
+    mu.init_kd_trees_cache(objects_names)
+    # The inflated hemis are queried with their shape keys, like in appearance_panel.snap_cursor
+    mu.init_kd_trees_cache(mu.INF_HEMIS, use_shape_keys=True)
+
+
+def find_closest_obj(search_also_for_subcorticals=True):
+    distances, names, indices = [], [], []
+
+    parent_objects_names = get_closest_obj_parents_names(search_also_for_subcorticals)
     for parent_object_name in parent_objects_names:
         parent_object = bpy.data.objects.get(parent_object_name, None)
         if parent_object is None:
@@ -343,22 +361,14 @@ def find_closest_obj(search_also_for_subcorticals=True):
                 cursor = bpy.context.object.location
 
             co_find = cursor * obj.matrix_world.inverted()
-
-            mesh = obj.data
-            size = len(mesh.vertices)
-            kd = mathutils.kdtree.KDTree(size)
-
-            for i, v in enumerate(mesh.vertices):
-                kd.insert(v.co, i)
-
-            kd.balance()
+            if 'unknown' in obj.name:
+                continue
 
             # Find the closest point to the 3d cursor
-            for (co, index, dist) in kd.find_n(co_find, 1):
-                if 'unknown' not in obj.name:
-                    distances.append(dist)
-                    names.append(obj.name)
-                    indices.append(index)
+            co, index, dist = mu.get_obj_kd_tree(obj).find(co_find)
+            distances.append(dist)
+            names.append(obj.name)
+            indices.append(index)
 
     # print(np.argmin(np.array(distances)))
     min_index = np.argmin(np.array(distances))
@@ -383,20 +393,23 @@ def find_closest_label(atlas=None, plot_contour=True):
     hemi = 'rh' if 'rh' in hemi else 'lh'
     if atlas is None:
         atlas = bpy.context.scene.subject_annot_files
-    annot_fname = op.join(subjects_dir, mu.get_user(), 'label', '{}.{}.annot'.format(hemi, atlas))
-    if not op.isfile(annot_fname):
-        annot_fname = op.join(mu.get_user_fol(), 'labels', '{}.{}.annot'.format(hemi, atlas))
-    if op.isfile(annot_fname):
-        labels = mu.read_labels_from_annot(annot_fname)
-        vert_labels = [l for l in labels if vertex_ind in l.vertices]
-        if len(vert_labels) > 0:
-            label = vert_labels[0]
-            bpy.context.scene.closest_label_output = label.name
-            if plot_contour:
-                plot_closest_label_contour(label.name, hemi)
-        return label.name
-    else:
-        print("Can't find the annotation file for atlas {}!".format(atlas))
+    # The vertices labels lookup is created in the preprocessing (labels_utils.create_vertices_labels_ids_lookup),
+    # or here from the annotation file
+    if not op.isfile(mu.get_vertices_labels_ids_fname(mu.get_user_fol(), atlas, hemi)):
+        annot_fname = op.join(subjects_dir, mu.get_user(), 'label', '{}.{}.annot'.format(hemi, atlas))
+        if not op.isfile(annot_fname):
+            annot_fname = op.join(mu.get_user_fol(), 'labels', '{}.{}.annot'.format(hemi, atlas))
+        if not op.isfile(annot_fname):
+            print("Can't find the annotation file for atlas {}!".format(atlas))
+            return
+        vertices_labels_ids, labels_names = mu.calc_vertices_labels_ids_from_annot(annot_fname)
+        mu.save_vertices_labels_ids(mu.get_user_fol(), atlas, hemi, vertices_labels_ids, labels_names)
+    label_name = mu.find_vertex_label(mu.get_user_fol(), atlas, hemi, vertex_ind)
+    if label_name != '':
+        bpy.context.scene.closest_label_output = label_name
+        if plot_contour:
+            plot_closest_label_contour(label_name, hemi)
+    return label_name
 
 
 def plot_closest_label_contour(label, hemi):
@@ -874,6 +887,9 @@ bpy.types.Scene.find_closest_label_on_click = bpy.props.BoolProperty(default=Fal
     description='Finds the closest label each time an area clicked (right click) on the brain')
 bpy.types.Scene.plot_closest_label_contour = bpy.props.BoolProperty(default=False,
     description='Plots the selected label’s contour')
+bpy.types.Scene.build_kd_trees_on_load = bpy.props.BoolProperty(default=False,
+    description='Builds the search trees of the brain and labels objects when the subject is loaded,\n'
+                'instead of on the first click')
 
 # bpy.types.Scene.where_am_i_atlas = bpy.props.StringProperty()
 
@@ -957,6 +973,8 @@ def init(addon):
             WhereAmIPanel.gray_colormap = np.load(gray_colormap_fname)
 
         WhereAmIPanel.addon = addon
+        if bpy.context.scene.build_kd_trees_on_load:
+            init_kd_trees_cache()
         WhereAmIPanel.init = True
         WhereAmIPanel.run_slices_listener = False
         init_slices()
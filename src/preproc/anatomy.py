@@ -321,7 +321,7 @@ def calc_faces_verts_dic(subject, atlas, overwrite=False):
             out_files.extend(faces_verts_dic_fnames)
 
     for ply_file, out_file in zip(ply_files, out_files):
-        if not overwrite and op.isfile(out_file):
+        if not overwrite and utils.faces_verts_lookup_exists(out_file):
             # print('{} already exist.'.format(out_file))
             continue
         # ply_file = op.join(SUBJECTS_DIR, subject,'surf', '{}.pial.ply'.format(hemi))
@@ -359,9 +359,9 @@ def load_bem_surfaces(subject, include_seghead=True, overwrite=False):
         if not op.isfile(ply_fname) or overwrite:
             utils.write_ply_file(verts, faces, ply_fname)
         faces_verts_fname = op.join(MMVT_DIR, subject, 'surf', '{}_faces_verts.npy'.format(watershed_name))
-        if not op.isfile(faces_verts_fname):
+        if not utils.faces_verts_lookup_exists(faces_verts_fname):
             utils.calc_ply_faces_verts(verts, faces, faces_verts_fname, overwrite, watershed_name)
-        ret = ret and op.isfile(ply_fname) and op.isfile(faces_verts_fname)
+        ret = ret and op.isfile(ply_fname) and utils.faces_verts_lookup_exists(faces_verts_fname)
     return ret
 
 
@@ -516,8 +516,7 @@ def parcelate_cortex(subject, atlas, overwrite=False, overwrite_annotation=False
     utils.make_dir(op.join(MMVT_DIR, subject, 'labels'))
     labels_to_annot(subject, atlas, overwrite_annotation, surf_type, overwrite_vertices_labels_lookup,
                     n_jobs=n_jobs)
-    vertices_labels_ids_lookup = lu.create_vertices_labels_lookup(
-        subject, atlas, True, overwrite_vertices_labels_lookup)
+    vertices_labels_ids_lookup = lu.create_vertices_labels_ids_lookup(subject, atlas, overwrite_vertices_labels_lookup)
     params = []
     for surface_type in ['pial', 'inflated']:
         files_exist = True
@@ -834,9 +833,10 @@ def calc_labeles_contours(subject, atlas, overwrite=True, verbose=False):
         print('calc_labeles_contours: You should first run create_spatial_connectivity')
         create_spatial_connectivity(subject)
         return calc_labeles_contours(subject, atlas, overwrite, verbose)
-    vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas, False, overwrite)
+    vertices_labels_ids_lookup = lu.create_vertices_labels_ids_lookup(subject, atlas, overwrite)
     for hemi in utils.HEMIS:
         verts, _ = utils.read_pial(subject, MMVT_DIR, hemi)
+        vertices_labels_ids = vertices_labels_ids_lookup[hemi][0]
         contours = np.zeros((len(verts)))
         vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
         # labels = lu.read_hemi_labels(subject, SUBJECTS_DIR, atlas, hemi)
@@ -848,7 +848,7 @@ def calc_labeles_contours(subject, atlas, overwrite=True, verbose=False):
             for vert_ind, vert in enumerate(label.vertices):
                 if vert >= len(verts):
                     continue
-                nei = set([vertices_labels_lookup[hemi].get(v, '') for v in vertices_neighbors[vert]]) - set([''])
+                nei = set(vertices_labels_ids[list(vertices_neighbors[vert])]) - set([-1])
                 contours[vert] = label_ind + 1 if len(nei) > 1 else 0
                 if verbose:
                     label_nei[vert_ind] = contours[vert]
@@ -1428,7 +1428,7 @@ def create_skull_surfaces(subject, surfaces_fol_name='bem', verts_in_ras=True):
             print('{}: {}'.format(k, message))
 
     return all([op.isfile(op.join(skull_fol, '{}.ply'.format(skull_surf))) and \
-                op.isfile(op.join(skull_fol, 'faces_verts_{}.npy'.format(skull_surf))) \
+                utils.faces_verts_lookup_exists(op.join(skull_fol, 'faces_verts_{}.npy'.format(skull_surf))) \
                 for skull_surf in ['inner_skull', 'outer_skull']])
 
 
@@ -1465,7 +1465,15 @@ def main(subject, remote_subject_dir, org_args, flags):
 
     if utils.should_run(args, 'create_surfaces'):
         # *) convert rh.pial and lh.pial to rh.pial.ply and lh.pial.ply
-        flags['create_surfaces'] = create_surfaces(subject, args.surf_type, overwrite=args.overwrite_hemis_ply)
+        flags['create_surfaces'] = pu.run_cached_step(
+            subject, args, 'create_surfaces',
+            lambda overwrite: create_surfaces(subject, args.surf_type, overwrite=overwrite),
+            args.overwrite_hemis_ply, args_keys=('surf_type',),
+            inputs=[op.join(SUBJECTS_DIR, subject, 'surf', '{}.{}'.format(hemi, surf_type))
+                    for hemi in utils.HEMIS for surf_type in args.surf_type],
+            # Only the surfaces create_surfaces checks, the dural surface is optional
+            outputs=[op.join(MMVT_DIR, subject, 'surf', '{}.{}.{}'.format(hemi, surf_type, file_type))
+                     for hemi in utils.HEMIS for surf_type in ('pial', 'inflated') for file_type in ('ply', 'npz')])
 
     if utils.should_run(args, 'create_annotation'):
         # *) Create annotation file from fsaverage
@@ -1486,7 +1494,12 @@ def main(subject, remote_subject_dir, org_args, flags):
 
     if utils.should_run(args, 'calc_faces_verts_dic'):
         # *) Create a dictionary for verts and faces for both hemis
-        flags['faces_verts'] = calc_faces_verts_dic(subject, args.atlas, args.overwrite_faces_verts)
+        flags['faces_verts'] = pu.run_cached_step(
+            subject, args, 'calc_faces_verts_dic', lambda overwrite: calc_faces_verts_dic(subject, args.atlas, overwrite),
+            args.overwrite_faces_verts, args_keys=('atlas',),
+            inputs=[op.join(MMVT_DIR, subject, 'surf', '{}.pial.npz'.format(hemi)) for hemi in utils.HEMIS],
+            outputs=[utils.faces_verts_lookup_fname(op.join(MMVT_DIR, subject, 'faces_verts_{}.npy'.format(hemi)))
+                     for hemi in utils.HEMIS])
 
     if utils.should_run(args, 'save_labels_vertices'):
         # *) Save the labels vertices for labels plotting
@@ -1504,7 +1517,16 @@ def main(subject, remote_subject_dir, org_args, flags):
         flags['connectivity'] = create_spatial_connectivity(subject)
 
     if utils.should_run(args, 'calc_labeles_contours'):
-        flags['calc_labeles_contours'] = calc_labeles_contours(subject, args.atlas, args.overwrite_labels_contours)
+        flags['calc_labeles_contours'] = pu.run_cached_step(
+            subject, args, 'calc_labeles_contours', lambda overwrite: calc_labeles_contours(subject, args.atlas, overwrite),
+            args.overwrite_labels_contours, args_keys=('atlas',),
+            inputs=utils.flat_list([[
+                op.join(MMVT_DIR, subject, 'surf', '{}.pial.npz'.format(hemi)),
+                op.join(MMVT_DIR, subject, 'verts_neighbors_{}.pkl'.format(hemi)),
+                utils.get_vertices_labels_ids_fname(op.join(MMVT_DIR, subject), args.atlas, hemi)]
+                for hemi in utils.HEMIS]),
+            outputs=[op.join(MMVT_DIR, subject, 'labels', '{}_contours_{}.npz'.format(args.atlas, hemi))
+                     for hemi in utils.HEMIS])
 
     if utils.should_run(args, 'calc_labels_center_of_mass'):
         # *) Calc the labels center of mass
@@ -26,6 +26,8 @@ STAT_AVG, STAT_DIFF = range(2)
 STAT_NAME = {STAT_DIFF: 'diff', STAT_AVG: 'avg'}
 HEMIS_WITHIN, HEMIS_BETWEEN = range(2)
 ROIS_TYPE, ELECTRODES_TYPE = range(2)
+# Max number of elements in the temporary arrays of the vectorized connectivity functions
+MAX_CHUNK_SIZE = 5e7
 
 #todo: Add the necessary parameters
 # args.conditions, args.mat_fname, args.t_max, args.stat, args.threshold)
@@ -347,36 +349,25 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
             connectivity_method = 'COH'
     if not op.isfile(output_mat_fname) or args.recalc_connectivity:
         if 'corr' in args.connectivity_method:
-            conn = np.zeros((data.shape[0], data.shape[0], windows_num))
-            if labels_extract_mode.startswith('pca_'):
-                comps_num = int(labels_extract_mode.split('_')[1])
-                dims = (data.shape[0], data.shape[0], windows_num, comps_num * 2, comps_num * 2)
-                conn = np.zeros(dims)
             if data.ndim == 3 and not labels_extract_mode.startswith('pca_') or data.ndim == 4:
+                conn = np.zeros((data.shape[0], data.shape[0], windows_num))
                 for w in range(windows_num):
                     conn[:, :, w] = np.corrcoef(data[:, :, w])
+            elif not labels_extract_mode.startswith('pca_'):
+                backup(output_mat_fname)
+                conn = calc_sliding_windows_corr(data, windows[:windows_num], output_mat_fname)
             else:
-                if not labels_extract_mode.startswith('pca_'):
-                    for w in range(windows_num):
-                        conn[:, :, w] = np.corrcoef(data[:, windows[w, 0]:windows[w, 1]])
-                        np.fill_diagonal(conn[:, :, w], 0)
-                else:
-                    params = []
-                    for w in range(windows_num):
-                        w1, w2 = int(windows[w, 0]), int(windows[w, 1])
-                        data_w = data[:, w1:w2]
-                        params.append((data_w, comps_num))
-                    # params = [(data, w, windows, comps_num) for w in range(windows_num)]
-                    chunks = utils.chunks(list(enumerate(params)), windows_num / args.n_jobs)
-                    results = utils.run_parallel(_corr_matrix_parallel, chunks, args.n_jobs)
-                    for chunk in results:
-                        for w, con in chunk.items():
-                            conn[:, :, w] = con
+                comps_num = int(labels_extract_mode.split('_')[1])
+                conn = np.zeros((data.shape[0], data.shape[0], windows_num, comps_num * 2, comps_num * 2))
+                for w in range(windows_num):
+                    w1, w2 = int(windows[w, 0]), int(windows[w, 1])
+                    conn[:, :, w] = corr_matrix(data[:, w1:w2], comps_num)
             if conn.shape[2] == 1:
-                conn = conn.squeeze()
-            backup(output_mat_fname)
-            print('Saving {}, {}'.format(output_mat_fname, conn.shape))
-            np.save(output_mat_fname, conn)
+                conn = np.array(conn).squeeze()
+            if not isinstance(conn, np.memmap) or conn.ndim != 3:
+                backup(output_mat_fname)
+                print('Saving {}, {}'.format(output_mat_fname, conn.shape))
+                np.save(output_mat_fname, conn)
             connectivity_method = 'Pearson corr'
 
         elif 'pli' in args.connectivity_method:
@@ -390,14 +381,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                     conn_data = np.zeros((windows_num, cond_data.shape[0], args.windows_length))
                     for w in range(windows_num):
                         conn_data[w] = cond_data[:, windows[w, 0]:windows[w, 1]]
-                indices = np.array_split(np.arange(windows_num), args.n_jobs)
-                # chunks = utils.chunks(list(enumerate(conn_data)), windows_num / args.n_jobs)
-                chunks = [(conn_data[chunk_indices], chunk_indices, len(labels_names), args.windows_length)
-                      for chunk_indices in indices]
-                results = utils.run_parallel(_pli_parallel, chunks, args.n_jobs)
-                for chunk in results:
-                    for w, con in chunk.items():
-                        conn[:, :, w, cond_ind] = con
+                conn[:, :, :, cond_ind] = calc_windows_pli(conn_data[:windows_num])
                 # output_mat_fname = op.join(utils.get_parent_fol(output_fname), '{}_{}.npy'.format(
                 #     utils.namebase(output_mat_fname), cond_name))
                 backup(output_mat_fname)
@@ -440,12 +424,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                     conn = np.load(conn_fname)
                 if not op.isfile(conn_fname) or conn.shape[0] != data.shape[0]:
                     conn = np.zeros(corr.shape)
-                    params = [(corr[:, :, w]) for w in range(windows_num)]
-                    chunks = utils.chunks(list(enumerate(params)), windows_num / args.n_jobs)
-                    results = utils.run_parallel(_mi_parallel, chunks, args.n_jobs)
-                    for chunk in results:
-                        for w, con in chunk.items():
-                            conn[:, :, w] = con
+                    conn[:, :, :windows_num] = mi(corr[:, :, :windows_num])
                     backup(conn_fname)
                     np.save(conn_fname, conn)
             if 'mi_vec' in args.connectivity_method and corr.ndim == 5:
@@ -454,14 +433,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                     conn = np.load(conn_fname)
                 if not op.isfile(conn_fname) or conn.shape[0] != data.shape[0]:
                     # comps_num = int(labels_extract_mode.split('_')[1])
-                    dims = (data.shape[0], data.shape[0], windows_num)
-                    conn = np.zeros(dims)
-                    params = [(corr[:, :, w]) for w in range(windows_num)]
-                    chunks = utils.chunks(list(enumerate(params)), windows_num / args.n_jobs)
-                    results = utils.run_parallel(_mi_vec_parallel, chunks, args.n_jobs)
-                    for chunk in results:
-                        for w, con in chunk.items():
-                            conn[:, :, w] = con
+                    conn = mi_vec(corr[:, :, :windows_num])
                     backup(conn_fname)
                     np.save(conn_fname, conn)
             connectivity_method = 'MI'
@@ -542,38 +514,81 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
     return ret
 
 
+def calc_sliding_windows_corr(data, windows, output_fname, dtype=np.float32, recalc_sums_every=100):
+    # Pearson correlation of data (channels x time) in each window, written straight to a memory-mapped npy.
+    # The running sums and cross-products are updated only with the samples that enter and leave the window when it
+    # slides, and are recalculated from scratch every recalc_sums_every windows to avoid accumulating errors.
+    # The output is (channels x channels x windows).
+    N = data.shape[0]
+    windows_num = len(windows)
+    # Centering the data keeps the running sums numerically stable
+    data = data - np.mean(data, axis=1, keepdims=True)
+    shape = (N, N, windows_num)
+    print('Writing the sliding windows correlation to {} {}'.format(output_fname, shape))
+    conn = np.lib.format.open_memmap(output_fname, mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+    sums, cross_prods = None, None
+    for w in range(windows_num):
+        w1, w2 = int(windows[w, 0]), int(windows[w, 1])
+        if sums is None or w % recalc_sums_every == 0 or w1 >= prev_w2 or w1 < prev_w1 or w2 < prev_w2:
+            win_data = data[:, w1:w2]
+            sums, cross_prods = np.sum(win_data, axis=1), np.dot(win_data, win_data.T)
+        else:
+            old_data, new_data = data[:, prev_w1:w1], data[:, prev_w2:w2]
+            sums += np.sum(new_data, axis=1) - np.sum(old_data, axis=1)
+            cross_prods += np.dot(new_data, new_data.T) - np.dot(old_data, old_data.T)
+        prev_w1, prev_w2 = w1, w2
+        L = w2 - w1
+        cov = cross_prods - np.outer(sums, sums) / L
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stds = np.sqrt(np.diag(cov))
+            corr = np.clip(cov / np.outer(stds, stds), -1, 1)
+        np.fill_diagonal(corr, 0)
+        conn[:, :, w] = corr
+    conn.flush()
+    return conn
+
+
 def pli(data, channels_num, window_length):
     try:
-        from scipy.signal import hilbert
         if data.shape[0] != channels_num:
             data = data.T
-        data_hil = hilbert(data)
-        # if data_hil.shape != (channels_num, window_length):
+        # if data.shape != (channels_num, window_length):
         #     raise Exception('PLI: Wrong dimentions!')
-        m = np.zeros((channels_num, channels_num))
-        for i in range(channels_num):
-            for j in range(channels_num):
-                if i < j:
-                    m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[i] / data_hil[j]))))
-                    # m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[:, i] / data_hil[:, j]))))
-        return m + m.T
+        return calc_windows_pli(data[np.newaxis])[:, :, 0]
     except:
         print(traceback.format_exc())
         return None
 
 
-def _pli_parallel(p):
-    res = {}
-    conn_data, indices, channels_num, window_length = p
-    # for window_ind, window in windows_chunk:
-    for window_ind, window in zip(indices, conn_data):
-        print('PLI: Window ind {}'.format(window_ind))
-        pli_val = pli(window, channels_num, window_length)
-        if not pli_val is None:
-            res[window_ind] = pli_val
-        else:
-            print('Error in PLI! windowsw ind {}'.format(window_ind))
-    return res
+def calc_windows_pli(windows_data, max_chunk_size=MAX_CHUNK_SIZE):
+    # windows_data: windows x channels x time. Returns a (channels x channels x windows) PLI matrix.
+    # sign(imag(h_i / h_j)) is the sign of imag(h_i * conj(h_j)) = imag(h_i) * real(h_j) - real(h_i) * imag(h_j),
+    # which is calculated for all the pairs of (windows chunk x channels chunk) at once.
+    from scipy.signal import hilbert
+    W, N, T = windows_data.shape
+    conn = np.zeros((N, N, W))
+    windows_chunk_len = max(1, min(W, int(max_chunk_size // (N * N * T))))
+    for w1 in range(0, W, windows_chunk_len):
+        w2 = min(w1 + windows_chunk_len, W)
+        # The analytic signal is calculated per windows chunk, so the whole windows stack isn't duplicated
+        data_hil = hilbert(windows_data[w1:w2], axis=-1)
+        hil_real, hil_imag = np.real(data_hil), np.imag(data_hil)
+        rows_chunk_len = max(1, min(N, int(max_chunk_size // ((w2 - w1) * N * T))))
+        for r1 in range(0, N, rows_chunk_len):
+            r2 = min(r1 + rows_chunk_len, N)
+            phase_diff_sign = np.sign(
+                hil_imag[:, r1:r2, np.newaxis] * hil_real[:, np.newaxis] -
+                hil_real[:, r1:r2, np.newaxis] * hil_imag[:, np.newaxis])
+            conn[r1:r2, :, w1:w2] = np.abs(np.mean(phase_diff_sign, axis=-1)).transpose([1, 2, 0])
+    return symmetrize_upper_triangle(conn)
+
+
+def symmetrize_upper_triangle(conn):
+    # Keeps only the i < j values of the (channels x channels x ...) conn, and copies them to the lower triangle
+    N = conn.shape[0]
+    upper = np.triu(np.ones((N, N), dtype=bool), 1).reshape((N, N) + (1,) * (conn.ndim - 2))
+    conn = np.where(upper, conn, 0)
+    return conn + np.swapaxes(conn, 0, 1)
 
 
 def _coh_parallel(p):
@@ -601,65 +616,45 @@ def coherence(data, sfreq, fmin, fmax):
 
 
 def corr_matrix(data, comps_num):
-    corr = np.zeros((data.shape[0], data.shape[0], comps_num * 2, comps_num * 2))
-    # w1, w2 = int(windows[w, 0]), int(windows[w, 1])
-    for i in range(data.shape[0]):
-        for j in range(data.shape[0]):
-            if i < j:
-                corr[i, j] = np.corrcoef(data[i].T, data[j].T)
-    for i in range(data.shape[0]):
-        for j in range(data.shape[0]):
-            if i > j:
-                corr[i, j] = corr[j, i]
+    # data: channels x time x comps. corr[i, j] is np.corrcoef(data[i].T, data[j].T), calculated from one
+    # correlation matrix of all the channels' components
+    N = data.shape[0]
+    comps = np.transpose(data, [0, 2, 1]).reshape((N * comps_num, -1))
+    comps = comps - np.mean(comps, axis=1, keepdims=True)
+    comps /= np.linalg.norm(comps, axis=1, keepdims=True)
+    R = np.clip(np.dot(comps, comps.T), -1, 1).reshape((N, comps_num, N, comps_num))
+    R_diag = R[np.arange(N), :, np.arange(N)]
+    corr = np.zeros((N, N, comps_num * 2, comps_num * 2))
+    corr[:, :, :comps_num, :comps_num] = R_diag[:, np.newaxis]
+    corr[:, :, :comps_num, comps_num:] = np.transpose(R, [0, 2, 1, 3])
+    corr[:, :, comps_num:, :comps_num] = np.transpose(R, [2, 0, 1, 3])
+    corr[:, :, comps_num:, comps_num:] = R_diag[np.newaxis]
+    corr[np.arange(N), np.arange(N)] = 0
+    # Like the upper triangle, the lower one is np.corrcoef(data[j].T, data[i].T) for i > j
+    lower_i, lower_j = np.tril_indices(N, -1)
+    corr[lower_i, lower_j] = corr[lower_j, lower_i]
     return corr
 
 
-def _corr_matrix_parallel(windows_chunk):
-    res = {}
-    for window_ind, window in windows_chunk:
-        print('_corr_matrix_parallel: window ind {}'.format(window_ind))
-        data_w, comps_num = window
-        res[window_ind] = corr_matrix(data_w, comps_num)
-    return res
-
-
 def mi(conn_w):
-    nch = conn_w.shape[0]
-    conn = np.zeros((nch, nch))
-    for i in range(nch):
-        for j in range(nch):
-            if i < j:
-                conn[i, j] = -0.5 * np.log(1 - conn_w[i, j] ** 2)
-    conn = conn + conn.T
-    return conn
-
-
-def _mi_parallel(windows_chunk):
-    res = {}
-    for window_ind, corr_w in windows_chunk:
-        print('_mi_parallel: window ind {}'.format(window_ind))
-        res[window_ind] = mi(corr_w)
-    return res
-
-
-def mi_vec(corr_w):
-    nch = corr_w.shape[0]
-    conn = np.zeros((nch, nch))
-    for i in range(nch):
-        for j in range(nch):
-            if i < j:
-                conn[i, j] = -0.5 * np.log(np.linalg.norm(
-                    np.eye(corr_w.shape[3]) - corr_w[i, j] * corr_w[i, j].T))
-    conn = conn + conn.T
-    return conn
-
-
-def _mi_vec_parallel(windows_chunk):
-    res = {}
-    for window_ind, corr_w in windows_chunk:
-        print('_mi_vec_parallel: window ind {}'.format(window_ind))
-        res[window_ind] = mi_vec(corr_w)
-    return res
+    # conn_w: channels x channels (x windows) correlation values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conn = -0.5 * np.log(1 - conn_w ** 2)
+    return symmetrize_upper_triangle(conn)
+
+
+def mi_vec(corr_w, max_chunk_size=MAX_CHUNK_SIZE):
+    # corr_w: channels x channels (x windows) x comps x comps correlation matrices
+    N, K = corr_w.shape[0], corr_w.shape[-1]
+    conn = np.zeros(corr_w.shape[:-2])
+    rows_chunk_len = max(1, int(max_chunk_size // (corr_w[0].size)))
+    for r1 in range(0, N, rows_chunk_len):
+        r2 = min(r1 + rows_chunk_len, N)
+        corr_chunk = corr_w[r1:r2]
+        diff = np.eye(K) - corr_chunk * np.swapaxes(corr_chunk, -1, -2)
+        with np.errstate(divide='ignore'):
+            conn[r1:r2] = -0.5 * np.log(np.sqrt(np.sum(diff ** 2, axis=(-2, -1))))
+    return symmetrize_upper_triangle(conn)
 
 
 @utils.tryit()
@@ -747,45 +742,20 @@ def calc_connectivity(data, labels, hemis, args):
     if data.ndim == 2:
         data = data[:, :, np.newaxis]
     W = data.shape[2] if 'windows' not in args or args.windows == 0 else args.windows
-    L = int((M * M + M) / 2 - M)
-    con_indices = np.zeros((L, 2))
-    con_values = np.zeros((L, W, len(args.conditions)))
-    con_names = [None] * L
-    con_type = np.zeros((L))
-    lower_rec_indices = list(utils.lower_rec_indices(M))
-    # LRI = len(lower_rec_indices)
-    for cond in range(len(args.conditions)):
-        for w in range(W):
-            # now = time.time()
-            if W > 1 and data.ndim == 4:
-                con_values[:, w, cond] = [data[i, j, w, cond] for i, j in lower_rec_indices]
-            elif data.ndim > 2:
-                con_values[:, w, cond] = [data[i, j, cond] for i, j in lower_rec_indices]
-            else:
-                con_values[:, w, cond] = [data[i, j] for i, j in lower_rec_indices]
-            # for ind, (i, j) in enumerate(lower_rec_indices):
-            #     # utils.time_to_go(now, ind, LRI, LRI/10)
-            #     if W > 1 and data.ndim == 4:
-            #         con_values[ind, w, cond] = data[i, j, w, cond]
-            #     elif data.ndim > 2:
-            #         con_values[ind, w, cond] = data[i, j, cond]
-            #     else:
-            #         con_values[ind, w, cond] = data[i, j]
+    C = len(args.conditions)
+    # The same (i, j), i > j order as utils.lower_rec_indices
+    con_indices = np.array(np.tril_indices(M, -1)).T
+    rows, cols = con_indices[:, 0], con_indices[:, 1]
+    L = len(rows)
+    if W > 1 and data.ndim == 4:
+        con_values = np.array(data[rows, cols, :W, :C], dtype=np.float64)
+    else:
+        con_values = np.tile(np.reshape(data[rows, cols, :C], (L, 1, C)).astype(np.float64), (1, W, 1))
     if len(args.conditions) > 1:
         stat_data = utils.calc_stat_data(con_values, args.stat)
     else:
         stat_data = np.squeeze(con_values)
 
-    con_indices = np.array(lower_rec_indices)
-    for ind, (i, j) in enumerate(utils.lower_rec_indices(M)):
-        try:
-            # con_indices[ind, :] = [i, j]
-            con_names[ind] = '{}-{}'.format(labels[i], labels[j])
-            con_type[ind] = HEMIS_WITHIN if hemis[i] == hemis[j] else HEMIS_BETWEEN
-        except:
-            print('error in calc_connectivity!')
-    con_indices = con_indices.astype(np.int)
-    con_names = np.array(con_names)
     data_max, data_min = utils.get_data_max_min(stat_data, args.norm_by_percentile, args.norm_percs)
     data_minmax = max(map(abs, [data_max, data_min]))
     if 'threshold_percentile' in args and args.threshold_percentile > 0:
@@ -800,11 +770,14 @@ def calc_connectivity(data, labels, hemis, args):
         # indices = np.where(np.abs(stat_data) > args.threshold)[0]
         # con_colors = con_colors[indices]
         con_indices = con_indices[indices]
-        con_names = con_names[indices]
         con_values = con_values[indices]
-        con_type  = con_type[indices]
         stat_data = stat_data[indices]
 
+    # The names and types are calculated only for the edges that passed the threshold
+    hemis = np.array(hemis)
+    con_type = np.where(hemis[con_indices[:, 0]] == hemis[con_indices[:, 1]], HEMIS_WITHIN, HEMIS_BETWEEN)
+    con_type = con_type.astype(np.float64)
+    con_names = np.array(['{}-{}'.format(labels[i], labels[j]) for i, j in con_indices])
     con_values = np.squeeze(con_values)
     # con_values = np.squeeze(stat_data)
     if 'data_max' not in args and 'data_min' not in args or args.data_max == 0 and args.data_min == 0:
@@ -887,13 +860,8 @@ def calc_electrodes_rest_connectivity(subject, args):
             windows_num = min(args.max_windows_num, windows_num)
 
         # pli_wins = 1
-        conn = np.zeros((E, E, windows_num))
         conn_data = conn_data[:windows_num]
-        chunks = utils.chunks(list(enumerate(conn_data)), windows_num / args.n_jobs)
-        results = utils.run_parallel(_pli_parallel, chunks, args.n_jobs)
-        for chunk in results:
-            for w, con in chunk.items():
-                conn[:, :, w] = con
+        conn = calc_windows_pli(conn_data)
 
         # five_cycle_freq = 5. * args.sfreq / float(conn_data.shape[2])
         # for w in range(windows_num - pli_wins):
@@ -1038,8 +1006,15 @@ def main(subject, remote_subject_dir, args, flags):
             args.overwrite_seed_data, args.n_jobs)
 
     if utils.should_run(args, 'calc_fmri_corr_degree'):
-        flags['calc_fmri_corr_degree'] = calc_fmri_corr_degree(
-            subject, args.identifier, args.connectivity_threshold, args.connectivity_method)
+        identifier = '{}_static_'.format(args.identifier) if args.identifier != '' else 'static_'
+        flags['calc_fmri_corr_degree'] = pu.run_cached_step(
+            subject, args, 'calc_fmri_corr_degree', lambda overwrite: calc_fmri_corr_degree(
+                subject, args.identifier, args.connectivity_threshold, args.connectivity_method),
+            args_keys=('identifier', 'connectivity_threshold', 'connectivity_method'),
+            inputs=[op.join(MMVT_DIR, subject, 'connectivity', 'fmri_{}{}.npy'.format(
+                identifier, args.connectivity_method[0]))],
+            outputs=[op.join(MMVT_DIR, subject, 'connectivity',  '{}{}_{}_degree.npy'.format(
+                identifier.replace('_static', ''), args.connectivity_method[0], str(args.connectivity_threshold)))])
 
 
     return flags
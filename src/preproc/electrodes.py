@@ -1260,7 +1260,8 @@ def save_electrodes_coords(subject, elecs_names, elecs_coords, good_channels=Non
     return electrodes_fname
 
 
-def snap_electrodes_to_dural(subject, snap_all=False, overwrite_snap=False, electrodes_type=None):
+def snap_electrodes_to_dural(subject, snap_all=False, overwrite_snap=False, electrodes_type=None, snap_chains_num=1,
+                             n_jobs=1):
     from src.utils import args_utils as au
     # todo: of over all the electrodes, check the groups, and run the snap in a loop only for the grids
     groups_pos_dict = defaultdict(list)
@@ -1268,7 +1269,7 @@ def snap_electrodes_to_dural(subject, snap_all=False, overwrite_snap=False, elec
     for elc_name, elc_pos in zip(all_names, all_pos):
         group = utils.elec_group(elc_name, False)
         groups_pos_dict[group].append(elc_pos)
-    snap_ret = True
+    grids_pos = OrderedDict()
     for group in groups_pos_dict.keys():
         pos = np.array(groups_pos_dict[group])
         if not snap_all:
@@ -1276,8 +1277,10 @@ def snap_electrodes_to_dural(subject, snap_all=False, overwrite_snap=False, elec
         else:
             do_snap = True
         if do_snap:
-            snap_ret = snap_ret and snap_electrodes_to_surface(
-                subject, pos, group, SUBJECTS_DIR, overwrite=overwrite_snap)
+            grids_pos[group] = pos
+    # All the grids (and their chains) are snapped concurrently
+    snap_ret = snap_grids_to_surface(
+        subject, grids_pos, SUBJECTS_DIR, overwrite=overwrite_snap, chains_num=snap_chains_num, n_jobs=n_jobs)
     if snap_ret:
         read_snapped_electrodes(subject, electrodes_type, overwrite_snap)
     return snap_ret
@@ -1310,7 +1313,7 @@ def read_snapped_electrodes(subject, electrodes_type=None, overwrite=False):
 def snap_electrodes_to_surface(subject, elecs_pos, grid_name, subjects_dir,
                                max_steps=40000, giveup_steps=10000,
                                init_temp=1e-3, temperature_exponent=1,
-                               deformation_constant=1., overwrite=False):
+                               deformation_constant=1., overwrite=False, chains_num=1, n_jobs=1):
     '''
     Transforms electrodes from surface space to positions on the surface
     using a simulated annealing "snapping" algorithm which minimizes an
@@ -1347,93 +1350,35 @@ def snap_electrodes_to_surface(subject, elecs_pos, grid_name, subjects_dir,
         the deformation and displacement are weighted equally. When less than
         1, there is assumed to be considerable deformation and the spring
         condition is weighted more highly than the deformation condition.
+    chains_num : Int
+        The number of independent annealing chains, with different seeds.
+        The lowest energy chain is taken. Default value 1
+    n_jobs : Int
+        The number of processes the chains are run on. Default value 1
 
     There is no return value. The 'snap_coords' attribute will be used to
     store the snapped locations of the electrodes
     '''
+    return snap_grids_to_surface(
+        subject, {grid_name: elecs_pos}, subjects_dir, max_steps, giveup_steps, init_temp, temperature_exponent,
+        deformation_constant, overwrite, chains_num, n_jobs)
 
-    fol = utils.make_dir(op.join(MMVT_DIR, subject, 'electrodes'))
-    output_fname = op.join(fol, '{}_snap_electrodes.npz'.format(grid_name))
-    if op.isfile(output_fname) and not overwrite:
-        print('The output file {} is already exist! To overwrite use --overwrite_snap 1'.format(output_fname))
-        return True
-    print('Snapping {} electrodes'.format(grid_name))
-
-    n = elecs_pos.shape[0]
-    e_init = np.array(elecs_pos)
-    snapped_electrodes = np.zeros(elecs_pos.shape)
-
-    # first set the alpha parameter exactly as described in Dykstra 2012.
-    # this parameter controls which electrodes have virtual springs connected.
-    # this may not matter but doing it is fast and safe
-    alpha = np.zeros((n, n))
-    init_dist = cdist(e_init, e_init)
-
-    neighbors = []
-
-    k_nei = np.min([n, 6])
-    for i in range(n):
-        neighbor_vec = init_dist[:, i]
-        # take 5 highest neighbors
-        h5, = np.where(np.logical_and(neighbor_vec < np.sort(neighbor_vec)[k_nei - 1],
-                                      neighbor_vec != 0))
-
-        neighbors.append(h5)
-
-    neighbors = np.squeeze(neighbors)
-
-    # get distances from each neighbor pairing
-    neighbor_dists = []
-    for i in range(n):
-        neighbor_dists.append(init_dist[i, neighbors[i]])
-
-    neighbor_dists = np.hstack(neighbor_dists)
-
-    # collect distance into histogram of resolution 0.2
-    max = np.max(np.around(neighbor_dists))
-    min = np.min(np.around(neighbor_dists))
-
-    hist, _ = np.histogram(neighbor_dists, bins=int((max - min) / 2), range=(min, max))
-
-    fundist = np.argmax(hist) * 2 + min + 1
-
-    # apply fundist to alpha matrix
-    alpha_tweak = 1.75
-
-    for i in range(n):
-        neighbor_vec = init_dist[:, i]
-        neighbor_vec[i] = np.inf
-
-        neighbors = np.where(neighbor_vec < fundist * alpha_tweak)
-
-        if len(neighbors) > 5:
-            neighbors = np.where(neighbor_vec < np.sort(neighbor_vec)[5])
 
-        if len(neighbors) == 0:
-            closest = np.argmin(neighbors)
-            neighbors = np.where(neighbor_vec < closest * alpha_tweak)
+def snap_grids_to_surface(subject, grids_pos, subjects_dir, max_steps=40000, giveup_steps=10000, init_temp=1e-3,
+                          temperature_exponent=1, deformation_constant=1., overwrite=False, chains_num=1, n_jobs=1):
+    # grids_pos: grid name -> electrodes positions. See snap_electrodes_to_surface for the parameters
+    from src.preproc import snap_grid_to_dural as sgd
 
-        alpha[i, neighbors] = 1
-
-        for j in range(i):
-            if alpha[j, i] == 1:
-                alpha[i, j] = 1
-            if alpha[i, j] == 1:
-                alpha[j, i] = 1
-
-    # alpha is set, now do the annealing
-    def energycost(e_new, e_old, alpha):
-        n = len(alpha)
-
-        dist_new = cdist(e_new, e_new)
-        dist_old = cdist(e_old, e_old)
-
-        H = 0
-        for i in range(n):
-            H += deformation_constant * float(cdist([e_new[i]], [e_old[i]]))
-            for j in range(i):
-                H += alpha[i, j] * (dist_new[i, j] - dist_old[i, j]) ** 2
-        return H
+    fol = utils.make_dir(op.join(MMVT_DIR, subject, 'electrodes'))
+    output_fnames = {grid_name: op.join(fol, '{}_snap_electrodes.npz'.format(grid_name)) for grid_name in grids_pos}
+    for grid_name, output_fname in output_fnames.items():
+        if op.isfile(output_fname) and not overwrite:
+            print('The output file {} is already exist! To overwrite use --overwrite_snap 1'.format(output_fname))
+    grids_pos = OrderedDict([(grid_name, np.array(pos)) for grid_name, pos in grids_pos.items()
+                             if overwrite or not op.isfile(output_fnames[grid_name])])
+    if len(grids_pos) == 0:
+        return True
+    print('Snapping {} electrodes'.format(', '.join(grids_pos.keys())))
 
     # load the dural surface locations
     ply_template = op.join(MMVT_DIR, subject, 'surf', '{hemi}.dural.ply')
@@ -1449,87 +1394,23 @@ def snap_electrodes_to_surface(subject, elecs_pos, grid_name, subjects_dir,
         return False
     dura = np.vstack((lh_dura, rh_dura))
 
-    max_deformation = 3
-    deformation_choice = 50
-
-    # adjust annealing parameters
-    # H determines maximal number of steps
-    H = max_steps
-    # Texp determines the steepness of temperateure gradient
-    Texp = 1 - temperature_exponent / H
-    # T0 sets the initial temperature and scales the energy term
-    T0 = init_temp
-    # Hbrk sets a break point for the annealing
-    Hbrk = giveup_steps
-
-    h = 0;
-    hcnt = 0
-    lowcost = mincost = 1e6
-
-    # start e-init as greedy snap to surface
-    e_snapgreedy = dura[np.argmin(cdist(dura, e_init), axis=0)]
-
-    e = np.array(e_snapgreedy).copy()
-    emin = np.array(e_snapgreedy).copy()
-
-    # the annealing schedule continues until the maximum number of moves
-    while h < H:
-        h += 1
-        hcnt += 1
-        # terminate if no moves have been made for a long time
-        if hcnt > Hbrk:
-            break
-
-        # current temperature
-        T = T0 * (Texp ** h)
-
-        # select a random electrode
-        e1 = np.random.randint(n)
-        # transpose it with a *nearby* point on the surface
-
-        # find distances from this point to all points on the surface
-        dists = np.squeeze(cdist(dura, [e[e1]]))
-        # take a distance within the minimum 5X
-
-        mindist = np.sort(dists)[deformation_choice]
-        candidate_verts, = np.where(dists < mindist * max_deformation)
-        choice_vert = candidate_verts[np.random.randint(len(candidate_verts))]
-        e_tmp = e.copy()
-        e_tmp[e1] = dura[choice_vert]
-
-        cost = energycost(e_tmp, e_init, alpha)
-
-        if cost < lowcost or np.random.random() < np.exp(-(cost - lowcost) / T):
-            e = e_tmp
-            lowcost = cost
-
-            if cost < mincost:
-                emin = e
-                mincost = cost
-                print('step %i ... current lowest cost = %f' % (h, mincost))
-                hcnt = 0
-
-            if mincost == 0:
-                break
-        if h % 200 == 0:
-            print('%s %s: step %i ... final lowest cost = %f' % (subject, grid_name, h, mincost))
-
-    # return the emin coordinates
-    for ind, loc in enumerate(emin):
-        snapped_electrodes[ind] = loc
+    grids_results = sgd.anneal_grids_chains(
+        grids_pos, dura, chains_num, n_jobs, max_steps=max_steps, giveup_steps=giveup_steps, init_temp=init_temp,
+        temperature_exponent=temperature_exponent, deformation_constant=deformation_constant)
 
     lh_pia, _ = nib.freesurfer.read_geometry(op.join(subjects_dir, subject, 'surf', 'lh.pial'))
     rh_pia, _ = nib.freesurfer.read_geometry(op.join(subjects_dir, subject, 'surf', 'rh.pial'))
     pia = np.vstack((lh_pia, rh_pia))
-    e_pia = np.argmin(cdist(pia, emin), axis=0)
 
-    snapped_electrodes_pial = np.zeros(snapped_electrodes.shape)
-    for ind, soln in enumerate(e_pia):
-        snapped_electrodes_pial[ind] = pia[soln]
-
-    np.savez(output_fname, snapped_electrodes=snapped_electrodes, snapped_electrodes_pial=snapped_electrodes_pial)
-    print('The snap electrodes were saved to {}'.format(output_fname))
-    return op.isfile(output_fname)
+    for grid_name, grid_results in grids_results.items():
+        # return the emin coordinates
+        snapped_electrodes = np.array(grid_results['emin'])
+        e_pia = np.argmin(cdist(pia, snapped_electrodes), axis=0)
+        snapped_electrodes_pial = pia[e_pia]
+        sgd.save_snapped_electrodes(
+            output_fnames[grid_name], snapped_electrodes, snapped_electrodes_pial, grid_results)
+        print('The snap electrodes were saved to {}'.format(output_fnames[grid_name]))
+    return all([op.isfile(output_fnames[grid_name]) for grid_name in grids_pos])
 
 
 def set_args(args):
@@ -1733,7 +1614,7 @@ def main(subject, remote_subject_dir, args, flags):
 
     if 'snap_electrodes_to_dural' in args.function:
         flags['snap_electrodes_to_dural'] = snap_electrodes_to_dural(
-            subject, args.snap_all, args.overwrite_snap, args.electrodes_type)
+            subject, args.snap_all, args.overwrite_snap, args.electrodes_type, args.snap_chains_num, args.n_jobs)
 
     if 'read_snapped_electrodes' in args.function:
         flags['read_snapped_electrodes'] = read_snapped_electrodes(
@@ -1792,6 +1673,7 @@ def read_cmd_args(argv=None):
     parser.add_argument('--snap', required=False, default=0, type=au.is_true)
     parser.add_argument('--snap_all', required=False, default=1, type=au.is_true)
     parser.add_argument('--overwrite_snap', required=False, default=0, type=au.is_true)
+    parser.add_argument('--snap_chains_num', required=False, default=1, type=int)
 
     parser.add_argument('--electrodes_groups_coloring_fname', help='', required=False, default='electrodes_groups_coloring.csv')
     parser.add_argument('--ras_xls_sheet_name', help='ras_xls_sheet_name', required=False, default='')
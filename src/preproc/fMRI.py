@@ -853,7 +853,8 @@ def copy_volumes(subject, contrast_file_template, contrast, volume_fol, volume_n
 
 def analyze_4d_data(subject, atlas, input_fname_template='rest.sm6.{subject}.{hemi}.mgz', measures=['mean'],
                     template_brain='', norm_percs=(1,99), overwrite=False, remote_fmri_dir='', do_plot=False,
-                    do_plot_all_vertices=False, excludes=('corpuscallosum', 'unknown'), input_format='nii.gz'):
+                    do_plot_all_vertices=False, excludes=('corpuscallosum', 'unknown'), input_format='nii.gz',
+                    n_jobs=1):
     files_exist = all([utils.both_hemi_files_exist(op.join(
         MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_{}.npz'.format(atlas, em, '{hemi}'))) for em in measures])
     minmax_fname_template = op.join(MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_minmax.pkl'.format(atlas, '{em}'))
@@ -889,7 +890,7 @@ def analyze_4d_data(subject, atlas, input_fname_template='rest.sm6.{subject}.{he
                     print('No {} {} labels were found!'.format(morph_from_subject, atlas))
                     return False
             labels_data, labels_names = lu.calc_time_series_per_label(
-                x, labels, em, excludes, figures_dir, do_plot, do_plot_all_vertices)
+                x, labels, em, excludes, figures_dir, do_plot, do_plot_all_vertices, n_jobs)
             np.savez(output_fname, data=labels_data, names=labels_names)
             labels_minmax[em].append(utils.calc_min_max(labels_data, norm_percs=norm_percs))
             print('{} was saved'.format(output_fname))
@@ -1149,17 +1150,18 @@ def find_fmri_fname_template(subject, fmri_file_template, template_brains, only_
 
 
 def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='fsaverage', format='mgz',
-                              norm_percs=(1, 99), overwrite=False):
+                              norm_percs=(1, 99), overwrite=False, legacy_frames=False):
     minmax_fname = op.join(MMVT_DIR, subject, 'fmri', 'activity_map_minmax.npy')
     fmri_fname_template = find_fmri_fname_template(subject, fmri_file_template, template_brains, False, format)
+    fol_template = op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{hemi}')
     hemi_minmax = []
     for hemi in utils.HEMIS:
-        fol = op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{}'.format(hemi))
+        fol = fol_template.format(hemi=hemi)
         fmri_fname = fmri_fname_template.format(hemi=hemi)
         # Check if there is a morphed file
         data = nib.load(fmri_fname).get_data().squeeze()
         T = data.shape[1]
-        if not overwrite and len(glob.glob(op.join(fol, '*.npy'))) == T:
+        if not overwrite and activity_map_was_saved(fol, T, legacy_frames):
             hemi_minmax.append(utils.calc_min_max(data, norm_percs=norm_percs))
             continue
         verts, faces = utils.read_pial(subject, MMVT_DIR, hemi)
@@ -1183,20 +1185,34 @@ def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='f
             data = nib.load(fmri_fname).get_data().squeeze()
         assert (data.shape[0] == subject_verts_num)
         hemi_minmax.append(utils.calc_min_max(data, norm_percs=norm_percs))
-        utils.delete_folder_files(fol)
-        now = time.time()
-        T = data.shape[1]
-        for t in range(T):
-            utils.time_to_go(now, t, T, runs_num_to_print=10)
-            np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+        utils.save_activity_cube(fol, data, cb_title='fMRI')
+        if legacy_frames:
+            # The per-frame files are only needed by older versions of the addon
+            utils.delete_folder_files(fol)
+            now = time.time()
+            T = data.shape[1]
+            for t in range(T):
+                utils.time_to_go(now, t, T, runs_num_to_print=10)
+                np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+        elif op.isdir(fol):
+            shutil.rmtree(fol)
 
     data_min, data_max = utils.calc_minmax_from_arr(hemi_minmax)
     print('save_dynamic_activity_map minmax: {},{}'.format(data_min, data_max))
     np.save(minmax_fname, (data_min, data_max))
-    return np.all([len(glob.glob(op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{}'.format(hemi), '*.npy'))) == T
+    for hemi in utils.HEMIS:
+        utils.save_activity_cube_header(fol_template.format(hemi=hemi), data_min=data_min, data_max=data_max)
+    return np.all([activity_map_was_saved(fol_template.format(hemi=hemi), T, legacy_frames)
                    for hemi in utils.HEMIS])
 
 
+def activity_map_was_saved(fol, T, legacy_frames=False):
+    if legacy_frames:
+        return len(glob.glob(op.join(fol, '*.npy'))) == T
+    _, header = utils.load_activity_cube(fol)
+    return header is not None and header.get('times_num', 0) == T
+
+
 def find_template_files(template_fname, file_types=('mgz', 'mgh', 'nii.gz', 'nii', 'npy')):
     def find_files(template_fname):
         recursive = '**' in set(template_fname.split(op.sep))
@@ -1885,10 +1901,23 @@ def main(subject, remote_subject_dir, args, flags):
             args.fwhm, args.lfp, args.nskip, remote_fmri_dir, args.overwrite_4d_preproc, args.print_only)
 
     if 'analyze_4d_data' in args.function:
-        flags['analyze_4d_data'] = analyze_4d_data(
-            subject, args.atlas, args.fmri_file_template, args.labels_extract_mode, args.template_brain,
-            args.norm_percs, args.overwrite_labels_data, remote_fmri_dir, args.resting_state_plot,
-            args.resting_state_plot_all_vertices, args.excluded_labels, args.input_format)
+        fmri_files_template = args.fmri_file_template.replace('{subject}', subject).replace('{hemi}', '*')
+        labels_subject = subject if args.template_brain == '' else args.template_brain
+        flags['analyze_4d_data'] = pu.run_cached_step(
+            subject, args, 'analyze_4d_data', lambda overwrite: analyze_4d_data(
+                subject, args.atlas, args.fmri_file_template, args.labels_extract_mode, args.template_brain,
+                args.norm_percs, overwrite, remote_fmri_dir, args.resting_state_plot,
+                args.resting_state_plot_all_vertices, args.excluded_labels, args.input_format, args.n_jobs),
+            args.overwrite_labels_data,
+            args_keys=('atlas', 'fmri_file_template', 'labels_extract_mode', 'template_brain', 'norm_percs',
+                       'excluded_labels', 'input_format'),
+            inputs=[op.join(FMRI_DIR, subject, fmri_files_template)] +
+                   [op.join(SUBJECTS_DIR, labels_subject, 'label', '{}.{}.annot'.format(hemi, args.atlas))
+                    for hemi in utils.HEMIS],
+            outputs=[op.join(MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_{}.npz'.format(args.atlas, em, hemi))
+                     for em in args.labels_extract_mode for hemi in utils.HEMIS] +
+                    [op.join(MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_minmax.pkl'.format(args.atlas, em))
+                     for em in args.labels_extract_mode])
 
     if 'save_dynamic_activity_map' in args.function:
         flags['save_dynamic_activity_map'] = save_dynamic_activity_map(
@@ -69,6 +69,8 @@ def init_globals(subject, mri_subject='', fname_format='', fname_format_cond='',
         BEM, STC, STC_HEMI, STC_HEMI_SAVE, STC_HEMI_SMOOTH, STC_HEMI_SMOOTH_SAVE, STC_ST, COR, AVE, LBL, STC_MORPH,\
         ACT, ASEG, MMVT_SUBJECT_FOLDER, DATA_COV, NOISE_COV, DATA_CSD, NOISE_CSD, MEG_TO_HEAD_TRANS, \
         locating_meg_file, locating_subject_file
+    # The parallel workers are forked with the globals
+    utils.shutdown_pool()
     if files_includes_cond:
         fname_format = fname_format_cond
     SUBJECT = subject
@@ -2456,16 +2458,17 @@ def check_stc_with_ply(stc, cond_name='', subject=''):
 
 
 def save_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', smoothed_stc=True, morph_to_subject='',
-                      stc_t=-1, norm_by_percentile=False, norm_percs=(1,99), plot_cb=False):
+                      stc_t=-1, norm_by_percentile=False, norm_percs=(1,99), plot_cb=False, legacy_frames=False):
     try:
         if stat not in [STAT_DIFF, STAT_AVG]:
             raise Exception('stat not in [STAT_DIFF, STAT_AVG]!')
         stcs = get_stat_stc_over_conditions(
             events, stat, stcs_conds, inverse_method, smoothed_stc, morph_to_subject, stc_t)
+        subject = MRI_SUBJECT if morph_to_subject == '' else morph_to_subject
         if stc_t == -1:
             save_activity_map_minmax(stcs, events, stat, stcs_conds, inverse_method, morph_to_subject,
                                      norm_by_percentile, norm_percs, plot_cb)
-        subject = MRI_SUBJECT if morph_to_subject == '' else morph_to_subject
+            data_min, data_max = utils.load(op.join(MMVT_DIR, subject, 'meg_activity_map_minmax.pkl'))
         for hemi in HEMIS:
             verts, faces = utils.read_pial(subject, MMVT_DIR, hemi)
             data = stcs[hemi]
@@ -2477,13 +2480,18 @@ def save_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', smoo
             if morph_to_subject != '':
                 fol = fol.replace(MRI_SUBJECT, morph_to_subject)
             if stc_t == -1:
-                utils.delete_folder_files(fol)
-                now = time.time()
-                T = data.shape[1]
-                for t in range(T):
-                    utils.time_to_go(now, t, T, runs_num_to_print=10)
-                    np.save(op.join(fol, 't{}'.format(t)), data[:, t])
-            else:
+                utils.save_activity_cube(fol, data, data_min, data_max, 'MEG')
+                if legacy_frames:
+                    # The per-frame files are only needed by older versions of the addon
+                    utils.delete_folder_files(fol)
+                    now = time.time()
+                    T = data.shape[1]
+                    for t in range(T):
+                        utils.time_to_go(now, t, T, runs_num_to_print=10)
+                        np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+                elif op.isdir(fol):
+                    shutil.rmtree(fol)
+            elif not utils.save_activity_cube_frame(fol, stc_t, data):
                 utils.make_dir(fol)
                 np.save(op.join(fol, 't{}'.format(stc_t)), data)
         flag = True
@@ -3420,14 +3428,16 @@ def calc_labels_avg_for_rest_wrapper(args, raw=None):
         args.atlas, args.inverse_method, raw, args.pick_ori, args.extract_mode, args.snr, args.raw_fname,
         args.inv_fname, args.labels_data_template, args.overwrite_stc, args.overwrite_labels_data,
         args.fwd_usingMEG, args.fwd_usingEEG, cond_name='all', positive=False, moving_average_win_size=0,
-        save_data_files=True, n_jobs=args.n_jobs)
+        save_data_files=True, shared_inverse_kernel=args.rest_shared_inverse_kernel,
+        raw_chunk_len=args.rest_raw_chunk_len, check_shared_kernel=args.rest_check_shared_kernel,
+        n_jobs=args.n_jobs)
 
 
 def calc_labels_avg_for_rest(
         atlas, inverse_method, raw=None, pick_ori=None, extract_modes=['mean_flip'], snr=1, raw_fname='', inv_fname='',
         labels_data_template='', overwrite_stc=False, overwrite_labels_data=False, fwd_usingMEG=True, fwd_usingEEG=True,
         cond_name='all', positive=False, moving_average_win_size=0, save_data_files=True, do_plot_time_series=True,
-        modality='meg', n_jobs=6):
+        modality='meg', shared_inverse_kernel=False, raw_chunk_len=1000, check_shared_kernel=False, n_jobs=6):
 
     def collect_parallel_results(indices, results, labels_num):
         labels_data_hemi = {}
@@ -3455,7 +3465,7 @@ def calc_labels_avg_for_rest(
         if raw is None:
             raw_fname = get_raw_fname(raw_fname)
             if op.isfile(raw_fname):
-                mne.io.read_raw_fif(raw_fname)
+                raw = mne.io.read_raw_fif(raw_fname)
             else:
                 raise Exception("Can't find the raw file! ({})".format(raw_fname))
         if not isinstance(inverse_method, str) and isinstance(inverse_method, Iterable):
@@ -3464,14 +3474,22 @@ def calc_labels_avg_for_rest(
         src = inverse_operator['src']
         lambda2 = 1.0 / snr ** 2
         labels_data = {}
-        for hemi in utils.HEMIS:
-            labels = lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi=hemi)
-            indices = np.array_split(np.arange(len(labels)), n_jobs)
-            chunks = [([labels[ind] for ind in indices_chunk], raw, src, inverse_operator, lambda2, inverse_method,
-                       extract_modes, pick_ori, save_data_files, labels_output_fol_template, overwrite_stc,
-                       do_plot_time_series) for indices_chunk in indices]
-            results = utils.run_parallel(calc_stc_labels_parallel, chunks, n_jobs)
-            labels_data[hemi] = collect_parallel_results(indices, results, len(labels))
+        if shared_inverse_kernel:
+            labels_data = calc_labels_avg_for_rest_with_shared_kernel(
+                atlas, raw, inverse_operator, lambda2, inverse_method, extract_modes, pick_ori, save_data_files,
+                labels_output_fol_template, overwrite_stc, do_plot_time_series, raw_chunk_len)
+            if check_shared_kernel:
+                check_labels_avg_for_rest_with_shared_kernel(
+                    labels_data, atlas, raw, inverse_operator, lambda2, inverse_method, pick_ori, raw_chunk_len)
+        else:
+            for hemi in utils.HEMIS:
+                labels = lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi=hemi)
+                indices = np.array_split(np.arange(len(labels)), n_jobs)
+                chunks = [([labels[ind] for ind in indices_chunk], raw, src, inverse_operator, lambda2,
+                           inverse_method, extract_modes, pick_ori, save_data_files, labels_output_fol_template,
+                           overwrite_stc, do_plot_time_series) for indices_chunk in indices]
+                results = utils.run_parallel(calc_stc_labels_parallel, chunks, n_jobs)
+                labels_data[hemi] = collect_parallel_results(indices, results, len(labels))
 
     elif (not labels_data_exist) or overwrite_labels_data:
         labels_data = {}
@@ -3534,6 +3552,105 @@ def calc_stc_labels_parallel(p):
     return labels_data
 
 
+def calc_labels_avg_for_rest_with_shared_kernel(
+        atlas, raw, inverse_operator, lambda2, inverse_method, extract_modes, pick_ori=None, save_data_files=True,
+        labels_output_fol_template='', overwrite=False, do_plot_time_series=True, raw_chunk_len=1000):
+    # Instead of applying the inverse for each label (calc_stc_labels_parallel), the inverse kernel is prepared once,
+    # and the raw data is projected through it in time chunks. The labels' mean_flip time courses are calculated
+    # from one sparse (labels x sources) pooling matrix, so the full source estimate is never in memory.
+    from mne.minimum_norm.inverse import (
+        prepare_inverse_operator, _pick_channels_inverse_operator, _assemble_kernel, combine_xyz)
+    from mne.io.constants import FIFF
+
+    for em in extract_modes:
+        if em != 'mean_flip':
+            print("{} isn't implemented yet for rest data!".format(em))
+    labels = {hemi: lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi=hemi) for hemi in utils.HEMIS}
+    all_labels = labels['lh'] + labels['rh']
+    inv = prepare_inverse_operator(inverse_operator, 1, lambda2, inverse_method)
+    sel = _pick_channels_inverse_operator(raw.ch_names, inv)
+    K, noise_norm, vertno = _assemble_kernel(inv, None, inverse_method, pick_ori)[:3]
+    is_free_ori = inverse_operator['source_ori'] == FIFF.FIFFV_MNE_FREE_ORI and pick_ori != 'normal'
+    pooling = calc_labels_pooling_matrix(all_labels, inverse_operator['src'], vertno)
+    if not is_free_ori:
+        # Without combining the orientations, the pooling can be applied on the kernel itself
+        if noise_norm is not None:
+            K = K * noise_norm
+        K = np.asarray(pooling.dot(K))
+    T = raw.n_times
+    all_labels_data = np.zeros((len(all_labels), T))
+    now = time.time()
+    for chunk_ind, start in enumerate(range(0, T, raw_chunk_len)):
+        utils.time_to_go(now, chunk_ind, int(np.ceil(T / raw_chunk_len)), runs_num_to_print=10)
+        stop = min(start + raw_chunk_len, T)
+        data, _ = raw[sel, start:stop]
+        sol = np.dot(K, data)
+        if is_free_ori:
+            sol = combine_xyz(sol)
+            if noise_norm is not None:
+                sol *= noise_norm
+            sol = pooling.dot(sol)
+        all_labels_data[:, start:stop] = sol
+
+    labels_data = {}
+    labels_output_fol = labels_output_fol_template.format(extract_mode='mean_flip')
+    utils.make_dir(labels_output_fol)
+    for hemi, hemi_indices in zip(utils.HEMIS, np.split(np.arange(len(all_labels)), [len(labels['lh'])])):
+        labels_data[hemi] = {'mean_flip': all_labels_data[hemi_indices]}
+        for label, label_data in zip(labels[hemi], labels_data[hemi]['mean_flip']):
+            if do_plot_time_series:
+                plot_label_data(label_data, label.name, 'mean_flip', labels_output_fol)
+            if save_data_files:
+                label_fname = op.join(labels_output_fol, '{}-{}.npy'.format(label.name, 'mean_flip'))
+                if not op.isfile(label_fname) or overwrite:
+                    np.save(label_fname, label_data)
+    return labels_data
+
+
+def check_labels_avg_for_rest_with_shared_kernel(
+        labels_data, atlas, raw, inverse_operator, lambda2, inverse_method, pick_ori=None, samples_num=1000,
+        labels_num=3):
+    # Compares the shared kernel results of the first labels in each hemisphere with the per label
+    # apply_inverse_raw path (calc_stc_labels_parallel), on the first samples of the raw data
+    src = inverse_operator['src']
+    samples_num = min(samples_num, raw.n_times)
+    for hemi in utils.HEMIS:
+        labels = lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi=hemi)
+        for ind, label in enumerate(labels[:labels_num]):
+            stc = mne.minimum_norm.apply_inverse_raw(
+                raw, inverse_operator, lambda2, inverse_method, label=label, pick_ori=pick_ori, start=0,
+                stop=samples_num)
+            label_data = extract_label_data(label, src, stc)
+            shared_kernel_data = labels_data[hemi]['mean_flip'][ind, :samples_num]
+            if not np.allclose(shared_kernel_data, label_data, rtol=1e-4, atol=1e-6 * np.max(np.abs(label_data))):
+                raise Exception('The shared kernel results of {} are different from apply_inverse_raw!'.format(
+                    label.name))
+    print('The shared kernel results are the same as apply_inverse_raw')
+
+
+def calc_labels_pooling_matrix(labels, src, vertno):
+    # A sparse (labels x sources) matrix, where each row is the label's sign flip vector divided by its vertices num,
+    # so pooling.dot(sources_data) is extract_label_data for all the labels at once
+    import scipy.sparse
+    hemis_offsets = {'lh': 0, 'rh': len(vertno[0])}
+    rows, cols, vals = [], [], []
+    for label_ind, label in enumerate(labels):
+        hemi_vertno = vertno[0] if label.hemi == 'lh' else vertno[1]
+        label_vertno = np.intersect1d(hemi_vertno, label.vertices)
+        if len(label_vertno) == 0:
+            print('calc_labels_pooling_matrix: No vertices in {}!'.format(label.name))
+            continue
+        label_flip = np.atleast_1d(mne.label_sign_flip(label, src).squeeze())
+        rows.append(np.ones(len(label_vertno), dtype=int) * label_ind)
+        cols.append(hemis_offsets[label.hemi] + np.searchsorted(hemi_vertno, label_vertno))
+        vals.append(label_flip / len(label_vertno))
+    if len(rows) == 0:
+        return scipy.sparse.csr_matrix((len(labels), len(vertno[0]) + len(vertno[1])))
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(labels), len(vertno[0]) + len(vertno[1])))
+
+
 def _load_labels_data_parallel(p):
     labels, extract_modes, labels_output_fol_template, do_plot_time_series = p
     labels_data = {}
@@ -3577,9 +3694,7 @@ def calc_labels_avg_per_condition_wrapper(
             args.atlas, me, '{hemi}')) for me in args.extract_mode])
         if labels_data_exist and not args.overwrite_labels_data:
             if utils.should_run(args, 'calc_labels_min_max'):
-                flags['calc_labels_min_max'] = calc_labels_minmax(
-                    atlas, args.inverse_method, args.extract_mode, args.task, args.labels_data_template,
-                    args.overwrite_labels_data)
+                flags['calc_labels_min_max'] = calc_labels_minmax_cached(subject, atlas, args)
             return flags
 
         conditions_keys = conditions.keys() if conditions is not None else ['all']
@@ -3612,12 +3727,25 @@ def calc_labels_avg_per_condition_wrapper(
                     subject, conditions, inverse_method, args, flags, raw=raw, epochs=epochs)
 
     if utils.should_run(args, 'calc_labels_min_max'):
-        flags['calc_labels_min_max'] = calc_labels_minmax(
-            atlas, args.inverse_method, args.extract_mode, args.task, args.labels_data_template,
-            args.overwrite_labels_data)
+        flags['calc_labels_min_max'] = calc_labels_minmax_cached(subject, atlas, args)
     return flags
 
 
+def calc_labels_minmax_cached(subject, atlas, args):
+    # calc_labels_minmax through the steps cache, with the labels data files as its inputs
+    labels_data_template = args.labels_data_template if args.labels_data_template != '' else LBL
+    extract_modes = [args.extract_mode] if isinstance(args.extract_mode, str) else args.extract_mode
+    min_max_output_template = get_labels_minmax_template(labels_data_template)
+    return pu.run_cached_step(
+        subject, args, 'calc_labels_min_max', lambda overwrite: calc_labels_minmax(
+            atlas, args.inverse_method, args.extract_mode, args.task, args.labels_data_template, overwrite),
+        args.overwrite_labels_data, args_keys=('atlas', 'inverse_method', 'extract_mode', 'task', 'labels_data_template'),
+        inputs=[get_labels_data_fname(labels_data_template, im, args.task, atlas, em, hemi)
+                for em, im, hemi in product(extract_modes, args.inverse_method, utils.HEMIS)],
+        outputs=[op.join(MMVT_DIR, MRI_SUBJECT, 'meg', utils.namebase_with_ext(get_minmax_fname(
+            min_max_output_template, im, args.task, atlas, em))) for em, im in product(extract_modes, args.inverse_method)])
+
+
 def calc_labels_minmax(atlas, inverse_method, extract_modes, task='', labels_data_template='',
                        overwrite_labels_data=False):
     if labels_data_template == '':
@@ -4423,7 +4551,9 @@ def main(tup, remote_subject_dir, org_args, flags=None):
             args.atlas, inverse_method, None, args.pick_ori, args.extract_mode, args.snr, args.raw_fname,
             args.inv_fname, args.labels_data_template, args.overwrite_stc, args.overwrite_labels_data,
             args.fwd_usingMEG, args.fwd_usingEEG, cond_name='all', positive=False, moving_average_win_size=0,
-            save_data_files=True, n_jobs=args.n_jobs)
+            save_data_files=True, shared_inverse_kernel=args.rest_shared_inverse_kernel,
+            raw_chunk_len=args.rest_raw_chunk_len, check_shared_kernel=args.rest_check_shared_kernel,
+            n_jobs=args.n_jobs)
 
     # functions that aren't in the main pipeline
     if 'smooth_stc' in args.function:
@@ -4650,6 +4780,9 @@ def read_cmd_args(argv=None):
     parser.add_argument('--calc_source_band_induced_power', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--apply_on_raw', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--extract_mode', help='', required=False, default='mean_flip', type=au.str_arr_type)
+    parser.add_argument('--rest_shared_inverse_kernel', help='', required=False, default=0, type=au.is_true)
+    parser.add_argument('--rest_raw_chunk_len', help='', required=False, default=1000, type=int)
+    parser.add_argument('--rest_check_shared_kernel', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--read_only_from_annot', help='', required=False, default=1, type=au.is_true)
     parser.add_argument('--colors_map', help='', required=False, default='OrRd')
     parser.add_argument('--save_smoothed_activity', help='', required=False, default=True, type=au.is_true)
@@ -24,12 +24,16 @@ def parcelate(subject, atlas, hemi, surface_type, vertices_labels_ids_lookup=Non
     output_fol = op.join(MMVT_DIR, subject, 'labels', '{}.{}.{}'.format(atlas, surface_type, hemi))
     utils.make_dir(output_fol)
     vtx, fac = utils.read_ply_file(op.join(MMVT_DIR, subject, 'surf', '{}.{}.ply'.format(hemi, surface_type)))
+    # vertices_labels_ids_lookup: the hemi's (vertices_labels_ids, labels_names) of create_vertices_labels_ids_lookup
     if vertices_labels_ids_lookup is None or overwrite_vertices_labels_lookup:
-        vertices_labels_ids_lookup = lu.create_vertices_labels_lookup(
-            subject, atlas, True, overwrite_vertices_labels_lookup)[hemi]
+        vertices_labels_ids_lookup = lu.create_vertices_labels_ids_lookup(
+            subject, atlas, overwrite_vertices_labels_lookup)[hemi]
     labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
     if 'unknown-{}'.format(hemi) not in [l.name for l in labels]:
         labels.append(lu.Label([], name='unknown-{}'.format(hemi), hemi=hemi))
+    # The faces are split by the indices in labels
+    unknown_ind = [l.name for l in labels].index('unknown-{}'.format(hemi))
+    vertices_labels_ids_lookup = lu.remap_vertices_labels_ids(*vertices_labels_ids_lookup, labels, unknown_ind)
 
     nV = vtx.shape[0]
     nF = fac.shape[0]
@@ -8,7 +8,7 @@ from src.utils import utils
 def snap_electrodes_to_surface(subject, elecs_pos, grid_name, subjects_dir,
                                max_steps=40000, giveup_steps=10000,
                                init_temp=1e-3, temperature_exponent=1,
-                               deformation_constant=1.):
+                               deformation_constant=1., chains_num=1, n_jobs=1):
     '''
     Transforms electrodes from surface space to positions on the surface
     using a simulated annealing "snapping" algorithm which minimizes an
@@ -45,6 +45,11 @@ def snap_electrodes_to_surface(subject, elecs_pos, grid_name, subjects_dir,
         the deformation and displacement are weighted equally. When less than
         1, there is assumed to be considerable deformation and the spring
         condition is weighted more highly than the deformation condition.
+    chains_num : Int
+        The number of independent annealing chains, with different seeds.
+        The lowest energy chain is taken. Default value 1
+    n_jobs : Int
+        The number of processes the chains are run on. Default value 1
 
     There is no return value. The 'snap_coords' attribute will be used to
     store the snapped locations of the electrodes
@@ -53,111 +58,177 @@ def snap_electrodes_to_surface(subject, elecs_pos, grid_name, subjects_dir,
 
     create_dural_surface(subject, subjects_dir)
 
-    n = elecs_pos.shape[0]
-    e_init = np.array(elecs_pos)
     snapped_electrodes = np.zeros(elecs_pos.shape)
 
-    # first set the alpha parameter exactly as described in Dykstra 2012.
-    # this parameter controls which electrodes have virtual springs connected.
-    # this may not matter but doing it is fast and safe
-    alpha = np.zeros((n, n))
-    init_dist = cdist(e_init, e_init)
+    # load the dural surface locations
+    lh_dura, _ = nib.freesurfer.read_geometry(
+        op.join(subjects_dir, subject, 'surf', 'lh.dural'))
 
-    neighbors = []
+    rh_dura, _ = nib.freesurfer.read_geometry(
+        op.join(subjects_dir, subject, 'surf', 'rh.dural'))
 
-    k_nei = np.min([n, 6])
-    for i in range(n):
-        neighbor_vec = init_dist[:, i]
-        # take 5 highest neighbors
-        h5, = np.where(np.logical_and(neighbor_vec < np.sort(neighbor_vec)[k_nei - 1],
-                                      neighbor_vec != 0))
+    # lh_dura[:, 0] -= np.max(lh_dura[:, 0])
+    # rh_dura[:, 0] -= np.min(rh_dura[:, 0])
 
-        neighbors.append(h5)
+    # align the surfaces correctly
+    # in the tkRAS space
+    # orig = op.join( subjects_dir, subject, 'mri', 'orig.mgz' )
+    # ras2vox = np.linalg.inv(geo.get_vox2rasxfm( orig ))
+    # tkr = geo.get_vox2rasxfm(orig, 'vox2ras-tkr')
+    # lh_dura = np.array( geo.apply_affine( geo.apply_affine(lh_dura, ras2vox),
+    #    tkr))
+    # rh_dura = np.array( geo.apply_affine( geo.apply_affine(rh_dura, ras2vox),
+    #    tkr))
+    # lh_dura = geo.apply_affine( geo.apply_affine(lh_dura, ras2vox), tkr)
+    # rh_dura = geo.apply_affine( geo.apply_affine(rh_dura, ras2vox), tkr)
 
-    neighbors = np.squeeze(neighbors)
+    dura = np.vstack((lh_dura, rh_dura))
 
-    # get distances from each neighbor pairing
-    neighbor_dists = []
-    for i in range(n):
-        neighbor_dists.append(init_dist[i, neighbors[i]])
+    grid_results = anneal_grids_chains(
+        {grid_name: elecs_pos}, dura, chains_num, n_jobs, max_steps=max_steps, giveup_steps=giveup_steps,
+        init_temp=init_temp, temperature_exponent=temperature_exponent,
+        deformation_constant=deformation_constant)[grid_name]
+    emin = grid_results['emin']
 
-    neighbor_dists = np.hstack(neighbor_dists)
+    # return the emin coordinates
+    for ind, loc in enumerate(emin):
+        snapped_electrodes[ind] = loc
 
-    # collect distance into histogram of resolution 0.2
-    max = np.max(np.around(neighbor_dists))
-    min = np.min(np.around(neighbor_dists))
+    # return the nearest vertex on the pial surface
+    lh_pia, _ = nib.freesurfer.read_geometry(
+        op.join(subjects_dir, subject, 'surf', 'lh.pial'))
 
-    hist, _ = np.histogram(neighbor_dists, bins=int((max - min) / 2), range=(min, max))
+    rh_pia, _ = nib.freesurfer.read_geometry(
+        op.join(subjects_dir, subject, 'surf', 'rh.pial'))
 
-    fundist = np.argmax(hist) * 2 + min + 1
+    # expand the pial surfaces slightly to better visualize the electrodes
+    # lh_pia =geo.expand_triangular_mesh(lh_pia, com_bias=(-2, 0, 0), offset=18)
+    # rh_pia = geo.expand_triangular_mesh(rh_pia, com_bias=(2, 0, 0), offset=18)
 
-    # apply fundist to alpha matrix
-    alpha_tweak = 1.75
 
-    for i in range(n):
-        neighbor_vec = init_dist[:, i]
-        neighbor_vec[i] = np.inf
+    # adjust x-axis offsets as pysurfer illogically does as hard-coded step
+    # lh_pia[:, 0] -= np.max(lh_pia[:, 0])
+    # rh_pia[:, 0] -= np.min(rh_pia[:, 0])
 
-        neighbors = np.where(neighbor_vec < fundist * alpha_tweak)
 
-        if len(neighbors) > 5:
-            neighbors = np.where(neighbor_vec < np.sort(neighbor_vec)[5])
+    pia = np.vstack((lh_pia, rh_pia))
 
-        if len(neighbors) == 0:
-            closest = np.argmin(neighbors)
-            neighbors = np.where(neighbor_vec < closest * alpha_tweak)
+    e_pia = np.argmin(cdist(pia, emin), axis=0)
 
-        alpha[i, neighbors] = 1
+    snapped_electrodes_pial = np.zeros(snapped_electrodes.shape)
+    for ind, soln in enumerate(e_pia):
+        # elec.vertno = soln if soln < len(lh_pia) else soln - len(lh_pia)
+        # elec.hemi = 'lh' if soln < len(lh_pia) else 'rh'
+        snapped_electrodes_pial[ind] = pia[soln]
 
-        for j in range(i):
-            if alpha[j, i] == 1:
-                alpha[i, j] = 1
-            if alpha[i, j] == 1:
-                alpha[j, i] = 1
+    output_fname = op.join(subjects_dir, subject, 'electrodes', '{}_snap_electrodes'.format(grid_name))
+    save_snapped_electrodes(output_fname, snapped_electrodes, snapped_electrodes_pial, grid_results)
+    return snapped_electrodes, snapped_electrodes_pial
 
-    # alpha is set, now do the annealing
-    def energycost(e_new, e_old, alpha):
-        n = len(alpha)
 
-        dist_new = cdist(e_new, e_new)
-        dist_old = cdist(e_old, e_old)
+def save_snapped_electrodes(output_fname, snapped_electrodes, snapped_electrodes_pial, grid_results):
+    # The chains energies and traces are saved for QA. The traces are padded with nan to the longest chain
+    traces = grid_results['chains_traces']
+    chains_traces = np.full((len(traces), max([len(t) for t in traces]), 2), np.nan)
+    for chain_ind, trace in enumerate(traces):
+        chains_traces[chain_ind, :len(trace)] = trace
+    np.savez(output_fname, snapped_electrodes=snapped_electrodes, snapped_electrodes_pial=snapped_electrodes_pial,
+             chains_costs=grid_results['chains_costs'], chains_seeds=grid_results['chains_seeds'],
+             chains_traces=chains_traces)
 
-        H = 0
 
-        for i in range(n):
-            H += deformation_constant * float(cdist([e_new[i]], [e_old[i]]))
+def calc_springs_alpha(e_init):
+    '''
+    Sets the alpha parameter as described in Dykstra 2012. This parameter
+    controls which electrodes have virtual springs connected: the ones closer
+    than 1.75 times the most common distance between neighboring electrodes.
 
-            for j in range(i):
-                H += alpha[i, j] * (dist_new[i, j] - dist_old[i, j]) ** 2
+    Returns the (n, n) alpha matrix and the initial electrodes distances
+    '''
+    from scipy.spatial.distance import cdist
 
-        return H
+    n = e_init.shape[0]
+    init_dist = cdist(e_init, e_init)
 
-    # load the dural surface locations
-    lh_dura, _ = nib.freesurfer.read_geometry(
-        op.join(subjects_dir, subject, 'surf', 'lh.dural'))
+    # the neighbors of each electrode are the ones closer than its 6th
+    # closest electrode (including itself)
+    k_nei = np.min([n, 6])
+    nei_threshold = np.sort(init_dist, axis=0)[k_nei - 1]
+    neighbors_mask = (init_dist < nei_threshold) & (init_dist != 0)
+    # get distances from each neighbor pairing
+    neighbor_dists = init_dist[neighbors_mask]
 
-    rh_dura, _ = nib.freesurfer.read_geometry(
-        op.join(subjects_dir, subject, 'surf', 'rh.dural'))
+    # collect distance into histogram of resolution 0.2
+    max_dist = np.max(np.around(neighbor_dists))
+    min_dist = np.min(np.around(neighbor_dists))
+    hist, _ = np.histogram(neighbor_dists, bins=int((max_dist - min_dist) / 2), range=(min_dist, max_dist))
+    fundist = np.argmax(hist) * 2 + min_dist + 1
 
-    # lh_dura[:, 0] -= np.max(lh_dura[:, 0])
-    # rh_dura[:, 0] -= np.min(rh_dura[:, 0])
+    # apply fundist to alpha matrix
+    alpha_tweak = 1.75
+    alpha = (init_dist < fundist * alpha_tweak).astype(float)
+    np.fill_diagonal(alpha, 0)
+    return alpha, init_dist
 
-    # align the surfaces correctly
-    # in the tkRAS space
-    # orig = op.join( subjects_dir, subject, 'mri', 'orig.mgz' )
-    # ras2vox = np.linalg.inv(geo.get_vox2rasxfm( orig ))
-    # tkr = geo.get_vox2rasxfm(orig, 'vox2ras-tkr')
-    # lh_dura = np.array( geo.apply_affine( geo.apply_affine(lh_dura, ras2vox),
-    #    tkr))
-    # rh_dura = np.array( geo.apply_affine( geo.apply_affine(rh_dura, ras2vox),
-    #    tkr))
-    # lh_dura = geo.apply_affine( geo.apply_affine(lh_dura, ras2vox), tkr)
-    # rh_dura = geo.apply_affine( geo.apply_affine(rh_dura, ras2vox), tkr)
 
-    dura = np.vstack((lh_dura, rh_dura))
+def calc_energy(e, e_init, alpha, init_dist, deformation_constant=1.):
+    '''
+    The annealing objective: the electrodes displacement from their initial
+    positions, plus the deformation of the springs between them
+    '''
+    from scipy.spatial.distance import cdist
 
-    max_deformation = 3
-    deformation_choice = 50
+    displacement = np.sum(np.linalg.norm(e - e_init, axis=1))
+    deformation = np.sum(np.tril(alpha * (cdist(e, e) - init_dist) ** 2, -1))
+    return deformation_constant * displacement + deformation
+
+
+def calc_energy_delta(e, e1, new_pos, e_init, alpha, init_dist, deformation_constant=1.):
+    '''
+    The change of calc_energy when moving only electrode e1 to new_pos, in O(n)
+    '''
+    old_dists = np.linalg.norm(e - e[e1], axis=1)
+    new_dists = np.linalg.norm(e - new_pos, axis=1)
+    # alpha's diagonal is zero, so the e1 term is ignored
+    deformation_delta = np.dot(alpha[e1], (new_dists - init_dist[e1]) ** 2 - (old_dists - init_dist[e1]) ** 2)
+    displacement_delta = np.linalg.norm(new_pos - e_init[e1]) - np.linalg.norm(e[e1] - e_init[e1])
+    return deformation_constant * displacement_delta + deformation_delta
+
+
+def calc_candidates_verts(dura_tree, pos, deformation_choice=50, max_deformation=3):
+    '''
+    The dura vertices that are closer to pos than max_deformation times the
+    distance of its deformation_choice closest vertex
+    '''
+    dists, _ = dura_tree.query(pos, k=deformation_choice + 1)
+    max_dist = dists[-1] * max_deformation
+    candidate_verts = np.sort(np.array(dura_tree.query_ball_point(pos, max_dist), dtype=int))
+    # query_ball_point includes the vertices on the ball's surface
+    candidate_dists = np.linalg.norm(dura_tree.data[candidate_verts] - pos, axis=1)
+    return candidate_verts[candidate_dists < max_dist]
+
+
+def anneal_electrodes(elecs_pos, dura, dura_tree=None, max_steps=40000, giveup_steps=10000, init_temp=1e-3,
+                      temperature_exponent=1, deformation_constant=1., max_deformation=3, deformation_choice=50,
+                      log_prefix='', seed=None, return_trace=False):
+    '''
+    The simulated annealing of snap_electrodes_to_surface. Each step moves one
+    random electrode to a nearby dura vertex (found with the dura's KD-tree),
+    and updates the energy only for the moved electrode.
+
+    Returns the electrodes positions with the minimal energy, and the energy.
+    If seed is None, np.random's global state is used. If return_trace, the
+    (steps, 2) current and minimal energies of each step are returned too
+    '''
+    from scipy.spatial import cKDTree
+
+    if dura_tree is None:
+        dura_tree = cKDTree(dura)
+    rand = np.random if seed is None else np.random.RandomState(seed)
+    trace = np.zeros((max_steps, 2))
+    n = elecs_pos.shape[0]
+    e_init = np.array(elecs_pos)
+    alpha, init_dist = calc_springs_alpha(e_init)
 
     # adjust annealing parameters
     # H determines maximal number of steps
@@ -169,19 +240,20 @@ def snap_electrodes_to_surface(subject, elecs_pos, grid_name, subjects_dir,
     # Hbrk sets a break point for the annealing
     Hbrk = giveup_steps
 
-    h = 0;
+    h = 0
     hcnt = 0
+    steps_done = 0
     lowcost = mincost = 1e6
 
     # start e-init as greedy snap to surface
-    e_snapgreedy = dura[np.argmin(cdist(dura, e_init), axis=0)]
-
-    e = np.array(e_snapgreedy).copy()
-    emin = np.array(e_snapgreedy).copy()
+    _, greedy_verts = dura_tree.query(e_init)
+    e = dura[greedy_verts]
+    emin = e.copy()
+    cost_e = calc_energy(e, e_init, alpha, init_dist, deformation_constant)
 
     # the annealing schedule continues until the maximum number of moves
     while h < H:
-        h += 1;
+        h += 1
         hcnt += 1
         # terminate if no moves have been made for a long time
         if hcnt > Hbrk:
@@ -191,74 +263,72 @@ def snap_electrodes_to_surface(subject, elecs_pos, grid_name, subjects_dir,
         T = T0 * (Texp ** h)
 
         # select a random electrode
-        e1 = np.random.randint(n)
+        e1 = rand.randint(n)
         # transpose it with a *nearby* point on the surface
+        candidate_verts = calc_candidates_verts(dura_tree, e[e1], deformation_choice, max_deformation)
+        choice_vert = candidate_verts[rand.randint(len(candidate_verts))]
 
-        # find distances from this point to all points on the surface
-        dists = np.squeeze(cdist(dura, [e[e1]]))
-        # take a distance within the minimum 5X
-
-        # mindist = np.min(dists)
-        mindist = np.sort(dists)[deformation_choice]
-        candidate_verts, = np.where(dists < mindist * max_deformation)
-        choice_vert = candidate_verts[np.random.randint(len(candidate_verts))]
+        cost = cost_e + calc_energy_delta(e, e1, dura[choice_vert], e_init, alpha, init_dist, deformation_constant)
 
-        e_tmp = e.copy()
-        # print choice_vert
-        # print np.shape(candidate_verts)
-        e_tmp[e1] = dura[choice_vert]
-
-        cost = energycost(e_tmp, e_init, alpha)
-
-        if cost < lowcost or np.random.random() < np.exp(-(cost - lowcost) / T):
-            e = e_tmp
-            lowcost = cost
+        if cost < lowcost or rand.random_sample() < np.exp(-(cost - lowcost) / T):
+            e[e1] = dura[choice_vert]
+            lowcost = cost_e = cost
 
             if cost < mincost:
-                emin = e
+                emin = e.copy()
                 mincost = cost
                 print('step %i ... current lowest cost = %f' % (h, mincost))
                 hcnt = 0
 
-            if mincost == 0:
-                break
+        trace[h - 1] = (cost_e, mincost)
+        steps_done = h
+        if mincost == 0:
+            break
         if h % 200 == 0:
-            print('%s %s: step %i ... final lowest cost = %f' % (subject, grid_name, h, mincost))
+            print('%s: step %i ... final lowest cost = %f' % (log_prefix, h, mincost))
 
-    # return the emin coordinates
-    for ind, loc in enumerate(emin):
-        snapped_electrodes[ind] = loc
+    if return_trace:
+        return emin, mincost, trace[:steps_done]
+    return emin, mincost
 
-    # return the nearest vertex on the pial surface
-    lh_pia, _ = nib.freesurfer.read_geometry(
-        op.join(subjects_dir, subject, 'surf', 'lh.pial'))
 
-    rh_pia, _ = nib.freesurfer.read_geometry(
-        op.join(subjects_dir, subject, 'surf', 'rh.pial'))
-
-    # expand the pial surfaces slightly to better visualize the electrodes
-    # lh_pia =geo.expand_triangular_mesh(lh_pia, com_bias=(-2, 0, 0), offset=18)
-    # rh_pia = geo.expand_triangular_mesh(rh_pia, com_bias=(2, 0, 0), offset=18)
+def _anneal_electrodes_parallel(p):
+    chain_name, elecs_pos, dura, seed, anneal_kwargs = p
+    emin, mincost, trace = anneal_electrodes(
+        elecs_pos, dura, log_prefix=chain_name, seed=seed, return_trace=True, **anneal_kwargs)
+    return emin, mincost, trace
 
 
-    # adjust x-axis offsets as pysurfer illogically does as hard-coded step
-    # lh_pia[:, 0] -= np.max(lh_pia[:, 0])
-    # rh_pia[:, 0] -= np.min(rh_pia[:, 0])
-
-
-    pia = np.vstack((lh_pia, rh_pia))
-
-    e_pia = np.argmin(cdist(pia, emin), axis=0)
-
-    snapped_electrodes_pial = np.zeros(snapped_electrodes.shape)
-    for ind, soln in enumerate(e_pia):
-        # elec.vertno = soln if soln < len(lh_pia) else soln - len(lh_pia)
-        # elec.hemi = 'lh' if soln < len(lh_pia) else 'rh'
-        snapped_electrodes_pial[ind] = pia[soln]
+def anneal_grids_chains(grids_pos, dura, chains_num=1, n_jobs=1, seed=None, **anneal_kwargs):
+    '''
+    Runs chains_num annealing chains with different seeds for each grid in
+    grids_pos (grid name -> electrodes positions). All the grids' chains are
+    run together across n_jobs processes.
 
-    output_fname = op.join(subjects_dir, subject, 'electrodes', '{}_snap_electrodes'.format(grid_name))
-    np.savez(output_fname, snapped_electrodes=snapped_electrodes, snapped_electrodes_pial=snapped_electrodes_pial)
-    return snapped_electrodes, snapped_electrodes_pial
+    Returns for each grid the lowest energy chain's positions and energy, and
+    all the chains' energies, seeds and energy traces (for QA)
+    '''
+    if seed is None:
+        seed = np.random.randint(2 ** 31 - chains_num * len(grids_pos))
+    grids_names = list(grids_pos.keys())
+    params, seeds = [], {}
+    for grid_ind, grid_name in enumerate(grids_names):
+        seeds[grid_name] = seed + grid_ind * chains_num + np.arange(chains_num)
+        for chain_ind, chain_seed in enumerate(seeds[grid_name]):
+            params.append(('{} chain {}'.format(grid_name, chain_ind), np.array(grids_pos[grid_name]), dura,
+                           chain_seed, anneal_kwargs))
+    results = utils.run_parallel(_anneal_electrodes_parallel, params, min(n_jobs, len(params)))
+    grids_results = {}
+    for grid_ind, grid_name in enumerate(grids_names):
+        grid_results = results[grid_ind * chains_num: (grid_ind + 1) * chains_num]
+        costs = np.array([mincost for _, mincost, _ in grid_results])
+        best_chain = np.argmin(costs)
+        print('{}: chains lowest costs: {}, taking chain {}'.format(
+            grid_name, ', '.join(['{:.3f}'.format(c) for c in costs]), best_chain))
+        grids_results[grid_name] = dict(
+            emin=grid_results[best_chain][0], mincost=costs[best_chain], chains_costs=costs,
+            chains_seeds=seeds[grid_name], chains_traces=[trace for _, _, trace in grid_results])
+    return grids_results
 
 
 def create_dural_surface(subject, subjects_dir):
@@ -210,33 +210,34 @@ def fix_unknown_labels(subject, atlas):
     return utils.both_hemi_files_exist(op.join(SUBJECTS_DIR, subject, 'label', '{}-{}.annot'.format(atlas, '{hemi}')))
 
 
-def create_vertices_labels_lookup(subject, atlas, save_labels_ids=False, overwrite=False, read_labels_from_fol=''):
+def create_vertices_labels_ids_lookup(subject, atlas, overwrite=False, read_labels_from_fol=''):
+    # Per hemi, (vertices_labels_ids, labels_names): the vertices labels ids are indices in labels_names (the order of
+    # read_labels), saved as an int32 array in MMVT_DIR/subject/labels/{atlas}_vertices_labels_ids_{hemi}.npz
 
     def check_loopup_is_ok(lookup):
-        unique_values_num = sum([len(set(lookup[hemi].values())) for hemi in utils.HEMIS])
+        unique_values_num = sum([len(np.unique(lookup[hemi][0])) for hemi in utils.HEMIS])
         # check it's not only the unknowns
         lookup_ok = unique_values_num > 2
         err = ''
         if not lookup_ok:
             err = 'unique_values_num = {}\n'.format(unique_values_num)
         for hemi in utils.HEMIS:
-            verts, _ = utils.read_pial(subject, MMVT_DIR, hemi)
-            lookup_ok = lookup_ok and len(lookup[hemi].keys()) == len(verts)
+            no_label_verts_num = np.sum(lookup[hemi][0] < 0)
+            lookup_ok = lookup_ok and no_label_verts_num == 0
             if not lookup_ok:
-                err += 'len(lookup[{}].keys()) != len(verts) ({}!={})\n'.format(hemi, len(lookup[hemi].keys()), len(verts))
+                err += '{} vertices without a label in {}\n'.format(no_label_verts_num, hemi)
         return lookup_ok, err
 
-    output_fname = op.join(MMVT_DIR, subject, '{}_vertices_labels_{}lookup.pkl'.format(
-        atlas, 'ids_' if save_labels_ids else ''))
-    if op.isfile(output_fname) and not overwrite:
-        lookup = utils.load(output_fname)
+    subject_fol = op.join(MMVT_DIR, subject)
+    output_fname = utils.get_vertices_labels_ids_fname(subject_fol, atlas, '{hemi}')
+    if utils.both_hemi_files_exist(output_fname) and not overwrite:
+        lookup = {hemi: utils.load_vertices_labels_ids(subject_fol, atlas, hemi) for hemi in utils.HEMIS}
         loopup_is_ok, _ = check_loopup_is_ok(lookup)
         if loopup_is_ok:
             return lookup
     lookup = {}
 
     for hemi in utils.HEMIS:
-        lookup[hemi] = {}
         if read_labels_from_fol != '':
             labels = read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi, try_first_from_annotation=False,
                                  labels_fol=read_labels_from_fol)
@@ -265,29 +266,53 @@ def create_vertices_labels_lookup(subject, atlas, save_labels_ids=False, overwri
         if len([l for l in labels_names if 'unknown' in l.lower()]) == 0:
             raise Exception('No unknown label in {}'.format(annot_fname))
         verts, _ = utils.read_pial(subject, MMVT_DIR, hemi)
-        verts_indices = set(range(len(verts)))
-        for label in labels:
-            for vertice in label.vertices:
-                if vertice in verts_indices:
-                    lookup[hemi][vertice] = labels_names.index(label.name) if save_labels_ids else label.name
-                else:
-                    print('vertice {} of label {} not in verts! ({}, {})'.format(vertice, label.name, subject, hemi))
+        vertices_labels_ids = np.ones(len(verts), dtype=np.int32) * -1
+        for label_ind, label in enumerate(labels):
+            label_vertices = label.vertices[label.vertices < len(verts)]
+            if len(label_vertices) < len(label.vertices):
+                print('{} vertices of label {} not in verts! ({}, {})'.format(
+                    len(label.vertices) - len(label_vertices), label.name, subject, hemi))
+            vertices_labels_ids[label_vertices] = label_ind
+        lookup[hemi] = (vertices_labels_ids, np.array(labels_names))
     loopup_is_ok, err = check_loopup_is_ok(lookup)
     if loopup_is_ok:
-        utils.save(lookup, output_fname)
+        for hemi in utils.HEMIS:
+            utils.save_vertices_labels_ids(subject_fol, atlas, hemi, *lookup[hemi])
         return lookup
     else:
         print('unknown labels: ', [l for l in labels_names if 'unknown' in l])
         raise Exception('Error in vertices_labels_lookup!\n{}'.format(err))
 
 
+def remap_vertices_labels_ids(vertices_labels_ids, labels_names, labels, default_ind=-1):
+    # The lookup file can also be written by the addon (from the annotation, sorted by names), so its ids are mapped
+    # through its labels names to the indices in labels. Vertices without a label, or with a label that isn't in labels,
+    # get default_ind
+    labels_inds = {label.name: ind for ind, label in enumerate(labels)}
+    names_inds = np.array([labels_inds.get(name, default_ind) for name in labels_names] + [default_ind], dtype=np.int32)
+    return names_inds[vertices_labels_ids]
+
+
+def create_vertices_labels_lookup(subject, atlas, save_labels_ids=False, overwrite=False, read_labels_from_fol=''):
+    # A {hemi: {vertex: label name (or id)}} view of create_vertices_labels_ids_lookup
+    ids_lookup = create_vertices_labels_ids_lookup(subject, atlas, overwrite, read_labels_from_fol)
+    lookup = {}
+    for hemi in utils.HEMIS:
+        vertices_labels_ids, labels_names = ids_lookup[hemi]
+        vertices = np.where(vertices_labels_ids >= 0)[0]
+        values = vertices_labels_ids[vertices] if save_labels_ids else labels_names[vertices_labels_ids[vertices]]
+        lookup[hemi] = dict(zip(vertices.tolist(), values.tolist()))
+    return lookup
+
+
 def find_label_vertices(subject, atlas, hemi, vertices, label_template='*'):
     import re
-    vertices_labels_lookup = create_vertices_labels_lookup(subject, atlas)
+    vertices_labels_ids, labels_names = create_vertices_labels_ids_lookup(subject, atlas)[hemi]
     label_re_template = re.compile(label_template) if label_template != '*' else None
     label_vertices, label_vertices_indices = [], []
     for vert_ind, vert in enumerate(vertices):
-        vert_label = vertices_labels_lookup[hemi].get(vert, '')
+        vert_label = labels_names[vertices_labels_ids[vert]] if 0 <= vert < len(vertices_labels_ids) and \
+            vertices_labels_ids[vert] >= 0 else ''
         if vert_label == '':
             print('find_pick_activity: No label for vert {}'.format(vert))
             continue
@@ -734,18 +759,69 @@ def remove_exclude_labels_and_data(labels_names, labels_data, excludes=()):
     return labels_names, labels_data
 
 
-def calc_time_series_per_label(x, labels, measure, excludes=(),
-                               figures_dir='', do_plot=False, do_plot_all_vertices=False):
+def calc_labels_averaging_matrix(labels, vertices_num):
+    # A sparse (labels x vertices) matrix, where each row is 1 / label's vertices num over the label's vertices,
+    # so avg.dot(x) is the mean of x over each label
+    import scipy.sparse
+    labels_vertices = [np.unique(label.vertices) for label in labels]
+    rows = np.concatenate([np.ones(len(verts), dtype=int) * ind for ind, verts in enumerate(labels_vertices)])
+    cols = np.concatenate(labels_vertices).astype(int)
+    vals = np.concatenate([np.ones(len(verts)) / len(verts) for verts in labels_vertices])
+    return scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(labels), vertices_num))
+
+
+def calc_labels_mean_and_std(x, labels, max_chunk_size=5e7):
+    # One pass over x (vertices x 1 x 1 x T) in time chunks: the labels mean is avg.dot(x) and the std is
+    # calculated from the mean of the squares
+    avg = calc_labels_averaging_matrix(labels, x.shape[0])
+    T = x.shape[-1]
+    labels_mean, labels_sq_mean = np.zeros((len(labels), T)), np.zeros((len(labels), T))
+    chunk_len = max(1, int(max_chunk_size / x.shape[0]))
+    for t in range(0, T, chunk_len):
+        x_chunk = np.asarray(x[:, 0, 0, t:t + chunk_len], dtype=np.float64)
+        labels_mean[:, t:t + chunk_len] = avg.dot(x_chunk)
+        labels_sq_mean[:, t:t + chunk_len] = avg.dot(x_chunk ** 2)
+    labels_std = np.sqrt(np.maximum(labels_sq_mean - labels_mean ** 2, 0))
+    # Like np.mean of no vertices
+    empty_labels = np.where(np.diff(avg.indptr) == 0)[0]
+    labels_mean[empty_labels], labels_std[empty_labels] = np.nan, np.nan
+    return labels_mean, labels_std
+
+
+def _calc_labels_pca_parallel(p):
+    labels_x, comps_num = p
     import sklearn.decomposition as deco
+    labels_data = np.zeros((len(labels_x), labels_x[0].shape[0], comps_num))
+    for ind, _x in enumerate(labels_x):
+        remove_cols = np.where(np.all(_x == np.mean(_x, 0), 0))[0]
+        _x = np.delete(_x, remove_cols, 1)
+        _x = (_x - np.mean(_x, 0)) / np.std(_x, 0)
+        pca = deco.PCA(comps_num)
+        labels_data[ind] = pca.fit(_x).transform(_x)
+    return labels_data
+
+
+def calc_time_series_per_label(x, labels, measure, excludes=(), figures_dir='', do_plot=False,
+                               do_plot_all_vertices=False, n_jobs=1, max_chunk_size=5e7):
     import matplotlib.pyplot as plt
 
     labels, _ = remove_exclude_labels(labels, excludes)
-    if measure.startswith('pca'):
+    labels_names = [label.name for label in labels]
+    if measure == 'mean':
+        labels_data, _ = calc_labels_mean_and_std(x, labels, max_chunk_size)
+    elif measure == 'cv': #''coef_of_variation':
+        labels_mean, labels_std = calc_labels_mean_and_std(x, labels, max_chunk_size)
+        labels_data = labels_std / labels_mean
+    elif measure.startswith('pca'):
         comps_num = 1 if '_' not in measure else int(measure.split('_')[1])
-        labels_data = np.zeros((len(labels), x.shape[-1], comps_num))
+        n_jobs = utils.get_n_jobs(n_jobs)
+        indices_chunks = np.array_split(np.arange(len(labels)), min(n_jobs, len(labels)))
+        params = [([x[labels[ind].vertices, 0, 0, :].T for ind in indices], comps_num)
+                  for indices in indices_chunks if len(indices) > 0]
+        labels_data = np.concatenate(utils.run_parallel(_calc_labels_pca_parallel, params, n_jobs))
     else:
         labels_data = np.zeros((len(labels), x.shape[-1]))
-    labels_names = []
+
     if do_plot_all_vertices:
         all_vertices_plots_dir = op.join(figures_dir, 'all_vertices')
         utils.make_dir(all_vertices_plots_dir)
@@ -753,26 +829,6 @@ def calc_time_series_per_label(x, labels, measure, excludes=(),
         measure_plots_dir = op.join(figures_dir, measure)
         utils.make_dir(measure_plots_dir)
     for ind, label in enumerate(labels):
-        if measure == 'mean':
-            labels_data[ind, :] = np.mean(x[label.vertices, 0, 0, :], 0)
-        elif measure.startswith('pca'):
-            print(label)
-            _x = x[label.vertices, 0, 0, :].T
-            remove_cols = np.where(np.all(_x == np.mean(_x, 0), 0))[0]
-            _x = np.delete(_x, remove_cols, 1)
-            _x = (_x - np.mean(_x, 0)) / np.std(_x, 0)
-            comps = 1 if '_' not in measure else int(measure.split('_')[1])
-            pca = deco.PCA(comps)
-            x_r = pca.fit(_x).transform(_x)
-            # if x_r.shape[1] == 1:
-            labels_data[ind, :] = x_r
-            # else:
-            #     labels_data[ind, :] = x_r
-        elif measure == 'cv': #''coef_of_variation':
-            label_mean = np.mean(x[label.vertices, 0, 0, :], 0)
-            label_std = np.std(x[label.vertices, 0, 0, :], 0)
-            labels_data[ind, :] = label_std / label_mean
-        labels_names.append(label.name)
         if do_plot_all_vertices:
             plt.figure()
             plt.plot(x[label.vertices, 0, 0, :].T)
@@ -894,6 +950,26 @@ def grow_label(subject, vertice_indice, hemi, new_label_name, new_label_r=5, n_j
     return new_label_fname
 
 
+def calc_clusters_labels_overlaps(clusters, labels):
+    # A sparse (clusters x labels) matrix of the overlapped vertices num, from the clusters and labels
+    # (vertices x labels) incidence matrices
+    import scipy.sparse
+    clusters_vertices = [np.unique(cluster).astype(int) for cluster in clusters]
+    labels_vertices = [np.unique(label.vertices).astype(int) for label in labels]
+    vertices_num = max([verts[-1] + 1 for verts in clusters_vertices + labels_vertices if len(verts) > 0] + [0])
+
+    def incidence_matrix(vertices_lists):
+        rows = np.concatenate([np.ones(len(verts), dtype=int) * ind for ind, verts in enumerate(vertices_lists)] +
+                              [np.zeros(0, dtype=int)])
+        cols = np.concatenate(vertices_lists + [np.zeros(0, dtype=int)])
+        return scipy.sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(vertices_lists), vertices_num))
+
+    overlaps = incidence_matrix(clusters_vertices).dot(incidence_matrix(labels_vertices).T).tocsr()
+    overlaps.sort_indices()
+    return overlaps
+
+
 def find_clusters_overlapped_labeles(subject, clusters, data, atlas, hemi, verts,
                                      min_cluster_max=0, min_cluster_size=0, clusters_label='', n_jobs=6):
     cluster_labels = []
@@ -905,27 +981,28 @@ def find_clusters_overlapped_labeles(subject, clusters, data, atlas, hemi, verts
     if len(labels) == 0:
         print('No labels!')
         return None
+    labels = [label for label in labels if 'unknown' not in label.name]
+    clusters_max, clusters_max_vert, overlap_clusters = [], [], []
     for cluster in clusters:
         x = data[cluster]
         cluster_max = np.min(x) if abs(np.min(x)) > abs(np.max(x)) else np.max(x)
         if abs(cluster_max) < min_cluster_max or len(cluster) < min_cluster_size:
             continue
         max_vert_ind = np.argmin(x) if abs(np.min(x)) > abs(np.max(x)) else np.argmax(x)
-        max_vert = cluster[max_vert_ind]
-        inter_labels, inter_labels_tups = [], []
-        for label in labels:
-            overlapped_vertices = np.intersect1d(cluster, label.vertices)
-            if len(overlapped_vertices) > 0:
-                if 'unknown' not in label.name:
-                    inter_labels_tups.append((len(overlapped_vertices), label.name))
-                    # inter_labels.append(dict(name=label.name, num=len(overlapped_vertices)))
-        inter_labels_tups = sorted(inter_labels_tups)[::-1]
-        for inter_labels_tup in inter_labels_tups:
-            inter_labels.append(dict(name=inter_labels_tup[1], num=inter_labels_tup[0]))
+        clusters_max.append(cluster_max)
+        clusters_max_vert.append(cluster[max_vert_ind])
+        overlap_clusters.append(cluster)
+    # The overlapped vertices num of every (cluster, label) pair, in one sparse product
+    overlaps = calc_clusters_labels_overlaps(overlap_clusters, labels)
+    for cluster_ind, cluster in enumerate(overlap_clusters):
+        row = slice(overlaps.indptr[cluster_ind], overlaps.indptr[cluster_ind + 1])
+        inter_labels_tups = sorted([(int(num), labels[label_ind].name) for label_ind, num in zip(
+            overlaps.indices[row], overlaps.data[row]) if num > 0])[::-1]
+        inter_labels = [dict(name=name, num=num) for num, name in inter_labels_tups]
         if len(inter_labels) > 0 and (clusters_label in inter_labels[0]['name'] or clusters_label == ''):
-            # max_inter = max([(il['num'], il['name']) for il in inter_labels])
-            cluster_labels.append(dict(vertices=cluster, intersects=inter_labels, name=inter_labels[0]['name'],
-                coordinates=verts[cluster], max=cluster_max, hemi=hemi, size=len(cluster), max_vert=max_vert))
+            cluster_labels.append(dict(
+                vertices=cluster, intersects=inter_labels, name=inter_labels[0]['name'], coordinates=verts[cluster],
+                max=clusters_max[cluster_ind], hemi=hemi, size=len(cluster), max_vert=clusters_max_vert[cluster_ind]))
         else:
             print('No intersected labels!')
     return cluster_labels
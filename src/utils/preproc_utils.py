@@ -16,6 +16,100 @@ from src.utils import args_utils as au
 LINKS_DIR = utils.get_links_dir()
 SUBJECTS_DIR = utils.get_link_dir(LINKS_DIR, 'subjects', 'SUBJECTS_DIR')
 MMVT_DIR = op.join(LINKS_DIR, 'mmvt')
+STEPS_CACHE_FOL = 'steps_cache'
+_steps_report = defaultdict(list)
+
+
+def calc_file_hash(fname, block_size=2 ** 20):
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def calc_files_fingerprints(fnames, prev_fingerprints=None):
+    # (size, mtime, sha1) per existing file. The hash is recalculated only if the size or mtime were changed
+    prev_fingerprints = {} if prev_fingerprints is None else prev_fingerprints
+    fingerprints = {}
+    for fname in fnames:
+        if not op.isfile(fname):
+            continue
+        size, mtime = op.getsize(fname), op.getmtime(fname)
+        prev = prev_fingerprints.get(fname, None)
+        file_hash = prev[2] if prev is not None and prev[:2] == (size, mtime) else calc_file_hash(fname)
+        fingerprints[fname] = (size, mtime, file_hash)
+    return fingerprints
+
+
+def files_fingerprints_match(fnames, fingerprints):
+    existing_fnames = [fname for fname in fnames if op.isfile(fname)]
+    if set(existing_fnames) != set(fingerprints.keys()):
+        return False
+    for fname in existing_fnames:
+        size, mtime, file_hash = fingerprints[fname]
+        if op.getsize(fname) != size:
+            return False
+        # A touched file with the same content is fine
+        if op.getmtime(fname) != mtime and calc_file_hash(fname) != file_hash:
+            return False
+    return True
+
+
+def expand_files(fnames):
+    return sorted(set(utils.flat_list([glob.glob(fname) if '*' in fname else [fname] for fname in fnames])))
+
+
+def get_step_record_fname(subject, step_name):
+    return op.join(MMVT_DIR, subject, STEPS_CACHE_FOL, '{}.pkl'.format(step_name))
+
+
+def run_cached_step(subject, args, step_name, step_func, overwrite=False, inputs=(), outputs=(), args_keys=()):
+    # Calls step_func(overwrite), unless the step's fingerprint (its inputs and outputs files and the relevant args)
+    # matches the one recorded in its last successful run. If the fingerprint was changed, the step is rerun with
+    # overwrite=True, because the steps check only if their outputs exist
+    inputs, outputs = expand_files(inputs), expand_files(outputs)
+    step_args = {k: repr(args.get(k, None)) for k in args_keys}
+    record_fname = get_step_record_fname(subject, step_name)
+    record = utils.load(record_fname) if op.isfile(record_fname) else None
+    if not args.get('steps_cache', True) or step_name in args.get('force_steps', []):
+        status = 'forced'
+    elif record is None:
+        status = 'ran'
+    elif record['args'] == step_args and len(outputs) > 0 and all([op.isfile(f) for f in outputs]) and \
+            files_fingerprints_match(inputs, record['inputs']) and files_fingerprints_match(outputs, record['outputs']):
+        status = 'skipped'
+    else:
+        status, overwrite = 'invalidated', True
+    _steps_report[subject].append((step_name, status))
+    print('{}: {}'.format(step_name, status))
+    if status == 'skipped':
+        # Updates the mtimes of touched files, so their hash won't be calculated again
+        utils.save(dict(args=step_args, inputs=calc_files_fingerprints(inputs, record['inputs']),
+                        outputs=calc_files_fingerprints(outputs, record['outputs'])), record_fname)
+        return True
+    ret = step_func(overwrite)
+    success = ret if isinstance(ret, bool) else ret is not None
+    if success:
+        utils.make_dir(op.join(MMVT_DIR, subject, STEPS_CACHE_FOL))
+        prev_inputs = record['inputs'] if record is not None else None
+        utils.save(dict(args=step_args, inputs=calc_files_fingerprints(inputs, prev_inputs),
+                        outputs=calc_files_fingerprints(outputs)), record_fname)
+    elif op.isfile(record_fname):
+        os.remove(record_fname)
+    return ret
+
+
+def print_steps_report(subjects):
+    if not any([len(_steps_report[subject]) > 0 for subject in subjects]):
+        return
+    print('Steps cache report:')
+    logging.info('Steps cache report:')
+    for subject in subjects:
+        for step_name, status in _steps_report[subject]:
+            print('{}: {} {}'.format(subject, step_name, status))
+            logging.info('{}: {} {}'.format(subject, step_name, status))
 
 
 def decode_subjects(subjects, remote_subject_dir=''):
@@ -68,6 +162,8 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
         print('remote dir: {}'.format(remote_subject_dir))
         print('****************************************************************')
         os.environ['SUBJECT'] = subject
+        # The parallel workers are forked with the previous subject's globals
+        utils.shutdown_pool()
         flags = dict()
         try:
             # if utils.should_run(args, 'prepare_subject_folder'):
@@ -117,6 +213,7 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
             good_subjects.append(subject)
         else:
             bad_subjects.append(subject)
+    print_steps_report(list(subjects_flags.keys()) + list(subjects_errors.keys()))
     print('Good subjects:\n {}'.format(good_subjects))
     logging.info('Good subjects:\n {}'.format(good_subjects))
     print('Bad subjects:\n {}'.format(bad_subjects))
@@ -189,6 +286,10 @@ def add_common_args(parser):
     parser.add_argument('--sftp_port', help='sftp port', required=False, default=22, type=int)
     parser.add_argument('--sftp_password', help='sftp port', required=False, default='')
     parser.add_argument('--print_traceback', help='print_traceback', required=False, default=1, type=au.is_true)
+    parser.add_argument('--steps_cache', help='skip the steps with unchanged inputs, outputs and args', required=False,
+                        default=1, type=au.is_true)
+    parser.add_argument('--force_steps', help='steps to rerun regardless the steps cache', required=False,
+                        default='', type=au.str_arr_type)
 
     # global folders
     parser.add_argument('--meg_dir', required=False, default='')
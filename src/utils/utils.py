@@ -25,6 +25,7 @@ import os.path as op
 # import types
 import traceback
 import multiprocessing
+import atexit
 import getpass
 
 try:
@@ -81,6 +82,18 @@ namebase = mu.namebase
 check_if_atlas_exist = mu.check_if_atlas_exist
 get_label_for_full_fname = mu.get_label_for_full_fname
 to_str = mu.to_str
+activity_cube_fnames = mu.activity_cube_fnames
+save_activity_cube = mu.save_activity_cube
+save_activity_cube_header = mu.save_activity_cube_header
+save_activity_cube_frame = mu.save_activity_cube_frame
+load_activity_cube = mu.load_activity_cube
+activity_map_exists = mu.activity_map_exists
+faces_verts_lookup_exists = mu.faces_verts_lookup_exists
+load_faces_verts_lookup = mu.load_faces_verts_lookup
+faces_verts_lookup_fname = mu.faces_verts_lookup_fname
+get_vertices_labels_ids_fname = mu.get_vertices_labels_ids_fname
+save_vertices_labels_ids = mu.save_vertices_labels_ids
+load_vertices_labels_ids = mu.load_vertices_labels_ids
 
 from src.mmvt_addon.scripts import scripts_utils as su
 get_link_dir = su.get_link_dir
@@ -103,6 +116,8 @@ import uuid
 PLY_HEADER = 'ply\nformat ascii 1.0\nelement vertex {}\nproperty float x\nproperty float y\nproperty float z\nelement face {}\nproperty list uchar int vertex_index\nend_header\n'
 STAT_AVG, STAT_DIFF = range(2)
 HEMIS = ['lh', 'rh']
+_surfaces_cache = {}
+_pool = None
 
 
 def get_exisiting_dir(dirs):
@@ -133,11 +148,52 @@ def get_scalar_map(x_min, x_max, color_map='jet'):
     return cmx.ScalarMappable(norm=cNorm, cmap=cm)
 
 
+# The colors maps lookup tables, shared by all the coloring calls
+_colors_luts = {}
+
+
+def get_colors_lut(colors_map='jet'):
+    # The colors map's RGBA table (colors_map.N x 4), which matplotlib's to_rgba indexes into
+    if not isinstance(colors_map, str):
+        return colors_map(np.arange(colors_map.N))
+    if colors_map not in _colors_luts:
+        cm = plt.get_cmap(colors_map)
+        _colors_luts[colors_map] = cm(np.arange(cm.N))
+    return _colors_luts[colors_map]
+
+
+def _to_float_array(x):
+    # Like matplotlib's Normalize, ints are converted to floats, and float32 stays float32
+    x = np.asarray(x)
+    return x.astype(np.promote_types(x.dtype, np.float32) if x.dtype.kind in 'biu' else x.dtype)
+
+
+def calc_lut_colors(x, x_min, x_max, colors_map='jet'):
+    # Same as get_scalar_map(x_min, x_max, colors_map).to_rgba(x), for any x shape, in one vectorized pass
+    lut = get_colors_lut(colors_map)
+    colors_num = len(lut)
+    norm = np.array(_to_float_array(x), copy=True)
+    vmin, vmax = _to_float_array(x_min), _to_float_array(x_max)
+    if vmin == vmax:
+        norm.fill(0)
+    else:
+        norm -= vmin
+        norm /= (vmax - vmin)
+    norm *= colors_num
+    nan_inds = np.isnan(norm)
+    # Values out of [x_min, x_max] get the colors map's edges colors
+    np.clip(norm, 0, colors_num - 1, out=norm)
+    norm[nan_inds] = 0
+    colors = lut[norm.astype(int)]
+    colors[nan_inds] = 0
+    return colors
+
+
 def arr_to_colors(x, x_min=None, x_max=None, colors_map='jet', scalar_map=None, norm_percs=(1, 99)):
-    if scalar_map is None:
-        x_min, x_max = calc_min_max(x, x_min, x_max, norm_percs)
-        scalar_map = get_scalar_map(x_min, x_max, colors_map)
-    return scalar_map.to_rgba(x)
+    if scalar_map is not None:
+        return scalar_map.to_rgba(x)
+    x_min, x_max = calc_min_max(x, x_min, x_max, norm_percs)
+    return calc_lut_colors(x, x_min, x_max, colors_map)
 
 
 def mat_to_colors(x, x_min=None, x_max=None, colorsMap='jet', scalar_map=None, flip_cm=False):
@@ -158,22 +214,31 @@ def mat_to_colors(x, x_min=None, x_max=None, colorsMap='jet', scalar_map=None, f
 def arr_to_colors_two_colors_maps(x, x_min=None, x_max=None, cm_big='YlOrRd', cm_small='PuBu', threshold=0, default_val=0,
                                   scalar_map_big=None, scalar_map_small=None, flip_cm_big=False, flip_cm_small=False,
                                   norm_percs=(3, 97), norm_by_percentile=True):
-    colors = np.ones((len(x), 3)) * default_val
     norm_percs = norm_percs if norm_by_percentile else None
     x_min, x_max = calc_min_max(x, x_min, x_max, norm_percs)
+    return calc_two_colors_maps_colors(
+        x, x_min, x_max, cm_big, cm_small, threshold, default_val, scalar_map_big, scalar_map_small,
+        flip_cm_big, flip_cm_small)
 
-    if np.sum(x >= threshold) > 0:
+
+def calc_two_colors_maps_colors(x, x_min, x_max, cm_big='YlOrRd', cm_small='PuBu', threshold=0, default_val=0,
+                                scalar_map_big=None, scalar_map_small=None, flip_cm_big=False, flip_cm_small=False):
+    # Colors x (any shape) using cm_big for the values above the threshold, and cm_small for the values below -threshold
+    colors = np.ones(np.shape(x) + (3,)) * default_val
+    big_inds = x >= threshold
+    if np.any(big_inds):
         if not flip_cm_big:
-            big_colors = arr_to_colors(x[x >= threshold], threshold, x_max, cm_big, scalar_map_big)[:, :3]
+            big_colors = arr_to_colors(x[big_inds], threshold, x_max, cm_big, scalar_map_big)[:, :3]
         else:
-            big_colors = arr_to_colors(-x[x >= threshold], -x_max, -threshold, cm_big, scalar_map_big)[:, :3]
-        colors[x >= threshold, :] = big_colors
-    if np.sum(x <= -threshold) > 0:
+            big_colors = arr_to_colors(-x[big_inds], -x_max, -threshold, cm_big, scalar_map_big)[:, :3]
+        colors[big_inds] = big_colors
+    small_inds = x <= -threshold
+    if np.any(small_inds):
         if not flip_cm_small:
-            small_colors = arr_to_colors(x[x <= -threshold], x_min, -threshold, cm_small, scalar_map_small)[:, :3]
+            small_colors = arr_to_colors(x[small_inds], x_min, -threshold, cm_small, scalar_map_small)[:, :3]
         else:
-            small_colors = arr_to_colors(-x[x <= -threshold], threshold, -x_min, cm_small, scalar_map_small)[:, :3]
-        colors[x<=-threshold, :] = small_colors
+            small_colors = arr_to_colors(-x[small_inds], threshold, -x_min, cm_small, scalar_map_small)[:, :3]
+        colors[small_inds] = small_colors
     return colors
 
 
@@ -197,19 +262,13 @@ def calc_minmax_from_arr(hemi_minmax):
 def mat_to_colors_two_colors_maps(x, x_min=None, x_max=None, cm_big='YlOrRd', cm_small='PuBu', threshold=0, default_val=0,
         scalar_map_big=None, scalar_map_small=None, flip_cm_big=False, flip_cm_small=False, min_is_abs_max=False,
         norm_percs = None):
-    colors = np.ones((x.shape[0],x.shape[1], 3)) * default_val
     x_min, x_max = calc_min_max(x, x_min, x_max, norm_percs)
     if min_is_abs_max:
         x_max = max(map(abs, [x_min, x_max]))
         x_min = -x_max
-    # scalar_map_pos = get_scalar_map(threshold, x_max, cm_big)
-    # scalar_map_neg = get_scalar_map(x_min, -threshold, cm_small)
-    # todo: calculate the scaler map before the loop to speed up
-    scalar_map_pos, scalar_map_neg = None, None
-    for ind in range(x.shape[0]):
-        colors[ind] = arr_to_colors_two_colors_maps(x[ind], x_min, x_max, cm_big, cm_small, threshold,
-            default_val, scalar_map_pos, scalar_map_neg, flip_cm_big, flip_cm_small)
-    return np.array(colors)
+    # All the rows are colored at once, using the colors maps lookup tables
+    return calc_two_colors_maps_colors(
+        x, x_min, x_max, cm_big, cm_small, threshold, default_val, None, None, flip_cm_big, flip_cm_small)
 
 
 def read_srf_file(srf_file):
@@ -222,30 +281,51 @@ def read_srf_file(srf_file):
     return verts, faces, verts_num, faces_num
 
 
-def read_ply_file(ply_file, npz_fname=''):
+def get_surface_npz_fname(surf_fname):
+    if file_type(surf_fname) == 'ply':
+        return change_fname_extension(surf_fname, 'npz')
+    else:
+        # FreeSurfer surfaces, like lh.pial (lh.pial.npz is the lh.pial.ply npz)
+        return '{}.fs.npz'.format(surf_fname)
+
+
+def read_surface_file(surf_fname):
+    if file_type(surf_fname) == 'ply':
+        verts, faces = mu.read_ply_file(surf_fname)
+    else:
+        import nibabel as nib
+        verts, faces = nib.freesurfer.read_geometry(surf_fname)
+    return verts.astype(np.float64), faces.astype(np.int64)
+
+
+def read_ply_file(ply_file, npz_fname='', use_cache=True):
+    # Reads ply / FreeSurfer surfaces. The npz next to the surface file is written automatically and used while it's
+    # newer than the surface, and the surfaces are memoized in the process (returning copies)
     if file_type(ply_file) == '':
         ply_file = '{}.ply'.format(ply_file)
-    npz_file = change_fname_extension(ply_file, 'npz')
-    if file_type(ply_file) == 'ply' and not op.isfile(npz_file):
-        # print('Reading {}'.format(ply_file))
-        with open(ply_file, 'r') as f:
-            lines = f.readlines()
-            verts_num = int(lines[2].split(' ')[-1])
-            faces_num = int(lines[6].split(' ')[-1])
-            verts_lines = lines[9:9 + verts_num]
-            faces_lines = lines[9 + verts_num:]
-            verts = np.array([list(map(float, l.strip().split(' '))) for l in verts_lines])
-            faces = np.array([list(map(int, l.strip().split(' '))) for l in faces_lines])[:,1:]
-    elif file_type(ply_file) == 'npz' or op.isfile(npz_file):
+    npz_file = ply_file if file_type(ply_file) == 'npz' else get_surface_npz_fname(ply_file)
+    surf_stamp = lambda: tuple(op.getmtime(f) if op.isfile(f) else None for f in (ply_file, npz_file))
+    cache_key = op.abspath(ply_file)
+    if use_cache and cache_key in _surfaces_cache and _surfaces_cache[cache_key][0] == surf_stamp():
+        verts, faces = _surfaces_cache[cache_key][1:]
+        return verts.copy(), faces.copy()
+    if op.isfile(npz_file) and (not op.isfile(ply_file) or op.getmtime(npz_file) >= op.getmtime(ply_file)):
         # print('Reading {}'.format(npz_file))
         d = np.load(npz_file)
         verts, faces = d['verts'], d['faces']
-        faces = faces.astype(np.int)
-    # elif npz_fname != '' and op.isfile(npz_fname):
-    #     d = np.load(npz_fname)
-    #     verts, faces = d['verts'], d['faces']
+        faces = faces.astype(np.int64)
+    elif op.isfile(ply_file):
+        # print('Reading {}'.format(ply_file))
+        verts, faces = read_surface_file(ply_file)
+        try:
+            np.savez(npz_file, verts=verts, faces=faces)
+        except:
+            print("read_ply_file: Can't write {}".format(npz_file))
     else:
         raise Exception("Can't find ply/npz file!")
+    if use_cache:
+        _surfaces_cache[cache_key] = (surf_stamp(), verts, faces)
+        return verts.copy(), faces.copy()
     return verts, faces
 
 
@@ -267,9 +347,7 @@ def load_surf(subject, mmvt_dir, subjects_dir, surf_type='pial'):
             hemi_verts, _ = read_ply_file(
                 op.join(subjects_dir, subject, 'surf', '{}.{}.ply'.format(hemi, surf_type)))
         elif op.isfile(op.join(subjects_dir, subject, 'surf', '{}.{}'.format(hemi, surf_type))):
-            import nibabel as nib
-            hemi_verts, _ = nib.freesurfer.read_geometry(
-                op.join(subjects_dir, subject, 'surf', '{}.{}'.format(hemi, surf_type)))
+            hemi_verts, _ = read_ply_file(op.join(subjects_dir, subject, 'surf', '{}.{}'.format(hemi, surf_type)))
         else:
             print("Can't find {} {} ply/npz files!".format(hemi, surf_type))
             return None
@@ -282,7 +360,6 @@ def load_surf(subject, mmvt_dir, subjects_dir, surf_type='pial'):
 #     return d['verts'], d['faces']
 
 
-@functools.lru_cache(maxsize=None)
 def read_pial(subject, mmvt_dir, hemi, surface_type='pial'):
     verts, faces = read_ply_file(op.join(mmvt_dir, subject, 'surf', '{}.{}.ply'.format(hemi, surface_type)))
     return verts, faces
@@ -351,31 +428,21 @@ def get_ply_vertices_num(ply_file_template):
 
 
 def calc_ply_faces_verts(verts, faces, out_file, overwrite=False, ply_name='', errors={}, verbose=False):
-    if not overwrite and op.isfile(out_file):
+    if not overwrite and faces_verts_lookup_exists(out_file):
         if verbose:
             print('{} already exist.'.format(out_file))
     else:
-        _faces = faces.ravel()
         if verbose:
             print('{}: verts: {}, faces: {}, faces ravel: {}'.format(
-                ply_name, verts.shape[0], faces.shape[0], len(_faces)))
-        faces_arg_sort = np.argsort(_faces)
-        faces_sort = np.sort(_faces)
-        faces_count = Counter(faces_sort)
-        max_len = max([v for v in faces_count.values()])
-        print(ply_name, verts.shape[0], max_len)
-        lookup = np.ones((verts.shape[0], max_len)) * -1
-        diff = np.diff(faces_sort)
-        n = 0
-        for ind, (k, v) in enumerate(zip(faces_sort, faces_arg_sort)):
-            lookup[k, n] = v
-            n = 0 if ind < len(diff) and diff[ind] > 0 else n+1
-        np.save(out_file, lookup.astype(np.int))
+                ply_name, verts.shape[0], faces.shape[0], faces.size))
+        lookup = mu.calc_faces_verts_lookup(faces, verts.shape[0])
+        print(ply_name, verts.shape[0], np.max(np.diff(lookup.indptr)))
+        mu.save_faces_verts_lookup(lookup, out_file)
         if verbose:
-            print('{} max lookup val: {}'.format(ply_name, int(np.max(lookup))))
-        if len(_faces) != int(np.max(lookup)) + 1:
+            print('{} max lookup val: {}'.format(ply_name, int(np.max(lookup.loops))))
+        if faces.size != int(np.max(lookup.loops)) + 1:
             errors[ply_name] = 'Wrong values in lookup table! ' + \
-                'faces ravel: {}, max looup val: {}'.format(len(_faces), int(np.max(lookup)))
+                'faces ravel: {}, max looup val: {}'.format(faces.size, int(np.max(lookup.loops)))
     return errors
 
 
@@ -1054,13 +1121,61 @@ def check_for_necessary_files(necessary_files, root_fol):
                 raise Exception('{} does not exist!'.format(full_path))
 
 
-def run_parallel(func, params, njobs=1):
+class ParallelTask(object):
+    # Wraps the worker function, so the workers return their exceptions instead of raising them
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, p):
+        try:
+            return True, self.func(p)
+        except:
+            return False, traceback.format_exc()
+
+
+def get_pool(njobs):
+    # A lazily created process-wide pool, reused while the number of workers stays the same
+    global _pool
+    if _pool is not None and (_pool[1] != njobs or _pool[2] != os.getpid()):
+        shutdown_pool()
+    if _pool is None:
+        _pool = (multiprocessing.Pool(processes=njobs), njobs, os.getpid())
+    return _pool[0]
+
+
+def shutdown_pool():
+    # Should be called when the global state the workers were forked with changes (like a new subject)
+    global _pool
+    if _pool is not None and _pool[2] == os.getpid():
+        _pool[0].close()
+        _pool[0].join()
+    _pool = None
+
+
+atexit.register(shutdown_pool)
+
+
+def run_parallel(func, params, njobs=1, chunksize=None):
     if njobs == 1:
         results = [func(p) for p in params]
     else:
-        pool = multiprocessing.Pool(processes=njobs)
-        results = pool.map(func, params)
-        pool.close()
+        params = list(params)
+        if chunksize is None:
+            chunksize = max(1, int(np.ceil(len(params) / (njobs * 4))))
+        pool = get_pool(njobs)
+        results, errors = [], []
+        for ind, (success, result) in enumerate(pool.imap(ParallelTask(func), params, chunksize)):
+            results.append(result if success else None)
+            if not success:
+                errors.append((ind, result))
+        if len(errors) > 0:
+            func_name = getattr(func, '__name__', str(func))
+            for ind, error in errors:
+                params_str = str(params[ind])
+                print('run_parallel: Error in {} for params #{}: {}'.format(
+                    func_name, ind, params_str if len(params_str) < 1000 else params_str[:1000] + '...'))
+                print(error)
+            raise Exception('run_parallel: {} of {} {} tasks failed!'.format(len(errors), len(params), func_name))
     return results
 
 